@@ -1,8 +1,15 @@
+import array
 import struct
+import sys
 
 class Packet:
     HEADER_FORMAT = '!IIHH'
     HEADER_SIZE = 12
+    # precompiled header so the hot paths don't re-parse the format string
+    HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+    STUDENT_ID = 696
+    # zero bytes used to fill in padding, sliced instead of allocated
+    PADDING = b'\x00\x00\x00'
 
     # initialize mock header + payload with class
     # assumes that the payload is already processed in byte form and ready to send
@@ -10,15 +17,14 @@ class Packet:
         self.payload_len = payload_len
         self.psecret = psecret
         self.step = step
-        self.id_num = 696
+        self.id_num = Packet.STUDENT_ID
         self.payload = payload
 
 
     # processes the packet object into sendable form
     # adds header and padding
     def wrap_payload(self) -> bytes:
-        header = struct.pack(
-            self.HEADER_FORMAT,
+        header = self.HEADER_STRUCT.pack(
             self.payload_len,
             self.psecret,
             self.step,
@@ -33,22 +39,117 @@ class Packet:
             padding = 4 - len(packet) % 4
 
         packet += b'\x00' * padding
-        
+
         return packet
 
 
+    # writes the packet (header + payload + padding) into buf at offset
+    # returns the number of bytes written
+    def pack_into(self, buf, offset: int = 0) -> int:
+        return Packet.encode_into(
+            buf, offset, self.payload_len, self.psecret, self.step,
+            self.payload, self.id_num
+        )
+
+
+    # returns the size of a packet on the wire for a payload of payload_len bytes
+    @staticmethod
+    def padded_size(payload_len: int) -> int:
+        return (Packet.HEADER_SIZE + payload_len + 3) & ~3
+
+
+    # writes a header, payload and padding straight into buf at offset
+    # without building any intermediate bytes objects
+    # if payload is None the payload bytes are left for the caller to fill in
+    # returns the padded length of the packet
+    @staticmethod
+    def encode_into(buf, offset: int, payload_len: int, psecret: int, step: int,
+                    payload=None, id_num: int = STUDENT_ID) -> int:
+        Packet.HEADER_STRUCT.pack_into(buf, offset, payload_len, psecret, step, id_num)
+
+        start = offset + Packet.HEADER_SIZE
+        if payload is None:
+            end = start + payload_len
+        else:
+            end = start + len(payload)
+            buf[start:end] = payload
+
+        total = (end - offset + 3) & ~3
+        buf[end:offset + total] = Packet.PADDING[:offset + total - end]
+
+        return total
+
+
+    # parses a received buffer without copying
+    # returns the header tuple (payload_len, psecret, step, id_num) and
+    # a memoryview over the payload (truncated if the buffer is short)
+    @staticmethod
+    def parse(buf, offset: int = 0):
+        header = Packet.HEADER_STRUCT.unpack_from(buf, offset)
+
+        start = offset + Packet.HEADER_SIZE
+        return header, memoryview(buf)[start:start + header[0]]
+
+
+    # encodes count packets that share one header template back to back into buf
+    # if first_id is given, the first 4 bytes of each payload hold consecutive
+    # packet ids (first_id, first_id + 1, ...) and payload_len includes them
+    # returns the padded size of one packet (the stride between packets)
+    @staticmethod
+    def encode_batch(buf, count: int, payload_len: int, psecret: int, step: int,
+                     payload=None, first_id=None, offset: int = 0) -> int:
+        template = bytearray(Packet.padded_size(payload_len))
+        Packet.HEADER_STRUCT.pack_into(template, 0, payload_len, psecret, step, Packet.STUDENT_ID)
+        if payload is not None:
+            start = Packet.HEADER_SIZE if first_id is None else Packet.HEADER_SIZE + 4
+            template[start:start + len(payload)] = payload
+
+        stride = len(template)
+        end = offset + stride * count
+        buf[offset:end] = template * count
+
+        if first_id is not None:
+            # write the ids one byte column at a time instead of once per packet
+            ids = array.array('I', range(first_id, first_id + count))
+            if sys.byteorder == 'little':
+                ids.byteswap()
+            ids = ids.tobytes()
+            for i in range(4):
+                start = offset + Packet.HEADER_SIZE + i
+                buf[start:end:stride] = ids[i::4]
+
+        return stride
+
+
+    # splits a batch written by encode_batch into one memoryview per packet,
+    # ready to be handed to sendto or sendmsg as an iovec list
+    @staticmethod
+    def split_batch(buf, count: int, stride: int, offset: int = 0):
+        view = memoryview(buf)
+        return [view[offset + i * stride:offset + (i + 1) * stride] for i in range(count)]
+
+
+    # parses count packets laid out back to back in buf without copying
+    # yields (header, payload memoryview) for each one in order
+    @staticmethod
+    def parse_batch(buf, count: int, offset: int = 0):
+        for _ in range(count):
+            header, payload = Packet.parse(buf, offset)
+            yield header, payload
+            offset += Packet.padded_size(header[0])
+
+
     # returns the payload in bytes from a packet
     @staticmethod
     def extract_payload(packet: bytes) -> bytes:
-        header = struct.unpack(Packet.HEADER_FORMAT, packet[:Packet.HEADER_SIZE])
+        header = Packet.HEADER_STRUCT.unpack(packet[:Packet.HEADER_SIZE])
 
         payload_start = Packet.HEADER_SIZE
         payload_len = header[0]
 
         return packet[payload_start:payload_start + payload_len]
-        
 
 
 
-    
+
 
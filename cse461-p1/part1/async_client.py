@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import socket
+import struct
+import sys
+import time
+import jsonlog
+from packet_struct import Packet
+from reliability import GoBackNSender, RttEstimator, backoff_delays
+from client import TIMEOUT, PACKET_ID, STAGE_B_RESPONSE, StageBPackets
+
+# asyncio version of the client: the same stages on asyncio transports, so a
+# single process can run thousands of handshakes at once
+#
+#   secrets, timings, stats = await run_handshake(host, port)
+#
+# returns the same as client.run_handshake. Run as a script it does a batch
+# of handshakes and writes one JSON line per handshake:
+#
+#   python3 async_client.py localhost 12235 --count 1000 --concurrency 500
+
+log = logging.getLogger("client")
+
+STAGE_A_PAYLOAD = b'hello world\0'
+STAGE_A_RESPONSE = struct.Struct('!IIII')
+STAGE_C_RESPONSE = struct.Struct('!IIIc')
+STAGE_D_RESPONSE = struct.Struct('!I')
+# stage D bytes handed to the transport before waiting for it to drain
+STAGE_D_WRITE_BYTES = 1 << 20
+
+
+class DatagramQueue(asyncio.DatagramProtocol):
+    # collects the datagrams of one session's UDP socket for recv()
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait(data)
+
+    # waits up to timeout seconds for the next datagram, returns its payload
+    async def recv(self, timeout):
+        try:
+            data = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out") from None
+        return Packet.parse(data)[1]
+
+
+async def stage_a(transport, protocol, server, rtt):
+    log.info("---- Starting Stage A ----")
+    sent_at = time.monotonic()
+    transport.sendto(Packet(len(STAGE_A_PAYLOAD), 0, 1, STAGE_A_PAYLOAD).wrap_payload(), server)
+
+    payload = await protocol.recv(TIMEOUT)
+    rtt.sample(time.monotonic() - sent_at)
+    if len(payload) < STAGE_A_RESPONSE.size:
+        raise ValueError("Stage A response too short")
+
+    num, length, udp_port, secretA = STAGE_A_RESPONSE.unpack_from(payload)
+    log.info("Received: num=%d, len=%d, udp_port=%d, secretA=%d", num, length, udp_port, secretA)
+    return num, length, udp_port, secretA
+
+
+async def stage_b(transport, protocol, dest, num, length, secretA, rtt):
+    log.info("---- Starting Stage B ----")
+    packets = StageBPackets(num, length, secretA)
+    stride = packets.stride
+
+    # the same Go-Back-N sender as the blocking client, driven by the event loop
+    sender = GoBackNSender(num, packets.window, rtt)
+    response = None
+    give_up = time.monotonic() + TIMEOUT
+    while not sender.done():
+        now = time.monotonic()
+        if now > give_up:
+            raise socket.timeout(f"No ACK for packet {sender.base}")
+        ids = sender.poll(now)
+        if ids:
+            data = packets.fill(ids)
+            for start in range(0, len(data), stride):
+                transport.sendto(data[start:start + stride], dest)
+
+        try:
+            payload = await protocol.recv(max(sender.next_timeout(now), 0.001))
+        except socket.timeout:
+            continue
+
+        # the stage B response in place of the last ack acks the rest
+        if len(payload) == STAGE_B_RESPONSE.size:
+            response = payload
+            break
+        if sender.on_ack(PACKET_ID.unpack_from(payload)[0], time.monotonic()):
+            give_up = time.monotonic() + TIMEOUT
+
+    stats = sender.stats()
+    log.info("Stage B: sent %d packets for %d, %d retransmitted after %d timeouts",
+             stats["sent"], num, stats["retransmits"], stats["timeouts"])
+
+    if response is None:
+        response = await protocol.recv(TIMEOUT)
+    if len(response) < STAGE_B_RESPONSE.size:
+        raise ValueError("Stage B response too short")
+    tcp_port, secretB = STAGE_B_RESPONSE.unpack_from(response)
+    log.info("Received: tcp_port=%d, secretB=%d", tcp_port, secretB)
+    return tcp_port, secretB, stats
+
+
+# the server may still be setting up its listener, so a refused connection
+# is retried, backing off, for up to TIMEOUT (it only listens that long)
+async def connect(host, tcp_port):
+    delays = backoff_delays(TIMEOUT)
+    while True:
+        try:
+            log.info("Connecting to TCP port %d...", tcp_port)
+            return await asyncio.wait_for(asyncio.open_connection(host, tcp_port), TIMEOUT)
+        except ConnectionRefusedError:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+        except asyncio.TimeoutError:
+            raise socket.timeout(f"Connecting to TCP port {tcp_port} timed out") from None
+
+
+# reads one packet from the stream, returns its payload
+async def read_packet(reader):
+    header = await asyncio.wait_for(reader.readexactly(Packet.HEADER_SIZE), TIMEOUT)
+    payload_len = Packet.HEADER_STRUCT.unpack(header)[0]
+    payload = await asyncio.wait_for(reader.readexactly(Packet.padded_size(payload_len) - Packet.HEADER_SIZE), TIMEOUT)
+    return payload[:payload_len]
+
+
+async def stage_c(reader):
+    log.info("---- Starting Stage C ----")
+    payload = await read_packet(reader)
+    if len(payload) < STAGE_C_RESPONSE.size:
+        raise ValueError("Stage C response too short")
+    num2, len2, secretC, c = STAGE_C_RESPONSE.unpack_from(payload)
+    log.info("Received: num2=%d, len2=%d, secretC=%d, c=%s", num2, len2, secretC, c.decode())
+    return num2, len2, secretC, c
+
+
+async def stage_d(reader, writer, num2, len2, secretC, c):
+    log.info("---- Starting Stage D ----")
+    # all num2 packets are identical, write the one buffer num2 times,
+    # a bounded number at a time so large transfers aren't joined in memory
+    packet = bytearray(Packet.padded_size(len2))
+    Packet.encode_into(packet, 0, len2, secretC, 1, c * len2)
+    per_write = max(1, STAGE_D_WRITE_BYTES // len(packet))
+    for start in range(0, num2, per_write):
+        writer.writelines([packet] * min(per_write, num2 - start))
+        await writer.drain()
+
+    payload = await read_packet(reader)
+    if len(payload) < STAGE_D_RESPONSE.size:
+        raise ValueError("Stage D response too short")
+    secretD = STAGE_D_RESPONSE.unpack_from(payload)[0]
+    log.info("Received: secretD=%d", secretD)
+    return secretD
+
+
+# runs one full handshake against host:port, returns the same as
+# client.run_handshake; raises socket.timeout or OSError on failure
+async def run_handshake(host, port):
+    loop = asyncio.get_running_loop()
+    timings = {}
+    rtt = RttEstimator()
+    start = last = time.monotonic()
+
+    def lap(stage):
+        nonlocal last
+        now = time.monotonic()
+        timings[stage] = now - last
+        last = now
+
+    # resolve once, the stage B port is on the same host
+    info = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    address = info[0][4][0]
+
+    transport, protocol = await loop.create_datagram_endpoint(
+        DatagramQueue, local_addr=("0.0.0.0", 0), family=socket.AF_INET
+    )
+    writer = None
+    try:
+        num, length, udp_port, secretA = await stage_a(transport, protocol, (address, port), rtt)
+        lap("a")
+        tcp_port, secretB, stats = await stage_b(transport, protocol, (address, udp_port), num, length, secretA, rtt)
+        lap("b")
+        transport.close()
+
+        reader, writer = await connect(address, tcp_port)
+        lap("connect")
+        num2, len2, secretC, c = await stage_c(reader)
+        lap("c")
+        secretD = await stage_d(reader, writer, num2, len2, secretC, c)
+        lap("d")
+        stats["bytes_b"] = num * length
+        stats["bytes_d"] = num2 * len2
+    finally:
+        transport.close()
+        if writer is not None:
+            writer.close()
+
+    timings["total"] = time.monotonic() - start
+    return (secretA, secretB, secretC, secretD), timings, stats
+
+
+async def run_batch(host, port, count, concurrency, output):
+    # at most concurrency handshakes in flight, each result written as it ends
+    limit = asyncio.Semaphore(concurrency)
+    ok = 0
+
+    async def one(index):
+        nonlocal ok
+        async with limit:
+            try:
+                secrets, timings, stats = await run_handshake(host, port)
+                result = {"index": index, "ok": True, "secrets": secrets, "timings": timings, "stats": stats}
+                ok += 1
+            except (socket.timeout, asyncio.IncompleteReadError) as e:
+                result = {"index": index, "ok": False, "reason": "timeout", "error": str(e)}
+            except Exception as e:
+                result = {"index": index, "ok": False, "reason": type(e).__name__, "error": str(e)}
+        output.write(json.dumps(result) + "\n")
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.monotonic() - start
+    print(f"{ok}/{count} handshakes in {elapsed:.2f} s ({ok / elapsed:.1f}/s)", file=sys.stderr)
+
+
+def raise_fd_limit():
+    # every handshake in flight holds a socket or two
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio CSE 461 project 1 client")
+    parser.add_argument("server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--count", type=int, default=1,
+                        help="handshakes to run (default: 1)")
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="handshakes in flight at once (default: 100)")
+    parser.add_argument("--output", default=None,
+                        help="write the JSON lines here instead of stdout")
+    jsonlog.add_arguments(parser)
+    parser.set_defaults(log_level="warning")
+    args = parser.parse_args()
+
+    jsonlog.setup_logging("client", args.log_level, args.log_file, args.log_sample, args.log_rate)
+    raise_fd_limit()
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        asyncio.run(run_batch(args.server, args.port, args.count, args.concurrency, output))
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
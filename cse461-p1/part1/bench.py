@@ -0,0 +1,158 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import jsonlog
+from client import run_handshake
+from loadgen import STAGES, latency_summary
+
+# Runs the part 2 server and clients in one process over each transport
+# backend (see transport.py) and compares them:
+#
+#   python3 bench.py --transports inet,unix,memory --count 2000 --concurrency 50
+#
+# memory has no kernel in the path at all, so its CPU time per handshake is
+# what the protocol handling in Python costs; what inet and unix add on top
+# of that is the network stack. Every backend runs in a fresh process so
+# each gets a server of its own.
+
+# the part 2 server modules, after ours so the shared ones come from here
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "part2"))
+
+HOST = "localhost"
+BACKENDS = ("inet", "unix", "memory")
+
+
+def run_backend(name, args):
+    import server
+
+    server_args = server.make_parser().parse_args(
+        [HOST, str(args.port), "--log-level", "quiet", "--stage-b", args.stage_b, "--profile", args.profile,
+         "--tcp", args.tcp]
+        + (["--drain"] if args.drain else [])
+    )
+    # memory isn't on the server's command line, it only works in-process
+    server_args.transport = name
+    server_args.unix_dir = tempfile.mkdtemp(prefix="cse461-bench-")
+    server.configure(server_args)
+    server.TIMERS.start()
+    thread = threading.Thread(target=server.start_udp_server, daemon=True)
+    thread.start()
+    # let it bind, a hello sent before that is lost and waits out the client timeout
+    time.sleep(0.5)
+
+    results = []
+    lock = threading.Lock()
+    remaining = iter(range(args.count))
+
+    def client():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            try:
+                _, timings, _ = run_handshake(HOST, args.port, server.TRANSPORT)
+                result = {"ok": True, "timings": timings}
+            except (socket.timeout, TimeoutError):
+                result = {"ok": False, "reason": "timeout"}
+            except Exception as e:
+                result = {"ok": False, "reason": type(e).__name__}
+            with lock:
+                results.append(result)
+
+    cpu = os.times()
+    start = time.monotonic()
+    clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for worker in clients:
+        worker.start()
+    for worker in clients:
+        worker.join()
+    elapsed = time.monotonic() - start
+    used = os.times()
+
+    ok = [result["timings"] for result in results if result["ok"]]
+    failures = {}
+    for result in results:
+        if not result["ok"]:
+            failures[result["reason"]] = failures.get(result["reason"], 0) + 1
+    # server and clients share the process, so this is the CPU of both ends
+    cpu_user = used.user - cpu.user
+    cpu_system = used.system - cpu.system
+    return {
+        "transport": name,
+        "handshakes": len(ok),
+        "attempts": len(results),
+        "duration": elapsed,
+        "handshakes_per_sec": len(ok) / elapsed if elapsed else 0,
+        "failures": failures,
+        "latency": {stage: latency_summary([t[stage] for t in ok]) for stage in STAGES},
+        "cpu": {
+            "user": cpu_user,
+            "system": cpu_system,
+            "per_handshake": (cpu_user + cpu_system) / len(ok) if ok else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process transport benchmark for the CSE 461 project 1 handshake")
+    parser.add_argument("--transports", default="inet,unix,memory",
+                        help="comma separated backends to run, one after another (default: inet,unix,memory)")
+    parser.add_argument("--count", type=int, default=1000,
+                        help="handshakes per backend (default: 1000)")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="client threads (default: 20)")
+    parser.add_argument("--port", type=int, default=12235,
+                        help="stage A port (default: 12235)")
+    parser.add_argument("--stage-b", choices=["bind", "pool", "shared"], default="bind",
+                        help="the server's --stage-b mode (default: bind)")
+    parser.add_argument("--profile", default="classic",
+                        help="the server's --profile (default: classic)")
+    parser.add_argument("--tcp", choices=["listen", "shared"], default="listen",
+                        help="the server's --tcp mode (default: listen)")
+    parser.add_argument("--drain", action="store_true",
+                        help="run the server with --drain")
+    parser.add_argument("--output", default=None,
+                        help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    names = args.transports.split(",")
+    for name in names:
+        if name not in BACKENDS:
+            parser.error(f"unknown transport {name!r}, pick from {', '.join(BACKENDS)}")
+
+    report = {"count": args.count, "concurrency": args.concurrency, "stage_b": args.stage_b,
+              "profile": args.profile, "tcp": args.tcp, "drain": args.drain, "runs": []}
+    # spawn, so every backend starts from a clean server module
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        with context.Pool(1, jsonlog.setup_logging, ("client", "quiet")) as pool:
+            run = pool.apply(run_backend, (name, args))
+        report["runs"].append(run)
+        per_handshake = run["cpu"]["per_handshake"] or 0
+        print(f"{name}: {run['handshakes_per_sec']:.1f} handshakes/s, "
+              f"{per_handshake * 1000:.2f} ms CPU per handshake, "
+              f"{run['failures']} failures", file=sys.stderr)
+
+    # the share of CPU per handshake that goes beyond the Python protocol code
+    memory = next((run for run in report["runs"] if run["transport"] == "memory"), None)
+    if memory and memory["cpu"]["per_handshake"]:
+        for run in report["runs"]:
+            if run["cpu"]["per_handshake"]:
+                run["cpu"]["network_share"] = 1 - memory["cpu"]["per_handshake"] / run["cpu"]["per_handshake"]
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
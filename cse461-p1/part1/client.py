@@ -1,184 +1,342 @@
+import argparse
+import errno
+import logging
 import socket
 import struct
+import sys
+import time
 # import struct
 from packet_struct import Packet
-import sys
+from stream_reader import PacketStreamReader
+from reliability import GoBackNSender, RttEstimator, backoff_delays
+import jsonlog
+import packet_trace
+import transport
 
-SERVER_ADDR = sys.argv[1]
-TIMEOUT = 10
-RETRANSMIT_INTERVAL = 1
-UDP_PORT = int(sys.argv[2])
+log = logging.getLogger("client")
 
-def stage_a(sock):
-    print("---- Starting Stage A ----")
+TIMEOUT = 10
+# stage B packets in flight at once
+STAGE_B_WINDOW = 8
+# ... and bytes, so large packets don't overrun the server's receive buffer
+STAGE_B_WINDOW_BYTES = 131072
+RECV_SIZE = 1024
+PACKET_ID = struct.Struct('!I')
+STAGE_B_RESPONSE = struct.Struct('!II')
+# most iovecs the kernel accepts in one sendmsg call
+IOV_MAX = 1024
+# UDP generic segmentation offload (Linux 4.18+): one sendmsg hands the kernel
+# a buffer of equal sized datagrams to split up, instead of a syscall each
+SOL_UDP = 17
+UDP_SEGMENT = 103
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+# a packet_trace.TraceWriter with --trace
+TRACE = None
+
+# the hello world round trip is the first RTT sample for rtt
+def stage_a(sock, buf, server_addr, port, rtt):
+    log.info("---- Starting Stage A ----")
 
     payload = b'hello world\0'
     packet = Packet(len(payload), 0, 1, payload)
     processed_packet = packet.wrap_payload()
 
-    print(f"Sending packet: {processed_packet}")
+    log.debug("Sending packet: %r", processed_packet)
 
-    sock.sendto(processed_packet, (SERVER_ADDR, UDP_PORT))
-    print("Sent 'hello world'")
+    sent_at = time.monotonic()
+    sock.sendto(processed_packet, (server_addr, port))
+    log.info("Sent 'hello world'")
 
-    data, _ = sock.recvfrom(1024)
+    nbytes, _ = sock.recvfrom_into(buf)
+    rtt.sample(time.monotonic() - sent_at)
 
-    payload = Packet.extract_payload(data)
+    _, payload = Packet.parse(memoryview(buf)[:nbytes])
 
     if len(payload) < 16:
-        print("Stage A response too short")
+        log.warning("Stage A response too short")
         
     num, length, udp_port, secretA = struct.unpack('!IIII', payload)
-    print(f"Received: num={num}, len={length}, udp_port={udp_port}, secretA={secretA}")
+    log.info("Received: num=%d, len=%d, udp_port=%d, secretA=%d", num, length, udp_port, secretA)
 
     return num, length, udp_port, secretA
 
-def stage_b(sock, num, length, udp_port, secretA):
-    print("---- Starting Stage B ----")
-    
-    payload = b'\x00' * length
-    for id in range(num):
-        # send num packets with id number of 4 bytes and payload of length length with 0s
-        full_payload = struct.pack('!I', id) + payload
-        packet = Packet(len(full_payload), secretA, 1, full_payload)
-        processed_packet = packet.wrap_payload()
-        send_ack(sock, processed_packet, id, udp_port)
+# returns tcp_port, secretB and the sender's retransmit and RTT statistics
+def stage_b(sock, buf, server_addr, num, length, udp_port, secretA, rtt):
+    log.info("---- Starting Stage B ----")
     
-    # Create a longer timeout because gradescopt will take longer
-    try:
-        sock.settimeout(TIMEOUT)
-        data, _ = sock.recvfrom(1024)
-    except socket.timeout:
-        print("No response received for Stage B")
+    # send num packets with id number of 4 bytes and payload of length length with 0s
+    packets = StageBPackets(num, length, secretA)
+
+    # keep a window of packets in flight instead of waiting for every ack
+    # how long to wait for acks before resending adapts to the measured RTT
+    sender = GoBackNSender(num, packets.window, rtt)
+    response = send_window(sock, buf, sender, packets, (server_addr, udp_port))
+    stats = sender.stats()
+    log.info("Stage B: sent %d packets for %d, %d retransmitted after %d timeouts",
+             stats["sent"], num, stats["retransmits"], stats["timeouts"])
+
+    if response is None:
+        # Create a longer timeout because gradescopt will take longer
+        try:
+            sock.settimeout(TIMEOUT)
+            nbytes, _ = sock.recvfrom_into(buf)
+        except socket.timeout:
+            log.warning("No response received for Stage B")
+            raise
 
-    payload = Packet.extract_payload(data)
+        _, response = Packet.parse(memoryview(buf)[:nbytes])
 
-    if len(payload) < 8:
-        print(f"Stage B response too short")
+    if len(response) < 8:
+        log.warning("Stage B response too short")
 
-    tcp_port, secretB = struct.unpack('!II', payload)
+    tcp_port, secretB = STAGE_B_RESPONSE.unpack_from(response)
 
-    print(f"Received: tcp_port={tcp_port}, secretB={secretB}")
-    return tcp_port, secretB
+    log.info("Received: tcp_port=%d, secretB=%d", tcp_port, secretB)
+    return tcp_port, secretB, stats
 
-def stage_c(sock, tcp_port):
-    print("---- Starting Stage C ----")
+def stage_c(reader, tcp_port):
+    log.info("---- Starting Stage C ----")
 
     # receive packet from server and process
-    header = recv_data(sock, Packet.HEADER_SIZE)
-
-    if len(header) < Packet.HEADER_SIZE:
-        print("Stage C header too short")
-
-    payload_len = struct.unpack(Packet.HEADER_FORMAT, header)[0]
-
-    data = recv_data(sock, max(payload_len, 16))
-
-    payload = Packet.extract_payload(header + data)
+    _, payload = reader.read_packet()
 
     if len(payload) < 13:
-        print(f"Stage C response too short")
+        log.warning("Stage C response too short")
     
     num2, len2, secretC, c = struct.unpack('!IIIc', payload)
     
-    print(f"Received: num2={num2}, len2={len2}, secretC={secretC}, c={c.decode()}")
+    log.info("Received: num2=%d, len2=%d, secretC=%d, c=%s", num2, len2, secretC, c.decode())
     return num2, len2, secretC, c
 
-def stage_d(sock, num2, len2, secretC, c):
-    print("---- Starting Stage D ----")
+def stage_d(sock, reader, num2, len2, secretC, c):
+    log.info("---- Starting Stage D ----")
     
     payload = c * len2
-    print(f"Stage D: Sending {num2} packets of length {len(payload)} filled with char '{c}'")
+    log.info("Stage D: Sending %d packets of length %d filled with char %r", num2, len(payload), c)
     
-    # send num2 payloads
-    for i in range(num2):
-        packet = Packet(len(payload), secretC, 1, payload)
-        processed_packet = packet.wrap_payload()
-        print(f"Sending packet {i+1}/{num2} with payload length {len(payload)}")
-        sock.sendall(processed_packet)
-    
-    header = recv_data(sock, Packet.HEADER_SIZE)
-    if len(header) < Packet.HEADER_SIZE:
-        print("Stage D header too short")
-
-    payload_len = struct.unpack(Packet.HEADER_FORMAT, header)[0]
-    data = recv_data(sock, payload_len)
+    # all num2 packets are identical, so encode once and point every iovec at it
+    processed_packet = bytearray(Packet.padded_size(len2))
+    Packet.encode_into(processed_packet, 0, len2, secretC, 1, payload)
 
-    payload = Packet.extract_payload(header + data)
+    # send num2 payloads in as few syscalls as possible
+    send_all_buffers(sock, [memoryview(processed_packet)] * num2)
+    
+    _, payload = reader.read_packet()
 
     if len(payload) < 4:
-        print("Stage D response too short")
+        log.warning("Stage D response too short")
     
     secretD = struct.unpack('!I', payload)[0]
     
-    print(f"Received: secretD={secretD}")
+    log.info("Received: secretD=%d", secretD)
     return secretD
 
 
-def send_ack(sock, processed_packet, id, udp_port):
-
-    print(f"Sending packet with ack: {processed_packet}")
+class StageBPackets:
+    # every stage B packet is the same header and zeroed payload apart from
+    # its id, so rather than encoding all num of them (gigabytes with the
+    # large profiles) one window of packets is encoded once and the ids of
+    # the ones going out are written in before sending
+
+    def __init__(self, num, length, secretA):
+        stride = Packet.padded_size(length + 4)
+        self.window = max(1, min(STAGE_B_WINDOW, num, STAGE_B_WINDOW_BYTES // stride))
+        self.batch = bytearray()
+        self.stride = Packet.encode_batch(self.batch, self.window, length + 4, secretA, 1, first_id=0)
+        self.view = memoryview(self.batch)
+
+    # the packets for ids back to back, at most a window of them
+    def fill(self, ids):
+        for i, id in enumerate(ids):
+            PACKET_ID.pack_into(self.batch, i * self.stride + Packet.HEADER_SIZE, id)
+        return self.view[:len(ids) * self.stride]
+
+# sends the packets for every id the sender asks for and feeds it the acks
+# until every packet is acked
+# returns the stage B response payload if it arrived in place of the last ack
+def send_window(sock, buf, sender, packets, dest):
+    # GSO only on real sockets, and only while the kernel takes it
+    gso = sys.platform.startswith("linux") and type(sock) is socket.socket
+    # the server gives up on a quiet client after a few seconds, so retrying
+    # past TIMEOUT without progress would never get an answer
+    give_up = time.monotonic() + TIMEOUT
+    while not sender.done():
+        now = time.monotonic()
+        if now > give_up:
+            raise socket.timeout(f"No ACK for packet {sender.base}")
+        ids = sender.poll(now)
+        if ids:
+            log.debug("Sending packets %d-%d", ids[0], ids[-1])
+            gso = send_packets(sock, packets.fill(ids), packets.stride, dest, gso)
 
-    while True:
-        sock.sendto(processed_packet, (SERVER_ADDR, udp_port))
         try:
-            sock.settimeout(RETRANSMIT_INTERVAL)
-            data, _ = sock.recvfrom(1024)
-            
-            payload = Packet.extract_payload(data)
-            # now the id should be the next four bytes:
-            ack_id = struct.unpack('!I', payload[:4])[0]
-
-            if ack_id == id:
-                print(f"ACK received for id {ack_id}")
-                return data
+            sock.settimeout(max(sender.next_timeout(now), 0.001))
+            nbytes, _ = sock.recvfrom_into(buf)
         except socket.timeout:
-            print(f"Timeout, retrying")
-
-def recv_data(sock, length):
-    data = b''
-    while len(data) < length:
-        chunk = sock.recv(length - len(data))
-        data += chunk
-    return data
-
-
-def main():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    print(f"Sending to {SERVER_ADDR}:{UDP_PORT}")
-    #sock.settimeout(TIMEOUT)
-
-    # start stage_a
-    num, length, udp_port, secretA = stage_a(sock)
-    
-    print("\n stage A complete!\n")
-
-    # start stage_b
-    tcp_port, secretB = stage_b(sock, num, length, udp_port, secretA)
-
-    print("\n stage B complete!\n")
-    sock.close()
-
-    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            log.debug("Timeout, resending from packet %d", sender.base)
+            continue
+
+        _, payload = Packet.parse(memoryview(buf)[:nbytes])
+        # acks carry a 4 byte packet id, the stage B response is 8 bytes and
+        # only comes once everything was acked, so it acks the rest
+        if len(payload) == STAGE_B_RESPONSE.size:
+            return payload
+        # now the id should be the next four bytes:
+        ack_id = PACKET_ID.unpack_from(payload)[0]
+        if sender.on_ack(ack_id, time.monotonic()):
+            log.debug("ACK received for id %d", ack_id)
+            give_up = time.monotonic() + TIMEOUT
+        else:
+            log.debug("Ignoring stale ACK for id %d", ack_id)
+    return None
+
+# sends the datagrams of stride bytes each in data to dest, with GSO if gso
+# returns whether GSO can be used next time
+def send_packets(sock, data, stride, dest, gso):
+    count = len(data) // stride
+    per_send = min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // stride)
+    if gso and count > 1 and per_send > 1:
+        segment = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', stride))]
+        try:
+            for start in range(0, len(data), per_send * stride):
+                sock.sendmsg([data[start:start + per_send * stride]], segment, 0, dest)
+            return True
+        except OSError as e:
+            # an old kernel, or datagrams too big for the route's MTU
+            if e.errno not in (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP):
+                raise
+            log.debug("UDP GSO not available (%s), sending datagrams one by one", e)
+            gso = False
+    # sending a packet twice is harmless if GSO failed half way
+    for start in range(0, len(data), stride):
+        sock.sendto(data[start:start + stride], dest)
+    return gso
+
+# writes every buffer to a stream socket, gathering them with sendmsg
+# and picking up where the kernel left off after a partial write
+def send_all_buffers(sock, buffers):
+    if not hasattr(sock, "sendmsg"):
+        for start in range(0, len(buffers), IOV_MAX):
+            sock.sendall(b''.join(buffers[start:start + IOV_MAX]))
+        return
+
+    start = 0
+    while start < len(buffers):
+        iov = buffers[start:start + IOV_MAX]
+        sent = sock.sendmsg(iov)
+        # skip the buffers that went out whole, then trim the partial one
+        for chunk in iov:
+            if sent < len(chunk):
+                break
+            sent -= len(chunk)
+            start += 1
+        if sent:
+            buffers[start] = buffers[start][sent:]
+
+# the server may still be setting up its listener, so a refused connection
+# is retried, backing off, for up to TIMEOUT (it only listens that long)
+def connect(server_addr, tcp_port, net=transport.SOCKETS):
+    delays = backoff_delays(TIMEOUT)
     while True:
         try:
-            print(f"Connecting to TCP port {tcp_port}...")
-            tcp_sock.connect((SERVER_ADDR, tcp_port))
-            break  # Connection successful, break out of the loop
-        except (ConnectionRefusedError, socket.timeout):
-            print(f"Connection to TCP port {tcp_port} refused. Retrying...")
-            continue  # Retry until connection is successful
-
-    # start stage_c
-    num2, len2, secretC, c = stage_c(tcp_sock, tcp_port)
-
-    print("\n stage C complete!\n")
-
-    # start stage_d
+            log.info("Connecting to TCP port %d...", tcp_port)
+            # a socket whose connect failed can't be reused, every attempt gets a fresh one
+            return net.connect((server_addr, tcp_port), TIMEOUT)
+        except ConnectionRefusedError:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            log.debug("Connection to TCP port %d refused. Retrying in %.3f s", tcp_port, delay)
+            time.sleep(delay)
+
+# returns the four secrets, how long each stage took in seconds (a, b,
+# connect, c, d and total) and the stage B retransmit and RTT statistics
+# with the payload bytes of stages B and D
+# runs one full handshake against server_addr:port over net (see transport.py)
+# raises socket.timeout or OSError on failure
+def run_handshake(server_addr, port, net=transport.SOCKETS):
+    timings = {}
+    rtt = RttEstimator()
+    start = last = time.monotonic()
+
+    def lap(stage):
+        nonlocal last
+        now = time.monotonic()
+        timings[stage] = now - last
+        last = now
+
+    sock = net.datagram()
+    tcp_sock = None
+    if TRACE:
+        session = TRACE.new_session()
+        sock = TRACE.wrap(sock, session, packet_trace.UDP)
+    try:
+        log.info("Sending to %s:%d", server_addr, port)
+        # one receive buffer is reused for every stage of the session
+        buf = bytearray(RECV_SIZE)
+        sock.settimeout(TIMEOUT)
 
-    secretD = stage_d(tcp_sock, num2, len2, secretC, c)
+        # start stage_a
+        num, length, udp_port, secretA = stage_a(sock, buf, server_addr, port, rtt)
+        lap("a")
+        log.info("stage A complete!")
+
+        # start stage_b
+        tcp_port, secretB, stats = stage_b(sock, buf, server_addr, num, length, udp_port, secretA, rtt)
+        lap("b")
+        log.info("stage B complete!")
+        sock.close()
+
+        tcp_sock = connect(server_addr, tcp_port, net)
+        if TRACE:
+            tcp_sock = TRACE.wrap(tcp_sock, session, packet_trace.TCP, tcp_port)
+        lap("connect")
+
+        # start stage_c
+        # every packet on the TCP connection is read through one buffered reader
+        reader = PacketStreamReader(tcp_sock)
+
+        num2, len2, secretC, c = stage_c(reader, tcp_port)
+        lap("c")
+        log.info("stage C complete!")
+
+        # start stage_d
+
+        secretD = stage_d(tcp_sock, reader, num2, len2, secretC, c)
+        lap("d")
+        log.info("stage D complete!")
+        # payload bytes moved, for goodput
+        stats["bytes_b"] = num * length
+        stats["bytes_d"] = num2 * len2
+    finally:
+        sock.close()
+        if tcp_sock is not None:
+            tcp_sock.close()
+
+    timings["total"] = time.monotonic() - start
+    return (secretA, secretB, secretC, secretD), timings, stats
 
-    print("\n stage D complete!\n")
+def main():
+    global TRACE
+    parser = argparse.ArgumentParser(description="CSE 461 project 1 client")
+    parser.add_argument("server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--transport", choices=["inet", "unix"], default="inet",
+                        help="inet: UDP and TCP sockets (default), unix: the server's Unix domain sockets")
+    parser.add_argument("--unix-dir", default=None,
+                        help="directory of the server's --transport unix socket files")
+    parser.add_argument("--trace", default=None,
+                        help="append every packet sent and received to this binary trace")
+    jsonlog.add_arguments(parser)
+    args = parser.parse_args()
+
+    jsonlog.setup_logging("client", args.log_level, args.log_file, args.log_sample, args.log_rate)
+    if args.trace:
+        TRACE = packet_trace.TraceWriter(args.trace, packet_trace.CLIENT)
+
+    net = transport.get(args.transport, args.unix_dir)
+    (secretA, secretB, secretC, secretD), _, stats = run_handshake(args.server, args.port, net)
 
     print("\n---- Final Output ----")
     print(f"Secret A: {secretA}")
@@ -186,7 +344,12 @@ def main():
     print(f"Secret C: {secretC}")
     print(f"Secret D: {secretD}")
 
-    tcp_sock.close()
+    print("\n---- Stage B ----")
+    print(f"Packets: {stats['packets']}, sent: {stats['sent']}, "
+          f"retransmitted: {stats['retransmits']}, timeouts: {stats['timeouts']}")
+    print(f"RTT: srtt={stats['srtt'] * 1000:.3f} ms, rttvar={stats['rttvar'] * 1000:.3f} ms, "
+          f"min={stats['rtt_min'] * 1000:.3f} ms, max={stats['rtt_max'] * 1000:.3f} ms, "
+          f"samples: {stats['rtt_samples']}, rto={stats['rto'] * 1000:.1f} ms")
 
 
 if __name__ == "__main__":
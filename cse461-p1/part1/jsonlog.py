@@ -0,0 +1,183 @@
+import atexit
+import collections
+import json
+import logging
+import sys
+import threading
+
+# Logging for the packet hot paths
+#
+# Records are filtered (level, per-session sampling and rate limiting) in the
+# thread that logs them and then only appended to a bounded deque; a
+# background thread formats them as JSON lines and writes them out in
+# batches. Nothing is formatted unless it is actually written, so always pass
+# values as %-style arguments instead of building f-strings:
+#
+#     log.debug("Acknowledged packet %d", packet_id, extra={"session": addr})
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    # nothing passes, a disabled call costs one cached level check
+    "quiet": logging.CRITICAL + 1,
+}
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        session = getattr(record, "session", None)
+        if session is not None:
+            entry["session"] = format_session(session)
+        entry["msg"] = record.getMessage()
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+def format_session(session):
+    # (host, port) tuples read better as host:port
+    if isinstance(session, tuple) and len(session) == 2:
+        return f"{session[0]}:{session[1]}"
+    return session
+
+
+class SessionSampler(logging.Filter):
+    # keeps 1 in sample records per session and at most rate records per
+    # second per session (0 for no limit); warnings and errors always pass
+
+    MAX_SESSIONS = 10000
+
+    def __init__(self, sample=1, rate=0):
+        super().__init__()
+        self.sample = sample
+        self.rate = rate
+        self.counts = {}   # session -> records seen
+        self.buckets = {}  # session -> [tokens, last refill time]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        session = getattr(record, "session", None)
+
+        if self.sample > 1:
+            if len(self.counts) > self.MAX_SESSIONS:
+                self.counts.clear()
+            count = self.counts.get(session, 0)
+            self.counts[session] = count + 1
+            if count % self.sample:
+                return False
+
+        if self.rate:
+            if len(self.buckets) > self.MAX_SESSIONS:
+                self.buckets.clear()
+            now = record.created
+            bucket = self.buckets.get(session)
+            if bucket is None:
+                bucket = self.buckets[session] = [self.rate, now]
+            # token bucket, refilled at rate tokens per second up to rate
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+
+        return True
+
+
+class DequeHandler(logging.Handler):
+    # hands records to the writer thread without taking a lock or formatting
+    # when the writer falls behind the oldest records are dropped
+
+    def __init__(self, records):
+        super().__init__()
+        self.records = records
+        self.dropped = 0
+
+    def handle(self, record):
+        if not self.filter(record):
+            return False
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)
+        return True
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class JsonLinesWriter(threading.Thread):
+    # drains the deque every interval seconds and writes the batch in one go
+
+    def __init__(self, records, stream, interval=0.05):
+        super().__init__(daemon=True)
+        self.records = records
+        self.stream = stream
+        self.interval = interval
+        self.formatter = JsonFormatter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        lines = []
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception as e:
+                lines.append(json.dumps({"level": "ERROR", "msg": f"Could not format log record: {e}"}))
+        if lines:
+            lines.append("")
+            self.stream.write("\n".join(lines))
+            self.stream.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def setup_logging(name, level="info", path=None, sample=1, rate=0, max_queued=100000):
+    # configures logger name to write JSON lines to path (stdout if None)
+    # and returns it
+    logger = logging.getLogger(name)
+    logger.setLevel(LEVELS[level])
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    records = collections.deque(maxlen=max_queued)
+    handler = DequeHandler(records)
+    handler.addFilter(SessionSampler(sample, rate))
+    logger.addHandler(handler)
+
+    stream = open(path, "a") if path else sys.stdout
+    writer = JsonLinesWriter(records, stream)
+    writer.start()
+    # write out whatever is still queued when the program exits
+    atexit.register(writer.stop)
+    return logger
+
+
+def add_arguments(parser):
+    parser.add_argument("--log-level", choices=list(LEVELS), default="info",
+                        help="debug logs every packet, quiet logs nothing (default: info)")
+    parser.add_argument("--log-file", default=None,
+                        help="write JSON lines here instead of stdout")
+    parser.add_argument("--log-sample", type=int, default=1,
+                        help="keep 1 in N debug/info records per session")
+    parser.add_argument("--log-rate", type=float, default=0,
+                        help="at most N debug/info records per second per session")
@@ -0,0 +1,247 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import jsonlog
+from client import run_handshake
+
+# Load generator for the project 1 server
+#
+# Every step of the ramp runs `concurrency` simulated clients for `duration`
+# seconds, spread over a pool of processes with a few threads each. Every
+# client runs handshakes back to back with client.run_handshake and the
+# results are reported as one JSON document:
+#
+#   python3 loadgen.py localhost 12235 --ramp 1,8,32 --duration 10 --spawn-server
+#
+# Latencies are in seconds, per stage and end to end, over the successful
+# handshakes of a step. Goodput counts the stage B and D payload bytes of
+# those handshakes. With --profiles and --spawn-server the whole ramp runs
+# once per server --profile (see part2/profiles.py):
+#
+#   python3 loadgen.py localhost 12235 --spawn-server --profiles classic,mtu,bulk --ramp 4
+
+STAGES = ("a", "b", "connect", "c", "d", "total")
+PERCENTILES = (50, 95, 99)
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "part2", "server.py")
+
+
+# runs in a pool process: threads clients doing handshakes until duration is up
+def run_clients(server, port, threads, duration):
+    results = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        while time.monotonic() < deadline:
+            try:
+                _, timings, stats = run_handshake(server, port)
+                result = {"ok": True, "timings": timings, "stats": stats}
+            except (socket.timeout, TimeoutError):
+                result = {"ok": False, "reason": "timeout"}
+            except Exception as e:
+                result = {"ok": False, "reason": type(e).__name__}
+            with lock:
+                results.append(result)
+
+    cpu = os.times()
+    start = time.monotonic()
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+    used = os.times()
+    return {
+        "results": results,
+        "elapsed": elapsed,
+        "cpu_user": used.user - cpu.user,
+        "cpu_system": used.system - cpu.system,
+    }
+
+
+# nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    summary = {f"p{p}": percentile(values, p) for p in PERCENTILES}
+    summary["mean"] = sum(values) / len(values) if values else None
+    summary["max"] = values[-1] if values else None
+    return summary
+
+
+# user and system CPU seconds of a process so far, from /proc (Linux only)
+def process_cpu(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return int(fields[11]) / ticks, int(fields[12]) / ticks
+
+
+# payload bytes moved per second, in total and per handshake
+def goodput_summary(stats, timings, elapsed):
+    bytes_b = sum(s["bytes_b"] for s in stats)
+    bytes_d = sum(s["bytes_d"] for s in stats)
+    return {
+        "bytes_b": bytes_b,
+        "bytes_d": bytes_d,
+        "bytes_per_sec": (bytes_b + bytes_d) / elapsed if elapsed else 0,
+        # how fast a single handshake moves its data through each stage
+        "stage_b_bytes_per_sec": latency_summary([s["bytes_b"] / t["b"] for s, t in zip(stats, timings) if t["b"]]),
+        "stage_d_bytes_per_sec": latency_summary([s["bytes_d"] / t["d"] for s, t in zip(stats, timings) if t["d"]]),
+    }
+
+
+def run_step(pool, args, concurrency, server_pid, profile):
+    # spread the clients over as many processes as are useful
+    processes = min(args.processes, concurrency)
+    threads = [concurrency // processes + (i < concurrency % processes) for i in range(processes)]
+
+    server_cpu = process_cpu(server_pid) if server_pid else None
+    start = time.monotonic()
+    outputs = pool.starmap(
+        run_clients, [(args.server, args.port, n, args.duration) for n in threads]
+    )
+    wall = time.monotonic() - start
+
+    results = [result for output in outputs for result in output["results"]]
+    ok = [result["timings"] for result in results if result["ok"]]
+    stats = [result["stats"] for result in results if result["ok"]]
+    failures = {}
+    for result in results:
+        if not result["ok"]:
+            failures[result["reason"]] = failures.get(result["reason"], 0) + 1
+
+    # clients finish the handshake they are in when time runs out,
+    # so rates are over how long the slowest process actually ran
+    elapsed = max(output["elapsed"] for output in outputs)
+    step = {
+        "profile": profile,
+        "concurrency": concurrency,
+        "processes": processes,
+        "duration": elapsed,
+        "handshakes": len(ok),
+        "attempts": len(results),
+        "handshakes_per_sec": len(ok) / elapsed if elapsed else 0,
+        "failures": failures,
+        "timeout_rate": failures.get("timeout", 0) / len(results) if results else 0,
+        "latency": {stage: latency_summary([t[stage] for t in ok]) for stage in STAGES},
+        "goodput": goodput_summary(stats, ok, elapsed),
+        "stage_b": {
+            "packets": sum(s["packets"] for s in stats),
+            "sent": sum(s["sent"] for s in stats),
+            "retransmits": sum(s["retransmits"] for s in stats),
+            "timeouts": sum(s["timeouts"] for s in stats),
+            "srtt": latency_summary([s["srtt"] for s in stats]),
+            "rto": latency_summary([s["rto"] for s in stats]),
+        },
+        "cpu": {
+            "clients_user": sum(output["cpu_user"] for output in outputs),
+            "clients_system": sum(output["cpu_system"] for output in outputs),
+        },
+    }
+    if server_cpu is not None:
+        used = process_cpu(server_pid)
+        if used is not None:
+            step["cpu"]["server_user"] = used[0] - server_cpu[0]
+            step["cpu"]["server_system"] = used[1] - server_cpu[1]
+            step["cpu"]["server_utilization"] = (sum(used) - sum(server_cpu)) / wall
+    return step
+
+
+def spawn_server(args, profile):
+    command = [sys.executable, SERVER_SCRIPT, args.server, str(args.port), "--log-level", "quiet"]
+    command += shlex.split(args.server_args)
+    if profile:
+        command += ["--profile", profile]
+    server = subprocess.Popen(command)
+    # give it a moment to bind, and make sure it did
+    time.sleep(args.server_startup)
+    if server.poll() is not None:
+        raise RuntimeError(f"Server exited with status {server.returncode}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the CSE 461 project 1 server")
+    parser.add_argument("server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--ramp", default="1,4,16",
+                        help="comma separated numbers of concurrent clients, one step each (default: 1,4,16)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds per step (default: 10)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="client processes (default: one per CPU)")
+    parser.add_argument("--spawn-server", action="store_true",
+                        help="start part2/server.py on server:port for the run")
+    parser.add_argument("--server-args", default="",
+                        help="extra arguments for the spawned server, e.g. \"--engine asyncio\"")
+    parser.add_argument("--profiles", default=None,
+                        help="comma separated server --profile values, the ramp runs once for each "
+                             "(needs --spawn-server for more than one)")
+    parser.add_argument("--server-startup", type=float, default=1,
+                        help="seconds to wait for the spawned server to start (default: 1)")
+    parser.add_argument("--log-level", choices=list(jsonlog.LEVELS), default="quiet",
+                        help="client log level, logs go to stdout (default: quiet)")
+    parser.add_argument("--output", default=None,
+                        help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    ramp = [int(n) for n in args.ramp.split(",")]
+    profiles = args.profiles.split(",") if args.profiles else [None]
+    if len(profiles) > 1 and not args.spawn_server:
+        parser.error("--profiles with more than one profile needs --spawn-server")
+
+    report = {
+        "server": args.server,
+        "port": args.port,
+        "server_args": args.server_args if args.spawn_server else None,
+        "processes": args.processes,
+        "cpus": os.cpu_count(),
+        "steps": [],
+    }
+    processes = min(args.processes, max(ramp))
+    with multiprocessing.Pool(processes, jsonlog.setup_logging, ("client", args.log_level)) as pool:
+        for profile in profiles:
+            server = spawn_server(args, profile) if args.spawn_server else None
+            try:
+                for concurrency in ramp:
+                    step = run_step(pool, args, concurrency, server.pid if server else None, profile)
+                    report["steps"].append(step)
+                    print(f"{profile or 'server'} profile, {concurrency} clients: "
+                          f"{step['handshakes_per_sec']:.1f} handshakes/s, "
+                          f"{step['goodput']['bytes_per_sec'] / 1e6:.2f} MB/s goodput, "
+                          f"p99 {step['latency']['total']['p99']} s, {step['failures']} failures",
+                          file=sys.stderr)
+            finally:
+                if server:
+                    server.terminate()
+                    server.wait()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
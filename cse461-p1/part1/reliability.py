@@ -0,0 +1,174 @@
+import random
+
+# Reliable delivery of the stage B packets
+#
+# The sender here does no I/O: the caller tells it when acks arrive and
+# asks it which packet ids to put on the wire and how long it may wait for
+# the next ack, so the same logic runs over any socket (or none, in tests).
+
+
+# delays to sleep between attempts at something that may not be ready yet
+# (the server's TCP listener): doubling from first up to limit, with jitter so
+# many clients don't retry in lockstep, and stopping once total is used up
+def backoff_delays(total, first=0.005, limit=0.5):
+    delay = first
+    left = total
+    while left > 0:
+        sleep = min(left, delay * random.uniform(0.5, 1))
+        yield sleep
+        left -= sleep
+        delay = min(limit, delay * 2)
+
+
+class RttEstimator:
+    # retransmission timeout from measured round trips, Jacobson/Karels
+    # style as in RFC 6298: a smoothed RTT and its mean deviation, with the
+    # RTO clamped to [min_rto, max_rto] and doubled on every timeout in a row
+    #
+    # the defaults suit a server that gives up after 3 s of silence: waiting
+    # longer than max_rto would only find the session gone
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    GRANULARITY = 0.001  # clock granularity, seconds
+
+    def __init__(self, initial_rto=1.0, min_rto=0.02, max_rto=2.0):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = initial_rto  # RTO before backoff
+        self.backoff = 0             # timeouts in a row
+        self.samples = 0
+        self.min_rtt = None
+        self.max_rtt = None
+
+    @property
+    def rto(self):
+        return min(self.max_rto, self.base_rto * (1 << self.backoff))
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        rto = self.srtt + max(self.GRANULARITY, self.K * self.rttvar)
+        self.base_rto = min(self.max_rto, max(self.min_rto, rto))
+        # a fresh sample means the path works again
+        self.backoff = 0
+
+        self.samples += 1
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.max_rtt = rtt if self.max_rtt is None else max(self.max_rtt, rtt)
+
+    def timed_out(self):
+        if self.rto < self.max_rto:
+            self.backoff += 1
+
+    # an ack that gave no sample (Karn's rule) still shows the path works,
+    # so the losses are no longer consecutive
+    def progress(self):
+        self.backoff = 0
+
+    def stats(self):
+        return {
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "rto": self.rto,
+            "rtt_samples": self.samples,
+            "rtt_min": self.min_rtt,
+            "rtt_max": self.max_rtt,
+        }
+
+
+class GoBackNSender:
+    # Go-Back-N over packet ids 0..count-1
+    #
+    # Up to window packets are in flight at once. The server only accepts the
+    # packet it expects next, so an ack for id k means every id up to k got
+    # through and acks are treated as cumulative. When nothing was acked for
+    # one RTO every packet still in flight is sent again, since the server
+    # threw away everything behind the one it missed.
+    #
+    # The RTO comes from rtt, which is fed the time from sending a packet to
+    # its ack. Following Karn's rule, packets that were sent more than once
+    # give no samples: their ack can't be matched to one of the sends.
+
+    def __init__(self, count, window=8, rtt=None):
+        self.count = count
+        self.window = window
+        self.rtt = rtt or RttEstimator()
+        self.base = 0        # oldest id not acked yet
+        self.next_id = 0     # next id to send
+        self.deadline = None # when the in-flight packets time out, None if none are
+        self.sent_at = {}    # id -> when it was sent, for ids in flight sent only once
+        self.resent = 0      # ids below this were sent more than once
+        self.sent = 0
+        self.retransmits = 0
+        self.timeouts = 0
+
+    def done(self):
+        return self.base >= self.count
+
+    # returns the ids to send now: new ones the window has room for, or
+    # everything in flight again once the retransmit timer ran out
+    def poll(self, now):
+        if self.deadline is not None and now >= self.deadline:
+            # go back: resend everything from base
+            self.timeouts += 1
+            self.retransmits += self.next_id - self.base
+            self.resent = max(self.resent, self.next_id)
+            self.sent_at.clear()
+            self.next_id = self.base
+            self.deadline = None
+            self.rtt.timed_out()
+
+        end = min(self.base + self.window, self.count)
+        ids = range(self.next_id, end)
+        if ids:
+            for id in ids:
+                if id >= self.resent:
+                    self.sent_at[id] = now
+            self.next_id = end
+            self.sent += len(ids)
+            if self.deadline is None:
+                self.deadline = now + self.rtt.rto
+        return ids
+
+    # handles an ack for ack_id, returns False for stale, duplicate or bogus ones
+    def on_ack(self, ack_id, now):
+        if ack_id < self.base or ack_id >= self.next_id:
+            return False
+        sent_at = self.sent_at.get(ack_id)
+        if sent_at is not None:
+            self.rtt.sample(now - sent_at)
+        else:
+            self.rtt.progress()
+        for id in range(self.base, ack_id + 1):
+            self.sent_at.pop(id, None)
+
+        self.base = ack_id + 1
+        # restart the timer for whatever is still in flight
+        self.deadline = now + self.rtt.rto if self.base < self.next_id else None
+        return True
+
+    # seconds until poll() has something to do, None if it never will
+    def next_timeout(self, now):
+        if self.done():
+            return None
+        if self.next_id < min(self.base + self.window, self.count):
+            return 0
+        return max(0, self.deadline - now)
+
+    def stats(self):
+        stats = {
+            "packets": self.count,
+            "sent": self.sent,
+            "retransmits": self.retransmits,
+            "timeouts": self.timeouts,
+        }
+        stats.update(self.rtt.stats())
+        return stats
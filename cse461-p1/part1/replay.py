@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import collections
+import json
+import socket
+import sys
+import time
+import async_client
+import jsonlog
+import packet_trace
+from async_client import DatagramQueue, STAGE_A_RESPONSE
+from loadgen import latency_summary
+from packet_struct import Packet
+from reliability import RttEstimator
+
+# Replays a packet trace (see packet_trace.py) against a running server
+#
+# The server picks new ports, lengths and secrets every time, so the recorded
+# packets can't simply be sent again. What is replayed is the traffic shape:
+# every recorded session starts at its recorded time (divided by --speed, or
+# as fast as --concurrency allows with --speed 0), sends its recorded hello
+# and then runs the handshake as far as the recorded one got. A session
+# passes if the server answers every stage it answered in the trace, with
+# responses that parse, and stays silent where it stayed silent:
+#
+#   python3 replay.py server.trace localhost 12235 --speed 10
+#
+# Traces recorded by the server (--trace on server.py) and by the client
+# both work.
+
+STAGES = ("a", "b", "c", "d")
+
+
+class TracedSession:
+
+    def __init__(self, start):
+        self.start = start        # when the client's first packet was sent
+        self.end = start          # when the last packet was seen
+        self.hello = None         # the client's first datagram
+        self.reached = None       # last stage the server answered, None if none
+        self.tcp = bytearray()    # the server's side of the TCP stream
+
+    def add_server_datagram(self, data):
+        header, payload = Packet.parse(data)
+        # acks are 4 bytes, the stage A and B responses longer
+        if header[0] == STAGE_A_RESPONSE.size:
+            self.reached = self.reached or "a"
+        elif header[0] == async_client.STAGE_B_RESPONSE.size:
+            self.reached = "b"
+
+    # the stage C and D responses are the first and second packet on TCP
+    def finish(self):
+        offset = packets = 0
+        while offset + Packet.HEADER_SIZE <= len(self.tcp):
+            offset += Packet.padded_size(Packet.HEADER_STRUCT.unpack_from(self.tcp, offset)[0])
+            if offset <= len(self.tcp):
+                packets += 1
+        if packets:
+            self.reached = "d" if packets > 1 else "c"
+        self.tcp = None
+
+
+# reads the sessions of a trace, sorted by start time
+def load(path):
+    sessions = {}
+    for role, start, record in packet_trace.read(path):
+        if not record.session:
+            continue
+        at = start + record.time
+        key = (start, record.session)
+        session = sessions.get(key)
+        if session is None:
+            session = sessions[key] = TracedSession(at)
+        session.end = max(session.end, at)
+
+        # what the client sent is what its recorder received on the server
+        from_client = (record.dir == packet_trace.RECV) == (role == packet_trace.SERVER)
+        if from_client:
+            if session.hello is None and record.kind == packet_trace.UDP:
+                session.hello = record.data
+                session.start = at
+        elif record.kind == packet_trace.UDP:
+            if len(record.data) >= Packet.HEADER_SIZE:
+                session.add_server_datagram(record.data)
+        else:
+            session.tcp += record.data
+
+    result = []
+    for session in sessions.values():
+        session.finish()
+        if session.hello is not None:
+            result.append(session)
+    result.sort(key=lambda session: session.start)
+    return result
+
+
+# replays one session, returns None if the server behaved as recorded or
+# the reason it didn't
+async def replay_session(address, port, session, silence):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        DatagramQueue, local_addr=("0.0.0.0", 0), family=socket.AF_INET
+    )
+    writer = None
+    stage = "a"
+    try:
+        rtt = RttEstimator()
+        sent_at = time.monotonic()
+        transport.sendto(session.hello, (address, port))
+        if session.reached is None:
+            # the recorded hello got no answer, the replayed one shouldn't either
+            try:
+                await protocol.recv(silence)
+                return "unexpected_response"
+            except socket.timeout:
+                return None
+
+        payload = await protocol.recv(async_client.TIMEOUT)
+        rtt.sample(time.monotonic() - sent_at)
+        if len(payload) < STAGE_A_RESPONSE.size:
+            raise ValueError("Stage A response too short")
+        num, length, udp_port, secretA = STAGE_A_RESPONSE.unpack_from(payload)
+        if session.reached == "a":
+            return None
+
+        stage = "b"
+        tcp_port, secretB, _ = await async_client.stage_b(
+            transport, protocol, (address, udp_port), num, length, secretA, rtt
+        )
+        transport.close()
+        if session.reached == "b":
+            return None
+
+        stage = "c"
+        reader, writer = await async_client.connect(address, tcp_port)
+        num2, len2, secretC, c = await async_client.stage_c(reader)
+        if session.reached == "c":
+            return None
+
+        stage = "d"
+        await async_client.stage_d(reader, writer, num2, len2, secretC, c)
+        return None
+    except (socket.timeout, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return f"timeout_{stage}"
+    except ValueError:
+        return f"bad_response_{stage}"
+    except OSError as e:
+        return f"{type(e).__name__}_{stage}"
+    finally:
+        transport.close()
+        if writer is not None:
+            writer.close()
+
+
+async def replay(sessions, host, port, speed, concurrency, silence):
+    loop = asyncio.get_running_loop()
+    info = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    address = info[0][4][0]
+
+    limit = asyncio.Semaphore(concurrency)
+    results = []
+    first = sessions[0].start
+    begin = time.monotonic()
+
+    async def one(session):
+        # when the session is due, relative to the start of the replay
+        due = (session.start - first) / speed if speed else 0
+        delay = begin + due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with limit:
+            started = time.monotonic()
+            reason = await replay_session(address, port, session, silence)
+            results.append({
+                "reason": reason,
+                "lag": started - begin - due,
+                "latency": time.monotonic() - started,
+                "recorded": session.end - session.start,
+                "reached": session.reached,
+            })
+
+    await asyncio.gather(*(one(session) for session in sessions))
+    return results, time.monotonic() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a CSE 461 project 1 packet trace against a server")
+    parser.add_argument("trace")
+    parser.add_argument("server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--speed", type=float, default=1,
+                        help="replay N times faster than recorded, 0 for as fast as possible (default: 1)")
+    parser.add_argument("--concurrency", type=int, default=1000,
+                        help="sessions replayed at once at most (default: 1000)")
+    parser.add_argument("--silence", type=float, default=1,
+                        help="seconds to wait for a response that should not come (default: 1)")
+    parser.add_argument("--log-level", choices=list(jsonlog.LEVELS), default="quiet",
+                        help="client log level, logs go to stdout (default: quiet)")
+    parser.add_argument("--output", default=None,
+                        help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    jsonlog.setup_logging("client", args.log_level)
+    async_client.raise_fd_limit()
+    sessions = load(args.trace)
+    if not sessions:
+        parser.error(f"no sessions in {args.trace}")
+
+    results, elapsed = asyncio.run(
+        replay(sessions, args.server, args.port, args.speed, args.concurrency, args.silence)
+    )
+
+    failures = collections.Counter(result["reason"] for result in results if result["reason"])
+    recorded = sessions[-1].start - sessions[0].start
+    report = {
+        "trace": args.trace,
+        "speed": args.speed,
+        "sessions": len(results),
+        "passed": len(results) - sum(failures.values()),
+        "failures": dict(failures),
+        "reached": dict(collections.Counter(str(session.reached) for session in sessions)),
+        "recorded_duration": recorded,
+        "replay_duration": elapsed,
+        "sessions_per_sec": len(results) / elapsed if elapsed else 0,
+        # how far behind schedule sessions started, the replayer can't keep
+        # up with --speed when this grows
+        "lag": latency_summary([result["lag"] for result in results]),
+        "latency": latency_summary([result["latency"] for result in results]),
+        "recorded_latency": latency_summary([result["recorded"] for result in results]),
+    }
+    print(f"{report['passed']}/{len(results)} sessions passed in {elapsed:.2f} s "
+          f"({report['sessions_per_sec']:.1f}/s), failures: {report['failures']}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
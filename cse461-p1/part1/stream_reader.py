@@ -0,0 +1,79 @@
+from packet_struct import Packet
+
+
+class PacketStreamReader:
+    # reads framed packets (header + padded payload) from a stream socket
+    #
+    # data is received with recv_into in large chunks into one buffer: the
+    # unread bytes sit between start and end, and when a packet would run past
+    # the end of the buffer the unread bytes wrap back to the front
+    # payload memoryviews handed out are only valid until the next read
+
+    def __init__(self, sock, size=65536, max_packet=1 << 24):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unread byte
+        self.end = 0    # one past the last received byte
+        # refuse headers that claim more than this, instead of buffering them
+        self.max_packet = max_packet
+
+    # makes sure at least needed unread bytes are in the buffer
+    def fill(self, needed):
+        if self.start + needed > len(self.buf):
+            self.make_room(needed)
+
+        while self.end - self.start < needed:
+            nbytes = self.sock.recv_into(self.view[self.end:])
+            if not nbytes:
+                raise ConnectionError("Socket closed prematurely")
+            self.end += nbytes
+
+    def make_room(self, needed):
+        unread = self.end - self.start
+        if needed > len(self.buf):
+            # a packet bigger than the buffer, grow it to fit
+            buf = bytearray(max(needed, 2 * len(self.buf)))
+            buf[:unread] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+        else:
+            self.view[:unread] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = unread
+
+    # returns the next packet's header tuple without consuming anything
+    def peek_header(self):
+        self.fill(Packet.HEADER_SIZE)
+        return Packet.HEADER_STRUCT.unpack_from(self.buf, self.start)
+
+    # consumes the next packet and returns (offset, size) of it in self.buf
+    def read_frame(self):
+        payload_len = self.peek_header()[0]
+        size = Packet.padded_size(payload_len)
+        if size > self.max_packet:
+            raise ValueError(f"Packet of {size} bytes is too large")
+
+        self.fill(size)
+        offset = self.start
+        self.start += size
+        if self.start == self.end:
+            # nothing left unread, start over at the front for free
+            self.start = self.end = 0
+        return offset, size
+
+    # consumes as many whole frames of size bytes as are buffered, at least one
+    # and at most max_count, returns (offset, count) of them in self.buf
+    def read_frames(self, size, max_count):
+        self.fill(size)
+        count = min(max_count, (self.end - self.start) // size)
+        offset = self.start
+        self.start += count * size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return offset, count
+
+    # consumes the next packet and returns (header tuple, payload memoryview)
+    def read_packet(self):
+        offset, _ = self.read_frame()
+        return Packet.parse(self.buf, offset)
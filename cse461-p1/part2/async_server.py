@@ -0,0 +1,435 @@
+import asyncio
+import logging
+import resource
+import time
+import listeners
+import server
+from packet_struct import Packet
+from port_pool import PortPool, SharedStageB, StageBSession
+from timing_wheel import IdleTimer
+from server import (
+    TIMEOUT, PACKET_ID, SESSIONS, STAGE_SECONDS, FAILURES,
+    check_stage_a, send_stage_a_response, check_stage_b_packet, should_ack, encode_ack,
+    make_stage_b_response, make_stage_c_response, make_stage_d_response,
+    StageDValidator, random_port, random_secret, stage_d_batch_bytes,
+)
+
+# asyncio engine for the server: every client runs as a task on one event loop
+# instead of a thread, so idle clients only cost a few sockets and some memory
+# every timeout is a timer on server.TIMERS, which the loop advances each tick
+
+log = logging.getLogger("server")
+
+# tasks are only weakly referenced by the loop, keep them alive here
+sessions = set()
+
+
+class StageAProtocol(asyncio.DatagramProtocol):
+    # receives hello world datagrams on the main port and starts a session for each
+
+    def __init__(self, host):
+        self.host = host
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if not check_stage_a(data, addr):
+            return
+
+        if server.COOKIES is not None:
+            # stateless: no task until the first valid stage B packet
+            num, length, udp_port, secretA = server.COOKIES.issue(addr)
+            send_stage_a_response(self.transport, addr, num, length, udp_port, secretA)
+            return
+        start_task(run_session(self.host, addr, self.transport))
+
+
+def start_task(coro):
+    task = asyncio.ensure_future(coro)
+    sessions.add(task)
+    task.add_done_callback(sessions.discard)
+
+
+# SharedStageB.start_session with --stateless
+def start_stateless_session(udp_port, session):
+    done = asyncio.get_running_loop().create_future()
+    session.on_done = done.set_result
+    log.info("Stage B session from a cookie on shared UDP port %d (%d sessions)",
+             udp_port, len(server.STAGE_B_PORTS.sessions), extra={"session": session.addr})
+    start_task(run_stateless_session(server.HOST, udp_port, session, done))
+
+
+class SharedStageBProtocol(asyncio.DatagramProtocol):
+    # feeds one shared stage B socket into the SharedStageB session table
+
+    def __init__(self, shared, port):
+        self.shared = shared
+        self.port = port
+        self.ack = bytearray(Packet.padded_size(PACKET_ID.size))
+
+    def connection_made(self, transport):
+        # acks and responses go out through the transport from now on
+        self.shared.senders[self.port] = transport
+
+    def datagram_received(self, data, client):
+        ack, finished = self.shared.handle_datagram(self.port, memoryview(data), client, self.ack)
+        if ack is not None:
+            self.shared.sendto(self.port, ack, client)
+        if finished is not None:
+            self.shared.finish(self.port, finished)
+
+
+class StageBProtocol(asyncio.DatagramProtocol):
+    # receives the num stage B packets of one client on its own port
+    # done is resolved with True once every packet was acked,
+    # or False if no packet arrived for TIMEOUT seconds
+
+    def __init__(self, addr, num, length, secretA, done):
+        self.addr = addr
+        self.num = num
+        self.length = length
+        self.secretA = secretA
+        self.done = done
+
+        self.received = 0
+        self.ack = bytearray(Packet.padded_size(PACKET_ID.size))
+        self.expected_content = bytes(length)
+        self.idle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.idle = IdleTimer(server.TIMERS, TIMEOUT, self.expire)
+
+    def connection_lost(self, exc):
+        self.idle.cancel()
+        if not self.done.done():
+            self.done.set_result(False)
+
+    def expire(self):
+        log.warning("Timeout in Stage B. Only received %d/%d packets.", self.received, self.num,
+                    extra={"session": self.addr})
+        FAILURES.inc("b", "timeout")
+        if not self.done.done():
+            self.done.set_result(False)
+
+    def datagram_received(self, data, client):
+        if self.done.done():
+            return
+        self.idle.touch()
+
+        packet_id = check_stage_b_packet(
+            self.addr, memoryview(data), self.length, self.received, self.expected_content, self.secretA
+        )
+        if packet_id is None:
+            return
+
+        if should_ack(self.received, self.num):
+            self.transport.sendto(encode_ack(self.ack, self.secretA, packet_id), client)
+            self.received += 1
+            log.debug("Acknowledged packet %d, %d/%d received", packet_id, self.received, self.num,
+                      extra={"session": self.addr})
+
+            if self.received == self.num:
+                self.done.set_result(True)
+
+
+async def run_session(host, addr, udp_sock):
+    loop = asyncio.get_running_loop()
+    (num, length), secretA = server.PROFILE.stage_b(), random_secret()
+    stage_b_ports = server.STAGE_B_PORTS
+
+    # stage B, ready to receive before the client learns the port
+    done = loop.create_future()
+    transport = None
+    if isinstance(stage_b_ports, SharedStageB):
+        udp_port = stage_b_ports.allocate_port()
+        session = StageBSession(addr, num, length, secretA, done.set_result)
+        stage_b_ports.register(udp_port, session)
+        sendto = lambda data, dest: stage_b_ports.sendto(udp_port, data, dest)
+    else:
+        udp_port = None
+        try:
+            if isinstance(stage_b_ports, PortPool):
+                udp_port = stage_b_ports.acquire()
+                endpoint = {"sock": stage_b_ports.socket(udp_port)}
+            else:
+                udp_port = random_port()
+                endpoint = {"local_addr": (host, udp_port)}
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: StageBProtocol(addr, num, length, secretA, done), **endpoint
+            )
+        except OSError as e:
+            log.warning("Could not start Stage B: %s", e, extra={"session": addr})
+            if isinstance(stage_b_ports, PortPool):
+                stage_b_ports.release(udp_port)
+            return
+        sendto = transport.sendto
+    log.info("Listening on UDP port %d for Stage B", udp_port, extra={"session": addr})
+
+    listening = None
+    try:
+        # transports have the same sendto(data, addr) as a socket
+        send_stage_a_response(udp_sock, addr, num, length, udp_port, secretA)
+        start_time = time.monotonic()
+        if not await done:
+            return
+        STAGE_SECONDS.observe(time.monotonic() - start_time, "b")
+        listening = await send_stage_b_response(host, addr, num, secretA, sendto)
+    finally:
+        if transport is not None:
+            transport.close()
+        if isinstance(stage_b_ports, PortPool):
+            stage_b_ports.release(udp_port)
+        elif isinstance(stage_b_ports, SharedStageB):
+            stage_b_ports.unregister(udp_port, session)
+
+    if listening:
+        await run_tcp_stages(addr, *listening)
+
+
+# the rest of the handshake of a client whose first valid stage B packet came
+# in with a cookie, the session stays with the shared sockets until it goes quiet
+async def run_stateless_session(host, udp_port, session, done):
+    start_time = time.monotonic()
+    if not await done:
+        return
+    STAGE_SECONDS.observe(time.monotonic() - start_time, "b")
+    sendto = lambda data, dest: server.STAGE_B_PORTS.sendto(udp_port, data, dest)
+    listening = await send_stage_b_response(host, session.addr, session.num, session.secretA, sendto)
+    if listening:
+        await run_tcp_stages(session.addr, *listening)
+
+
+# listens on a new TCP port (or expects the client on a shared listener) and
+# sends it in the stage B response
+# returns (tcp_server, accepted, tcp_port, secretB), or None if it can't listen
+async def send_stage_b_response(host, addr, num, secretA, sendto):
+    accepted = asyncio.get_running_loop().create_future()
+    if server.LISTENERS is not None:
+        tcp_server = None
+        tcp_port = server.LISTENERS.expect(addr, lambda conn: on_shared_accept(accepted, conn))
+    else:
+        # listen before sending the port so the client can connect right away
+        tcp_port = random_port()
+        try:
+            tcp_server = await asyncio.start_server(
+                lambda reader, writer: on_accept(accepted, reader, writer),
+                host, tcp_port, backlog=1, reuse_address=True,
+            )
+        except OSError as e:
+            log.warning("Could not bind TCP port %d: %s", tcp_port, e, extra={"session": addr})
+            return None
+
+    secretB, response = make_stage_b_response(secretA, tcp_port)
+    log.info("Stage B complete: received all %d packets.", num, extra={"session": addr})
+    log.info("Sending Stage B response: tcp_port=%d, secretB=%d", tcp_port, secretB, extra={"session": addr})
+    sendto(response, addr)
+    return tcp_server, accepted, tcp_port, secretB
+
+
+async def run_tcp_stages(addr, tcp_server, accepted, tcp_port, secretB):
+    # wait for the client to connect
+    timer = server.TIMERS.schedule(TIMEOUT, expire_accept, accepted)
+    start_time = time.monotonic()
+    try:
+        reader, writer = await accepted
+        STAGE_SECONDS.observe(time.monotonic() - start_time, "accept")
+    except asyncio.TimeoutError:
+        log.warning("Timeout waiting for TCP connection on port %d", tcp_port, extra={"session": addr})
+        FAILURES.inc("accept", "timeout")
+        return
+    finally:
+        server.TIMERS.cancel(timer)
+        if tcp_server is not None:
+            tcp_server.close()
+
+    try:
+        await handle_stages_cd(reader, writer, secretB)
+    finally:
+        writer.close()
+
+
+def expire_accept(accepted):
+    if not accepted.done():
+        accepted.set_exception(asyncio.TimeoutError())
+
+
+def on_accept(accepted, reader, writer):
+    # only the first connection belongs to the session
+    if accepted.done():
+        writer.close()
+    else:
+        accepted.set_result((reader, writer))
+
+
+# on_connect of a session waiting on a shared listener
+def on_shared_accept(accepted, conn):
+    if conn is None:
+        expire_accept(accepted)
+    elif accepted.done():
+        conn[1].close()
+    else:
+        accepted.set_result(conn)
+
+
+# a connection on shared listener port, handed to the session expecting it
+def on_shared_connection(port, reader, writer):
+    peer = writer.get_extra_info("peername")
+    if not server.LISTENERS.deliver(port, peer, (reader, writer)):
+        log.debug("Closing connection on TCP port %d: no session expects it", port, extra={"session": peer})
+        writer.close()
+
+
+class StageDProtocol(asyncio.BufferedProtocol):
+    # takes over a connection's transport for stage D: the transport receives
+    # straight into one preallocated buffer of whole packets, which are checked
+    # in place as they arrive, so no bytes object is made per batch
+    # done is resolved with True once num2 packets were valid, False on a bad
+    # one, or a ConnectionError if the connection ends first
+
+    def __init__(self, transport, validator, num2, idle, done):
+        self.transport = transport
+        self.validator = validator
+        self.num2 = num2
+        self.idle = idle
+        self.done = done
+
+        batch = stage_d_batch_bytes(validator.len2) // validator.frame
+        self.buf = bytearray(batch * validator.frame)
+        self.view = memoryview(self.buf)
+        self.end = 0  # bytes received into buf and not checked yet
+
+    def get_buffer(self, sizehint):
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        if self.done.done():
+            return
+        self.idle.touch()
+        self.end += nbytes
+
+        frame = self.validator.frame
+        count = min(self.end // frame, self.num2 - self.validator.checked)
+        if count == 0:
+            return
+        if not self.validator.check(self.buf, 0, count):
+            self.finish(False)
+            return
+        if self.validator.checked == self.num2:
+            self.finish(True)
+            return
+
+        # only the start of the next packet is left, move it to the front
+        used = count * frame
+        self.view[:self.end - used] = self.view[used:self.end]
+        self.end -= used
+
+    def finish(self, result):
+        self.transport.pause_reading()
+        self.done.set_result(result)
+
+    def eof_received(self):
+        if not self.done.done():
+            self.done.set_exception(ConnectionError("Connection closed by client"))
+
+    def connection_lost(self, exc):
+        if not self.done.done():
+            self.done.set_exception(exc or ConnectionError("Connection closed"))
+
+
+async def handle_stages_cd(reader, writer, secretB):
+    # stage C
+    start_time = time.monotonic()
+    response, num2, len2, secretC, c = make_stage_c_response(secretB)
+
+    # stage D, received into one buffer and checked in place
+    # the client only starts stage D once it has the stage C response, so
+    # nothing is left in reader when its transport moves to StageDProtocol
+    validator = StageDValidator(len2, secretC, c, stage_d_batch_bytes(len2))
+    done = asyncio.get_running_loop().create_future()
+    # a quiet client gets its connection aborted, which fails done
+    timed_out = []
+    idle = IdleTimer(server.TIMERS, TIMEOUT, abort_stage_d, writer, timed_out)
+    writer.transport.set_protocol(StageDProtocol(writer.transport, validator, num2, idle, done))
+
+    writer.write(response)
+    STAGE_SECONDS.observe(time.monotonic() - start_time, "c")
+    start_time = time.monotonic()
+
+    try:
+        if not await done:
+            return
+
+        # writer.drain() waits on reader's protocol, which has no say any
+        # more, the transport still sends everything before closing
+        secretD, response = make_stage_d_response(secretC)
+        writer.write(response)
+        STAGE_SECONDS.observe(time.monotonic() - start_time, "d")
+        SESSIONS.inc("completed")
+        log.info("Stage D complete. Sent secretD: %d", secretD)
+    except ConnectionError as e:
+        if timed_out:
+            log.warning("Timeout in Stage D after %d/%d packets", validator.checked, num2)
+            FAILURES.inc("d", "timeout")
+        else:
+            log.warning("Error in Stage D: %s", e)
+            FAILURES.inc("d", "error")
+    finally:
+        idle.cancel()
+
+
+def abort_stage_d(writer, timed_out):
+    timed_out.append(True)
+    writer.transport.abort()
+
+
+def drive_timers(loop, wheel):
+    # advances the timing wheel once per tick on the event loop
+    def tick():
+        wheel.advance()
+        loop.call_later(wheel.tick, tick)
+
+    loop.call_later(wheel.tick, tick)
+
+
+def raise_fd_limit():
+    # every in-flight client holds a socket, so allow as many as the system lets us
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def serve(host, port):
+    loop = asyncio.get_running_loop()
+    drive_timers(loop, server.TIMERS)
+    stage_b_ports = server.STAGE_B_PORTS
+    if isinstance(stage_b_ports, SharedStageB):
+        stage_b_ports.start_session = start_stateless_session
+        for shared_port, sock in stage_b_ports.socks.items():
+            await loop.create_datagram_endpoint(
+                lambda shared_port=shared_port: SharedStageBProtocol(stage_b_ports, shared_port), sock=sock
+            )
+
+    if server.LISTENERS is not None:
+        for tcp_port, sock in server.LISTENERS.socks.items():
+            await asyncio.start_server(
+                lambda reader, writer, tcp_port=tcp_port: on_shared_connection(tcp_port, reader, writer),
+                sock=sock, backlog=listeners.BACKLOG,
+            )
+
+    await loop.create_datagram_endpoint(
+        lambda: StageAProtocol(host), local_addr=(host, port), reuse_port=server.REUSE_PORT or None
+    )
+    log.info("Listening on UDP port %d (asyncio)", port)
+
+    # run until interrupted
+    await loop.create_future()
+
+
+def run(host, port):
+    raise_fd_limit()
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,213 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import time
+
+# Receiving and sending datagrams in batches
+#
+# receive(timeout) waits until at least one datagram is there and returns it
+# together with whatever else is already queued, up to count of them, as
+# [(memoryview, address)]; the views are only good until the next receive.
+# send(replies) sends [(data, address)] in as few calls as it can.
+#
+#   DatagramReceiver  one recvfrom_into and one sendto per datagram
+#   DrainReceiver     waits for one datagram, then reads on without blocking
+#                     until the socket is empty
+#   MmsgReceiver      one recvmmsg for the whole batch and one sendmmsg for
+#                     the replies, through ctypes (Linux, real sockets only)
+
+# most datagrams taken in one batch, and most bytes of buffer for them
+BATCH = 64
+BATCH_BYTES = 1 << 20
+
+
+# a receiver for sock's datagrams of up to size bytes, batched if drain
+def open_receiver(sock, size, drain):
+    if not drain:
+        return DatagramReceiver(sock, size)
+    count = max(1, min(BATCH, BATCH_BYTES // size))
+    if LIBC is not None and type(sock) is socket.socket and sock.family == socket.AF_INET:
+        return MmsgReceiver(sock, size, count)
+    return DrainReceiver(sock, size, count)
+
+
+class DatagramReceiver:
+
+    def __init__(self, sock, size, count=1):
+        self.sock = sock
+        self.size = size
+        self.count = count
+        self.buf = bytearray(size * count)
+        self.view = memoryview(self.buf)
+        self.timeout = -1  # what the socket's timeout was last set to
+
+    def settimeout(self, timeout):
+        if timeout != self.timeout:
+            self.sock.settimeout(timeout)
+            self.timeout = timeout
+
+    def receive(self, timeout):
+        self.settimeout(timeout)
+        nbytes, addr = self.sock.recvfrom_into(self.view[:self.size])
+        return [(self.view[:nbytes], addr)]
+
+    def send(self, replies):
+        for data, addr in replies:
+            self.sock.sendto(data, addr)
+
+
+class DrainReceiver(DatagramReceiver):
+    # works on anything with the socket API, including the transport.py backends
+
+    def receive(self, timeout):
+        datagrams = super().receive(timeout)
+        self.settimeout(0)
+        try:
+            for i in range(1, self.count):
+                slot = self.view[i * self.size:(i + 1) * self.size]
+                nbytes, addr = self.sock.recvfrom_into(slot)
+                datagrams.append((slot[:nbytes], addr))
+        except (BlockingIOError, socket.timeout):
+            # nothing more queued
+            pass
+        finally:
+            self.settimeout(timeout)
+        return datagrams
+
+
+class Iovec(ctypes.Structure):
+    _fields_ = [("base", ctypes.c_void_p), ("len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("name", ctypes.c_void_p),
+        ("namelen", ctypes.c_uint32),
+        ("iov", ctypes.POINTER(Iovec)),
+        ("iovlen", ctypes.c_size_t),
+        ("control", ctypes.c_void_p),
+        ("controllen", ctypes.c_size_t),
+        ("flags", ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("hdr", MsgHdr), ("len", ctypes.c_uint)]
+
+
+MSG_DONTWAIT = 0x40
+# struct sockaddr_in: family (host order), port, address, 8 bytes of zeros
+SOCKADDR_IN = struct.Struct('=H')
+SOCKADDR_IN_ADDR = struct.Struct('!H4s')
+SOCKADDR_SIZE = 16
+# replies longer than this are sent on their own
+REPLY_SIZE = 64
+
+
+def load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return libc
+
+
+LIBC = load_libc()
+
+
+# count message headers, each with one iovec of size bytes from buf and an
+# address slot in names
+def message_array(buf, size, names, count):
+    base = ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+    iovecs = (Iovec * count)()
+    msgs = (MMsgHdr * count)()
+    for i in range(count):
+        iovecs[i].base = base + i * size
+        iovecs[i].len = size
+        msgs[i].hdr.iov = ctypes.pointer(iovecs[i])
+        msgs[i].hdr.iovlen = 1
+        msgs[i].hdr.name = ctypes.addressof(names) + i * SOCKADDR_SIZE
+        msgs[i].hdr.namelen = SOCKADDR_SIZE
+    return iovecs, msgs
+
+
+class MmsgReceiver(DatagramReceiver):
+
+    def __init__(self, sock, size, count):
+        super().__init__(sock, size, count)
+        self.fd = sock.fileno()
+        self.names = ctypes.create_string_buffer(SOCKADDR_SIZE * count)
+        self.iovecs, self.msgs = message_array(self.buf, size, self.names, count)
+        self.used = 0  # headers the last recvmmsg filled in
+        self.poll = select.poll()
+        self.poll.register(self.fd, select.POLLIN)
+
+        self.replies = bytearray(REPLY_SIZE * count)
+        self.reply_names = ctypes.create_string_buffer(SOCKADDR_SIZE * count)
+        self.reply_iovecs, self.reply_msgs = message_array(self.replies, REPLY_SIZE, self.reply_names, count)
+        self.addresses = {}  # ip string -> packed, for the replies
+
+    def receive(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # recvmmsg overwrote the address lengths of the ones it filled in
+            for i in range(self.used):
+                self.msgs[i].hdr.namelen = SOCKADDR_SIZE
+            n = LIBC.recvmmsg(self.fd, self.msgs, self.count, MSG_DONTWAIT, None)
+            if n > 0:
+                break
+            self.used = 0
+            err = ctypes.get_errno()
+            if n < 0 and err not in (errno.EAGAIN, errno.EINTR):
+                raise OSError(err, os.strerror(err))
+
+            # nothing queued: wait for the next datagram
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                raise socket.timeout("timed out")
+            if not self.poll.poll(None if wait is None else wait * 1000):
+                raise socket.timeout("timed out")
+
+        self.used = n
+        datagrams = []
+        for i in range(n):
+            port, ip = SOCKADDR_IN_ADDR.unpack_from(self.names, i * SOCKADDR_SIZE + 2)
+            start = i * self.size
+            datagrams.append((self.view[start:start + self.msgs[i].len], (socket.inet_ntoa(ip), port)))
+        return datagrams
+
+    def send(self, replies):
+        start = 0
+        while start < len(replies):
+            n = 0
+            for data, (host, port) in replies[start:start + self.count]:
+                if len(data) > REPLY_SIZE:
+                    break
+                offset = n * REPLY_SIZE
+                self.replies[offset:offset + len(data)] = data
+                self.reply_iovecs[n].len = len(data)
+                packed = self.addresses.get(host)
+                if packed is None:
+                    packed = self.addresses[host] = socket.inet_aton(host)
+                SOCKADDR_IN.pack_into(self.reply_names, n * SOCKADDR_SIZE, socket.AF_INET)
+                SOCKADDR_IN_ADDR.pack_into(self.reply_names, n * SOCKADDR_SIZE + 2, port, packed)
+                n += 1
+
+            sent = LIBC.sendmmsg(self.fd, self.reply_msgs, n, MSG_DONTWAIT) if n else 0
+            if sent <= 0:
+                # a long reply, or the send buffer is full: one the slow way
+                sent = 1
+                self.sock.sendto(*replies[start])
+            start += sent
@@ -0,0 +1,67 @@
+import hmac
+import os
+import struct
+import time
+
+# Stateless stage A, like TCP SYN cookies
+#
+# Instead of picking random stage B parameters and remembering them, the
+# server derives them from a keyed MAC of the client's address and the
+# current epoch:
+#
+#   mac = HMAC-SHA256(key, client address | epoch)
+#   secretA, num, len and the shared stage B port are taken from mac
+#
+# so answering a hello keeps nothing. When a stage B packet comes from an
+# address without a session, the MAC is computed again, and if psecret is the
+# secretA it gives and the packet is a valid packet 0, the session is created
+# then. The lowest bit of secretA is the epoch's, so a check needs a single
+# MAC: a cookie is good in the epoch it was issued in and the next one, so
+# for EPOCH to 2 * EPOCH seconds. The key is random per server process.
+
+EPOCH = 30  # seconds
+# secretA stays in random_secret's range, 1000-99999: the low bit is the
+# epoch's and the rest one of SECRET_VALUES values
+SECRET_LOW = 1000
+SECRET_VALUES = 49500
+WORDS = struct.Struct('!IIII')
+
+
+class CookieJar:
+
+    def __init__(self, profile, ports, key=None, epoch=EPOCH):
+        self.profile = profile  # stage B sizes, see profiles.py
+        self.ports = ports      # the shared stage B ports
+        self.key = key or os.urandom(32)
+        self.epoch = epoch
+
+    def current_epoch(self):
+        return int(time.time() // self.epoch)
+
+    # the stage A response for addr in epoch: (num, length, udp_port, secretA)
+    def derive(self, addr, epoch):
+        mac = hmac.digest(self.key, f"{addr!r}|{epoch}".encode(), "sha256")
+        secret, num, length, port = WORDS.unpack_from(mac)
+        low, high = self.profile.num
+        num = low + num % (high - low + 1)
+        low, high = self.profile.length
+        length = low + length % (high - low + 1)
+        secretA = SECRET_LOW + 2 * (secret % SECRET_VALUES) + (epoch & 1)
+        return num, length, self.ports[port % len(self.ports)], secretA
+
+    def issue(self, addr):
+        return self.derive(addr, self.current_epoch())
+
+    # the stage A response addr got with secretA psecret, None if psecret was
+    # not issued to addr or has expired
+    def check(self, addr, psecret):
+        if not SECRET_LOW <= psecret < SECRET_LOW + 2 * SECRET_VALUES:
+            return None
+        epoch = self.current_epoch()
+        if (epoch ^ psecret) & 1:
+            # issued in the previous epoch
+            epoch -= 1
+        response = self.derive(addr, epoch)
+        if response[3] != psecret:
+            return None
+        return response
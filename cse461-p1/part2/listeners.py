@@ -0,0 +1,142 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+import server
+
+log = logging.getLogger("server")
+
+# Shared TCP listeners for stages C and D (--tcp shared)
+#
+# Instead of binding, listening on and closing a new port for every client,
+# the server keeps a few listeners open for good. The Stage B response names
+# one of them, and from then on the listener expects a connection from the
+# client's address for TIMEOUT seconds. A connection is handed to the oldest
+# session expecting one from its host on that listener; everything else is
+# closed. The connections of two sessions from the same host are told apart
+# by their order only, so sessions from one host go to different listeners
+# as long as there are enough of them.
+
+# pending connections per listener, beyond that the kernel refuses them
+BACKLOG = 1024
+
+
+# what identifies a client across its UDP and TCP sockets: its address without
+# the port (None for Unix domain sockets, which have no host)
+def host_of(addr):
+    return addr[0] if isinstance(addr, tuple) else None
+
+
+class PendingConnection:
+    # a session waiting for its client to connect
+
+    def __init__(self, host, on_connect):
+        self.host = host
+        # called once, with the connection or None if none came in time
+        self.on_connect = on_connect
+        self.since = time.monotonic()
+        self.timer = None
+
+
+class AcceptedConnection:
+    # on_connect for a thread that waits for its connection
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.conn = None
+
+    def set(self, conn):
+        self.conn = conn
+        self.ready.set()
+
+    # the connection, or None if the client didn't connect in time
+    def wait(self):
+        self.ready.wait()
+        return self.conn
+
+
+class SharedListeners:
+
+    def __init__(self, host, count, timers):
+        self.timers = timers
+        self.socks = {}
+        for _ in range(count):
+            # port 0 lets the kernel pick a port that is guaranteed to be free
+            sock = server.TRANSPORT.listen((host, 0), BACKLOG)
+            self.socks[sock.getsockname()[1]] = sock
+        self.ports = list(self.socks)
+        self.next_port = itertools.count()
+
+        # (listener port, client host) -> PendingConnections, oldest first
+        self.pending = {}
+        self.per_port = dict.fromkeys(self.ports, 0)
+        self.lock = threading.Lock()
+
+    # picks a listener for addr's connection and expects it there from now
+    # on, returns the listener's port
+    def expect(self, addr, on_connect):
+        pending = PendingConnection(host_of(addr), on_connect)
+        with self.lock:
+            # the listener with the fewest sessions of this host waiting, then
+            # the least busy, then round robin
+            start = next(self.next_port)
+            order = self.ports[start % len(self.ports):] + self.ports[:start % len(self.ports)]
+            port = min(order, key=lambda port: (len(self.pending.get((port, pending.host), ())), self.per_port[port]))
+            self.pending.setdefault((port, pending.host), collections.deque()).append(pending)
+            self.per_port[port] += 1
+            pending.timer = self.timers.schedule(server.TIMEOUT, self.expire, port, pending)
+        return port
+
+    # hands a connection accepted on port from peer to its session, returns
+    # False if no session was expecting it
+    def deliver(self, port, peer, conn):
+        key = (port, host_of(peer))
+        with self.lock:
+            waiting = self.pending.get(key)
+            if not waiting:
+                return False
+            pending = waiting.popleft()
+            if not waiting:
+                del self.pending[key]
+            self.per_port[port] -= 1
+        self.timers.cancel(pending.timer)
+        pending.on_connect(conn)
+        return True
+
+    def expire(self, port, pending):
+        key = (port, pending.host)
+        with self.lock:
+            waiting = self.pending.get(key)
+            if not waiting or pending not in waiting:
+                return
+            waiting.remove(pending)
+            if not waiting:
+                del self.pending[key]
+            self.per_port[port] -= 1
+        pending.on_connect(None)
+
+    # starts one accept thread per listener
+    def start_threads(self):
+        for port, sock in self.socks.items():
+            thread = threading.Thread(target=self.accept_loop, args=(port, sock), daemon=True)
+            thread.start()
+
+    def accept_loop(self, port, sock):
+        while True:
+            try:
+                conn, peer = sock.accept()
+            except OSError as e:
+                log.warning("Accept failed on TCP port %d: %s", port, e)
+                continue
+            if not self.deliver(port, peer, conn):
+                log.debug("Closing connection on TCP port %d: no session expects it", port, extra={"session": peer})
+                conn.close()
+
+    def occupancy(self):
+        with self.lock:
+            return {
+                "waiting": sum(self.per_port.values()),
+                "listeners": len(self.ports),
+                "per_port": dict(self.per_port),
+            }
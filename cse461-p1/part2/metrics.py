@@ -0,0 +1,311 @@
+import atexit
+import http.server
+import os
+import threading
+import time
+
+# Counters and latency histograms for the server, rendered in the Prometheus
+# text format
+#
+# Recording is a dict lookup and a few integer operations under a lock, and
+# every metric has a fixed set of labels, so memory stays bounded no matter
+# how many sessions are recorded. Reading the metrics (HTTP scrape or file
+# dump) happens on its own thread.
+
+
+class Histogram:
+    # log-linear buckets like HdrHistogram: every power of two of microseconds
+    # is split into SUB_BUCKETS linear buckets, so a value is never off by more
+    # than 1/SUB_BUCKETS of itself, with a fixed number of buckets
+
+    SUB_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BITS
+    MAX_US = 1 << 27  # about 134 s, anything longer lands in the last bucket
+
+    def __init__(self):
+        self.counts = [0] * (self.index(self.MAX_US - 1) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def index(cls, us):
+        if us < 2 * cls.SUB_BUCKETS:
+            return us
+        shift = us.bit_length() - cls.SUB_BITS - 1
+        return shift * cls.SUB_BUCKETS + (us >> shift)
+
+    # exclusive upper bound in microseconds of bucket i
+    @classmethod
+    def upper(cls, i):
+        if i < 2 * cls.SUB_BUCKETS:
+            return i + 1
+        shift = i // cls.SUB_BUCKETS - 1
+        return (i - shift * cls.SUB_BUCKETS + 1) << shift
+
+    def observe(self, seconds):
+        us = min(max(int(seconds * 1e6), 0), self.MAX_US - 1)
+        self.counts[self.index(us)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return list(self.counts), self.count, self.sum, self.max
+
+    def merge(self, snapshot):
+        counts, count, total, largest = snapshot
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.count += count
+        self.sum += total
+        self.max = max(self.max, largest)
+
+    # number of values below us microseconds, us must be a power of two
+    def count_below(self, us):
+        return sum(self.counts[:self.index(us)])
+
+    # upper bound in seconds of the bucket holding the q-th quantile
+    def quantile(self, q):
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.upper(i) / 1e6, self.max)
+        return self.max
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterFamily:
+    kind = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values):
+        with self.lock:
+            for labels, value in values.items():
+                self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} counter")
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+
+
+class HistogramFamily:
+    # exported buckets are every power of two from 16 us up; the finer
+    # buckets only show up in the quantiles, exported as a separate gauge
+
+    kind = "histogram"
+    EXPORT_BITS = range(4, 28)
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.histograms = {}  # label values -> Histogram
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        with self.lock:
+            histogram = self.histograms.get(labels)
+            if histogram is None:
+                histogram = self.histograms[labels] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {labels: histogram.snapshot() for labels, histogram in self.histograms.items()}
+
+    def merge(self, snapshots):
+        with self.lock:
+            for labels, snapshot in snapshots.items():
+                histogram = self.histograms.get(labels)
+                if histogram is None:
+                    histogram = self.histograms[labels] = Histogram()
+                histogram.merge(snapshot)
+
+    def render(self, lines):
+        quantiles = []
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        with self.lock:
+            for labels, histogram in sorted(self.histograms.items()):
+                for bits in self.EXPORT_BITS:
+                    le = format_labels(self.labels, labels, f'le="{(1 << bits) / 1e6}"')
+                    lines.append(f"{self.name}_bucket{le} {histogram.count_below(1 << bits)}")
+                le = format_labels(self.labels, labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {histogram.count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {histogram.sum}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {histogram.count}")
+
+                for q in self.QUANTILES:
+                    quantiles.append((format_labels(self.labels, labels, f'quantile="{q}"'), histogram.quantile(q)))
+                quantiles.append((format_labels(self.labels, labels, 'quantile="1"'), histogram.max))
+
+        name = self.name.replace("_seconds", "_quantile_seconds")
+        lines.append(f"# HELP {name} {self.help}, quantiles")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in quantiles:
+            lines.append(f"{name}{labels} {value}")
+
+
+class GaugeFamily:
+    # read() is called on every render and returns {label values: value}
+    # merged gauges are summed and read back from values instead
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, read=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.read = read or (lambda: self.values)
+
+    def snapshot(self):
+        return dict(self.read())
+
+    def merge(self, values):
+        for labels, value in values.items():
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} gauge")
+        for labels, value in sorted(self.read().items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+
+
+class Metrics:
+
+    def __init__(self):
+        self.families = []
+
+    def counter(self, name, help, labels=()):
+        return self.add(CounterFamily(name, help, labels))
+
+    def histogram(self, name, help, labels=()):
+        return self.add(HistogramFamily(name, help, labels))
+
+    def gauge(self, name, help, labels, read=None):
+        return self.add(GaugeFamily(name, help, labels, read))
+
+    def add(self, family):
+        self.families.append(family)
+        return family
+
+    # plain data that can be pickled and sent to another process
+    def snapshot(self):
+        return [
+            (family.kind, family.name, family.help, family.labels, family.snapshot())
+            for family in self.families
+        ]
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            try:
+                family.render(lines)
+            except Exception as e:
+                lines.append(f"# {family.name} failed: {e}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+# adds up snapshots (from several processes) into a new Metrics
+def combine(snapshots):
+    combined = Metrics()
+    families = {}
+    kinds = {"counter": CounterFamily, "histogram": HistogramFamily, "gauge": GaugeFamily}
+    for snapshot in snapshots:
+        for kind, name, help, labels, values in snapshot:
+            family = families.get(name)
+            if family is None:
+                family = families[name] = combined.add(kinds[kind](name, help, labels))
+            family.merge(values)
+    return combined
+
+
+# serves the metrics on http://host:port/ from a background thread
+def serve_http(metrics, host, port):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+# rewrites path with the current metrics every interval seconds and at exit
+def dump_periodically(metrics, path, interval):
+    def dump():
+        # write a temporary file and rename it, so readers never see half a dump
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(metrics.render())
+        os.replace(tmp, path)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            dump()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    atexit.register(dump)
+    return thread
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics over HTTP on this port")
+    parser.add_argument("--metrics-file", default=None,
+                        help="write Prometheus metrics to this file periodically")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="seconds between --metrics-file dumps (default: 10)")
+
+
+def setup(metrics, host, args):
+    if args.metrics_port is not None:
+        serve_http(metrics, host, args.metrics_port)
+    if args.metrics_file:
+        dump_periodically(metrics, args.metrics_file, args.metrics_interval)
@@ -0,0 +1,197 @@
+import atexit
+import collections
+import itertools
+import struct
+import sys
+import threading
+import time
+
+# Binary packet traces
+#
+# With --trace PATH the server and the client append every packet they send
+# and receive to PATH, as a fixed 20 byte record header followed by the bytes
+# on the wire (Packet headers and payloads):
+#
+#   time     uint64  microseconds since the trace segment started
+#   session  uint32  handshake the packet belongs to, 0 if unknown
+#   dir      uint8   RECV or SEND, as seen by whoever recorded it
+#   kind     uint8   UDP or TCP
+#   port     uint16  the server port the packet went to or came from
+#   length   uint32  number of bytes that follow
+#
+# Every run starts a new segment with a START record whose data says who
+# recorded it and when, so several runs can be appended to one file.
+# TCP records hold whatever one send or receive call moved, which may be
+# several packets or part of one; read the stream of a session and direction
+# as a whole to split it into packets.
+#
+#   python3 packet_trace.py server.trace    # prints a summary of a trace
+
+RECORD = struct.Struct('!QIBBHI')
+START_DATA = struct.Struct('!8sBd')  # MAGIC, role, start time (epoch seconds)
+MAGIC = b'CSE461TR'
+
+RECV, SEND, START = 0, 1, 2
+UDP, TCP = 0, 1
+SERVER, CLIENT = 0, 1
+
+Record = collections.namedtuple("Record", "time session dir kind port data")
+
+
+class TraceWriter:
+    # records are packed into a buffer by the threads handling packets and
+    # written out in batches by a background thread, like the JSON log
+
+    def __init__(self, path, role, interval=0.1):
+        self.stream = open(path, "ab")
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.start = time.monotonic()
+        self.sessions = {}  # client address -> session id, for the server
+        self.next_session = itertools.count(1)
+        self.stopped = threading.Event()
+        self.records = 0
+
+        start = START_DATA.pack(MAGIC, role, time.time())
+        self.buffer += RECORD.pack(0, 0, START, 0, 0, len(start)) + start
+        self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def new_session(self):
+        return next(self.next_session)
+
+    # a hello from addr (with --stateless, its first valid stage B packet)
+    # starts a new session, addr's later packets belong to it
+    def start_session(self, addr):
+        session = self.sessions[addr] = self.new_session()
+        return session
+
+    def session(self, addr):
+        return self.sessions.get(addr, 0)
+
+    def end_session(self, addr, session):
+        if self.sessions.get(addr) == session:
+            del self.sessions[addr]
+
+    def record(self, session, direction, kind, port, data):
+        us = int((time.monotonic() - self.start) * 1e6)
+        with self.lock:
+            self.buffer += RECORD.pack(us, session, direction, kind, port, len(data))
+            self.buffer += data
+            self.records += 1
+
+    # sock with everything that goes through it recorded under session
+    # port None records the port of each datagram's peer (for the client)
+    def wrap(self, sock, session, kind, port=None):
+        return TracedSocket(self, sock, session, kind, port)
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            data, self.buffer = self.buffer, bytearray()
+        if data:
+            self.stream.write(data)
+            self.stream.flush()
+
+    def close(self):
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+
+
+class TracedSocket:
+    # forwards to sock and records the bytes of every send and receive
+
+    def __init__(self, writer, sock, session, kind, port):
+        self.writer = writer
+        self.sock = sock
+        self.session = session
+        self.kind = kind
+        self.port = port
+
+    def peer_port(self, addr):
+        if self.port is not None:
+            return self.port
+        return addr[1] if isinstance(addr, tuple) else 0
+
+    def sendto(self, data, addr):
+        self.writer.record(self.session, SEND, self.kind, self.peer_port(addr), data)
+        return self.sock.sendto(data, addr)
+
+    def recvfrom_into(self, buf, nbytes=0):
+        n, addr = self.sock.recvfrom_into(buf, nbytes)
+        self.writer.record(self.session, RECV, self.kind, self.peer_port(addr), memoryview(buf)[:n])
+        return n, addr
+
+    def sendall(self, data):
+        self.writer.record(self.session, SEND, self.kind, self.port, data)
+        self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        sent = self.sock.sendmsg(buffers)
+        self.writer.record(self.session, SEND, self.kind, self.port, b''.join(buffers)[:sent])
+        return sent
+
+    def recv_into(self, buf, nbytes=0):
+        n = self.sock.recv_into(buf, nbytes)
+        self.writer.record(self.session, RECV, self.kind, self.port, memoryview(buf)[:n])
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+# yields (role, start time, record) for every record in the trace at path
+# record.time is seconds since the start of its segment
+def read(path):
+    role = start = None
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            us, session, direction, kind, port, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # cut off by a crash mid-write
+                return
+            if direction == START:
+                magic, role, start = START_DATA.unpack(data)
+                if magic != MAGIC:
+                    raise ValueError(f"{path} is not a packet trace")
+                continue
+            if role is None:
+                raise ValueError(f"{path} does not start with a trace header")
+            yield role, start, Record(us / 1e6, session, direction, kind, port, data)
+
+
+def main():
+    for path in sys.argv[1:]:
+        records = 0
+        sessions = set()
+        counts = collections.Counter()
+        sizes = collections.Counter()
+        first = last = None
+        for role, start, record in read(path):
+            records += 1
+            sessions.add((start, record.session))
+            key = ("recv" if record.dir == RECV else "send", "udp" if record.kind == UDP else "tcp")
+            counts[key] += 1
+            sizes[key] += len(record.data)
+            at = start + record.time
+            first = at if first is None else min(first, at)
+            last = at if last is None else max(last, at)
+        print(f"{path}: {records} records, {len(sessions)} sessions, "
+              f"{(last - first) if records else 0:.3f} s")
+        for key in sorted(counts):
+            print(f"  {key[0]} {key[1]}: {counts[key]} records, {sizes[key]} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import itertools
+import logging
+import random
+import threading
+from packet_struct import Packet
+from timing_wheel import IdleTimer
+import batch_io
+import packet_trace
+import server
+
+log = logging.getLogger("server")
+
+# Stage B port management
+#   PortPool:     every client still gets its own UDP socket, but the port comes
+#                 from a pool that only hands out ports it managed to bind
+#   SharedStageB: a small fixed set of sockets is shared by every client and
+#                 datagrams are routed to sessions by (client addr, psecret);
+#                 with --stateless a session is only created when its first
+#                 packet proves the client got a cookie in stage A (cookies.py)
+
+
+class PortPool:
+    # hands out UDP ports in [low, high] together with a socket bound to them,
+    # so a port somebody else already has bound is never given to a client
+
+    def __init__(self, host, low=1024, high=65535):
+        self.host = host
+        self.capacity = high - low + 1
+        self.free = list(range(low, high + 1))
+        self.bound = {}  # port -> socket, for ports currently handed out
+        self.busy = []   # ports found bound by another process
+        self.lock = threading.Lock()
+
+    # binds a random free port and returns it, raises OSError when none are left
+    def acquire(self):
+        with self.lock:
+            # ports that were busy get another chance once the free list runs dry
+            if not self.free:
+                self.free, self.busy = self.busy, []
+
+            while self.free:
+                # swap-remove a random entry so picking stays O(1)
+                i = random.randrange(len(self.free))
+                self.free[i], self.free[-1] = self.free[-1], self.free[i]
+                port = self.free.pop()
+
+                try:
+                    sock = server.TRANSPORT.datagram((self.host, port))
+                except OSError:
+                    # in use outside the pool, set it aside
+                    self.busy.append(port)
+                    continue
+
+                self.bound[port] = sock
+                return port
+        raise OSError("no free UDP ports left in the pool")
+
+    def socket(self, port):
+        return self.bound[port]
+
+    # closes the port's socket and puts it back into the pool
+    def release(self, port):
+        with self.lock:
+            sock = self.bound.pop(port, None)
+            if sock is None:
+                return
+            sock.close()
+            self.free.append(port)
+
+    def occupancy(self):
+        with self.lock:
+            return {
+                "in_use": len(self.bound),
+                "free": len(self.free),
+                "busy_elsewhere": len(self.busy),
+                "capacity": self.capacity,
+            }
+
+
+class StageBSession:
+    # stage B state for one client on a shared socket
+
+    def __init__(self, addr, num, length, secretA, on_done):
+        self.addr = addr
+        self.num = num
+        self.length = length
+        self.secretA = secretA
+        self.received = 0
+        self.expected_content = bytes(length)
+        # called once with True when every packet was acked,
+        # or with False when the session timed out
+        self.on_done = on_done
+        self.idle = None
+        # created from a stage A cookie when its first packet came in
+        self.stateless = False
+
+
+class SharedStageB:
+    # count UDP sockets shared by every client's stage B
+    # session timeouts are policed by the timing wheel timers, not by a thread per client
+
+    def __init__(self, host, count, timers):
+        self.timers = timers
+        self.socks = {}
+        for _ in range(count):
+            # port 0 lets the kernel pick a port that is guaranteed to be free
+            sock = server.TRANSPORT.datagram((host, 0))
+            self.socks[sock.getsockname()[1]] = sock
+        self.ports = list(self.socks)
+        # what acks go out through, the asyncio engine swaps in its transports
+        self.senders = dict(self.socks)
+        self.next_port = itertools.count()
+
+        # (client addr, psecret) -> StageBSession
+        self.sessions = {}
+        self.per_port = dict.fromkeys(self.ports, 0)
+        # sessions come and go on client threads, the receive loops and the
+        # timing wheel at once
+        self.lock = threading.Lock()
+        # with server.COOKIES, called with (port, session) for every session
+        # created from a cookie, to set its on_done and carry on the handshake
+        self.start_session = None
+
+    # spreads clients over the shared ports round robin
+    def allocate_port(self):
+        return self.ports[next(self.next_port) % len(self.ports)]
+
+    def register(self, port, session):
+        with self.lock:
+            self.sessions[(session.addr, session.secretA)] = session
+            self.per_port[port] += 1
+        session.idle = IdleTimer(self.timers, server.TIMEOUT, self.expire, port, session)
+
+    # removes the session, returns False if it was already gone
+    def unregister(self, port, session):
+        with self.lock:
+            if self.sessions.pop((session.addr, session.secretA), None) is None:
+                return False
+            self.per_port[port] -= 1
+        session.idle.cancel()
+        return True
+
+    def expire(self, port, session):
+        # a finished stateless session only lingered for late duplicates
+        if self.unregister(port, session) and session.received < session.num:
+            log.warning("Timeout in Stage B. Only received %d/%d packets.", session.received, session.num,
+                        extra={"session": session.addr})
+            server.FAILURES.inc("b", "timeout")
+            session.on_done(False)
+
+    def sendto(self, port, data, addr):
+        if server.TRACE:
+            server.TRACE.record(server.TRACE.session(addr), packet_trace.SEND, packet_trace.UDP, port, data)
+        self.senders[port].sendto(data, addr)
+
+    # sends a batch of acks that came in on port through receiver
+    def send_acks(self, port, receiver, acks):
+        if server.TRACE:
+            for data, addr in acks:
+                server.TRACE.record(server.TRACE.session(addr), packet_trace.SEND, packet_trace.UDP, port, data)
+        receiver.send(acks)
+
+    # validates one datagram received on port for its session, returns the ack
+    # to send back (encoded into ack) or None, and the session if this was
+    # its last packet; finish() it once the ack is sent
+    def handle_datagram(self, port, data, client, ack):
+        session = None
+        if len(data) >= Packet.HEADER_SIZE:
+            psecret = Packet.HEADER_STRUCT.unpack_from(data)[1]
+            session = self.sessions.get((client, psecret))
+            if session is None and server.COOKIES is not None:
+                session = self.open_stateless(port, data, client, psecret)
+        # recorded after open_stateless, whose packet starts the trace session
+        if server.TRACE:
+            server.TRACE.record(server.TRACE.session(client), packet_trace.RECV, packet_trace.UDP, port, data)
+        if session is None:
+            log.debug("Dropping packet on port %d: no Stage B session", port, extra={"session": client})
+            return None, None
+        session.idle.touch()
+
+        packet_id = server.check_stage_b_packet(
+            session.addr, data, session.length, session.received, session.expected_content, session.secretA
+        )
+        if packet_id is None or not server.should_ack(session.received, session.num):
+            return None, None
+
+        session.received += 1
+        log.debug("Acknowledged packet %d, %d/%d received", packet_id, session.received, session.num,
+                  extra={"session": session.addr})
+        ack = server.encode_ack(ack, session.secretA, packet_id)
+        return ack, session if session.received == session.num else None
+
+    # the session of a client that got a cookie in stage A and sent a valid
+    # packet 0 with it, None for anything else
+    def open_stateless(self, port, data, client, psecret):
+        response = server.COOKIES.check(client, psecret)
+        if response is None:
+            return None
+        num, length, udp_port, secretA = response
+        if udp_port != port or server.check_stage_b_packet(client, data, length, 0, bytes(length), secretA) != 0:
+            return None
+
+        session = StageBSession(client, num, length, secretA, None)
+        session.stateless = True
+        self.register(port, session)
+        self.start_session(port, session)
+        return session
+
+    # ends a session that received all its packets, after its acks went out so
+    # the Stage B response follows them
+    def finish(self, port, session):
+        if session.stateless:
+            # it stays until it goes quiet, late duplicates of its packets
+            # would otherwise look like a new client's packet 0
+            session.on_done(True)
+        # whoever removes the session reports how it ended
+        elif self.unregister(port, session):
+            session.on_done(True)
+
+    # starts one receiver thread per shared socket
+    def start_threads(self):
+        for port, sock in self.socks.items():
+            thread = threading.Thread(target=self.receive_loop, args=(port, sock), daemon=True)
+            thread.start()
+
+    def receive_loop(self, port, sock):
+        # any stage B packet, the sessions on a port have different sizes
+        receiver = batch_io.open_receiver(sock, 65536, server.DRAIN)
+        buffers = [bytearray(Packet.padded_size(4)) for _ in range(receiver.count)]
+        while True:
+            acks, done = [], []
+            for data, client in receiver.receive(None):
+                ack, finished = self.handle_datagram(port, data, client, buffers[len(acks)])
+                if ack is not None:
+                    acks.append((ack, client))
+                if finished is not None:
+                    done.append(finished)
+            self.send_acks(port, receiver, acks)
+            for session in done:
+                self.finish(port, session)
+
+    def occupancy(self):
+        with self.lock:
+            return {
+                "in_use": len(self.sessions),
+                "ports": len(self.ports),
+                "per_port": dict(self.per_port),
+            }
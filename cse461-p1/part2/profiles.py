@@ -0,0 +1,92 @@
+import argparse
+import random
+
+# How big the stage B and stage D transfers are
+#
+# The assignment's ranges (num and len of 1-5 and 1-10) keep every session
+# to a few hundred bytes. The other profiles scale the packet counts and
+# sizes up to exercise the bulk paths:
+#
+#   --profile classic   num, num2 1-5, len, len2 1-10 (the default)
+#   --profile mtu       100-1000 packets of 1000-1400 bytes, one per Ethernet frame
+#   --profile bulk      1000-10000 packets of 8-32 KB (stage B) and 8-64 KB (stage D)
+#   --profile max       100000 packets of the largest size each stage allows
+#
+# or ranges of your own, where anything left out stays classic:
+#
+#   --profile num=1000-5000,len=1400,num2=100,len2=60000,loss=0.05
+#
+# loss is the fraction of stage B acks the server leaves out on purpose, so
+# clients have to retransmit. The assignment's 0.4 would make the large
+# profiles crawl, they drop fewer.
+
+MAX_NUM = 100000
+# the largest stage B payload (not counting the packet id) that still fits
+# one UDP datagram with the packet id, header and padding
+MAX_LEN = 65488
+MAX_LEN2 = 65536
+
+
+class Profile:
+
+    def __init__(self, name, num, length, num2, len2, loss=0.4):
+        self.name = name
+        # (low, high) ranges, inclusive
+        self.num = num
+        self.length = length
+        self.num2 = num2
+        self.len2 = len2
+        self.loss = loss
+
+    # num and len for a new session
+    def stage_b(self):
+        return random.randint(*self.num), random.randint(*self.length)
+
+    # num2 and len2 for a new session
+    def stage_d(self):
+        return random.randint(*self.num2), random.randint(*self.len2)
+
+    def __str__(self):
+        return (f"{self.name} (num={self.num[0]}-{self.num[1]}, len={self.length[0]}-{self.length[1]}, "
+                f"num2={self.num2[0]}-{self.num2[1]}, len2={self.len2[0]}-{self.len2[1]}, loss={self.loss})")
+
+
+PROFILES = {
+    "classic": Profile("classic", (1, 5), (1, 10), (1, 5), (1, 10)),
+    "mtu": Profile("mtu", (100, 1000), (1000, 1400), (100, 1000), (1000, 1400), loss=0.05),
+    "bulk": Profile("bulk", (1000, 10000), (8000, 32000), (1000, 10000), (8000, MAX_LEN2), loss=0.01),
+    "max": Profile("max", (MAX_NUM, MAX_NUM), (MAX_LEN, MAX_LEN), (MAX_NUM, MAX_NUM), (MAX_LEN2, MAX_LEN2),
+                   loss=0.01),
+}
+
+LIMITS = {"num": MAX_NUM, "len": MAX_LEN, "num2": MAX_NUM, "len2": MAX_LEN2}
+
+
+# argparse type for --profile: a profile name or key=low-high,... ranges
+def parse(spec):
+    if spec in PROFILES:
+        return PROFILES[spec]
+
+    classic = PROFILES["classic"]
+    ranges = {"num": classic.num, "len": classic.length, "num2": classic.num2, "len2": classic.len2}
+    loss = classic.loss
+    try:
+        for item in spec.split(","):
+            key, value = item.split("=")
+            if key == "loss":
+                loss = float(value)
+                if not 0 <= loss < 1:
+                    raise argparse.ArgumentTypeError("loss must be at least 0 and below 1")
+                continue
+            if key not in LIMITS:
+                raise argparse.ArgumentTypeError(f"unknown profile key {key!r}")
+            low, _, high = value.partition("-")
+            low, high = int(low), int(high or low)
+            if not 1 <= low <= high <= LIMITS[key]:
+                raise argparse.ArgumentTypeError(f"{key} must be a range within 1-{LIMITS[key]}")
+            ranges[key] = (low, high)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{spec!r} is neither one of {', '.join(PROFILES)} nor key=low-high,... ranges"
+        ) from None
+    return Profile(spec, ranges["num"], ranges["len"], ranges["num2"], ranges["len2"], loss)
@@ -1,3 +1,6 @@
+import argparse
+import logging
+import signal
 import socket
 import threading
 from packet_struct import Packet
@@ -6,13 +9,72 @@ import struct
 import sys
 import time
 
-HOST = sys.argv[1]
-PORT = int(sys.argv[2])
+# let the other server modules import this file as "server" even when it is
+# run as a script, so they all see the same settings
+sys.modules.setdefault("server", sys.modules[__name__])
+
+from port_pool import PortPool, SharedStageB, StageBSession
+from stream_reader import PacketStreamReader
+from timing_wheel import TimingWheel
+import batch_io
+import cookies
+import jsonlog
+import listeners
+import metrics
+import packet_trace
+import profiles
+import transport
+
+log = logging.getLogger("server")
+
+# set from the command line in main()
+HOST = "localhost"
+PORT = 12235
+# None to bind a random port per client, otherwise a PortPool or SharedStageB
+STAGE_B_PORTS = None
+# set in sharded workers, which all bind PORT
+REUSE_PORT = False
+# where the threads engine gets its sockets from, see transport.py
+TRANSPORT = transport.SOCKETS
+# a packet_trace.TraceWriter with --trace
+TRACE = None
+# how many packets of what size stages B and D take, see profiles.py
+PROFILE = profiles.PROFILES["classic"]
+# with --drain, stage B takes every queued datagram at once, see batch_io.py
+DRAIN = False
+# a cookies.CookieJar with --stateless, stage A then keeps no state
+COOKIES = None
+# None to listen on a new port per client, otherwise a listeners.SharedListeners
+LISTENERS = None
+# session timeouts that are not tied to a blocking socket live on this wheel
+TIMERS = TimingWheel()
 RECV_SIZE = 1024
 TIMEOUT = 3  # seconds
 HEADER_SIZE = Packet.HEADER_SIZE
 HEADER_FORMAT = Packet.HEADER_FORMAT
 STUDENT_ID_LAST3 = 696
+STAGE_A_PAYLOAD = b'hello world\0'
+STAGE_A_RESPONSE = struct.Struct('!IIII')
+PACKET_ID = struct.Struct('!I')
+# how many bytes of stage D packets to receive at once, at least
+STAGE_D_BATCH_BYTES = 65536
+# ... and in packets, for large packets
+STAGE_D_BATCH_PACKETS = 8
+
+# stages: a (hello check), b, accept (waiting for the TCP connect), c, d
+METRICS = metrics.Metrics()
+SESSIONS = METRICS.counter("cse461_sessions_total", "Handshakes started and completed", ("result",))
+STAGE_SECONDS = METRICS.histogram("cse461_stage_seconds", "Time spent in each stage", ("stage",))
+FAILURES = METRICS.counter(
+    "cse461_failures_total",
+    "Failed checks by stage and reason: header_mismatch, bad_payload, wrong_secret, timeout, error",
+    ("stage", "reason"),
+)
+STAGE_B_DATAGRAMS = METRICS.counter(
+    "cse461_stage_b_datagrams_total",
+    "Valid stage B datagrams: acked, dropped (the client retransmits them), duplicate or out_of_order",
+    ("result",),
+)
 
 # The server should verify the header of every packet received and close any open sockets to the client and/or fail to respond to the client if:
   # unexpected number of buffers have been received
@@ -20,10 +82,6 @@ STUDENT_ID_LAST3 = 696
   # the server does not receive any packets from the client for 3 seconds
   # the server does not receive the correct secret
 
-def random_int():
-    return random.randint(1, 5)
-def random_length():
-    return random.randint(1, 10)
 def random_port():
     return random.randint(1024, 65535)
 def random_secret():
@@ -33,107 +91,279 @@ def random_secret():
 def padded_length(n):
     return ((n + 3) // 4) * 4
 
-def handle_stage_a(data, addr, udp_sock):
+# Stage A answered from a cookie (see cookies.py): nothing about the client is
+# kept, not even its trace session, its stage B session starts with its first
+# valid packet
+def handle_stage_a_stateless(data, addr, udp_sock, session=0):
     try:
-        # Verify the packet length
-        pad_len = padded_length(12)
-        if len(data) != HEADER_SIZE + pad_len:
-            return None
-
-        
-        # Verify packet header
-        payload_len, psecret, step, student_id = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
-        if payload_len != 12 or psecret != 0 or step != 1:
-            print(f"[{addr}] Header validation failed:")
-            print(f"  len={payload_len}, secret={psecret}, step={step}, id={student_id}")
-            return None
-        
-        # Extract payload
-        payload = Packet.extract_payload(data)
+        if check_stage_a(data, addr):
+            num, length, udp_port, secretA = COOKIES.issue(addr)
+            send_stage_a_response(udp_sock, addr, num, length, udp_port, secretA, session)
+    except Exception as e:
+        log.warning("Error in Stage A: %s", e, extra={"session": addr})
 
-        if payload != b'hello world\0':
-            print(f"[{addr}] Invalid payload: {payload}")
+def handle_stage_a(data, addr, udp_sock):
+    try:
+        if not check_stage_a(data, addr):
             return None
 
-        num = random_int()
-        length = random_length()
+        num, length = PROFILE.stage_b()
         udp_port = random_port()
         secretA = random_secret()
 
-        response_payload = struct.pack('!IIII', num, length, udp_port, secretA)
-        packet = Packet(len(response_payload), 0, 2, response_payload)
-
-        print(f"[{addr}] Sending Stage A response: num={num}, len={length}, udp_port={udp_port}, secretA={secretA}")
-    
-        udp_sock.sendto(packet.wrap_payload(), addr)
+        send_stage_a_response(udp_sock, addr, num, length, udp_port, secretA)
         return num, length, udp_port, secretA
     except Exception as e:
-        print(f"[{addr}] Error in Stage A: {e}")
+        log.warning("Error in Stage A: %s", e, extra={"session": addr})
         return None
-   
-def handle_stage_b(addr, num, length, udp_port, secretA):
-    # Create a UDP socket for this stage at port udp_port
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.bind((HOST, udp_port))
+
+# Helper Function: verify a stage A hello world packet
+def check_stage_a(data, addr):
+    start = time.monotonic()
+    # Verify the packet length
+    pad_len = padded_length(12)
+    if len(data) != HEADER_SIZE + pad_len:
+        FAILURES.inc("a", "header_mismatch")
+        return False
+
+    # Verify packet header
+    header, payload = Packet.parse(data)
+    payload_len, psecret, step, student_id = header
+    if payload_len != 12 or psecret != 0 or step != 1:
+        log.info("Stage A header validation failed: len=%d, secret=%d, step=%d, id=%d",
+                 payload_len, psecret, step, student_id, extra={"session": addr})
+        FAILURES.inc("a", "wrong_secret" if psecret != 0 else "header_mismatch")
+        return False
+
+    if payload != STAGE_A_PAYLOAD:
+        log.info("Invalid Stage A payload: %r", bytes(payload), extra={"session": addr})
+        FAILURES.inc("a", "bad_payload")
+        return False
+
+    STAGE_SECONDS.observe(time.monotonic() - start, "a")
+    SESSIONS.inc("started")
+    return True
+
+def send_stage_a_response(udp_sock, addr, num, length, udp_port, secretA, session=None):
+    # Build the response in place: header first, then the payload behind it
+    response = bytearray(Packet.padded_size(STAGE_A_RESPONSE.size))
+    Packet.encode_into(response, 0, STAGE_A_RESPONSE.size, 0, 2)
+    STAGE_A_RESPONSE.pack_into(response, HEADER_SIZE, num, length, udp_port, secretA)
+
+    log.info("Sending Stage A response: num=%d, len=%d, udp_port=%d, secretA=%d",
+             num, length, udp_port, secretA, extra={"session": addr})
+    if TRACE:
+        if session is None:
+            session = TRACE.session(addr)
+        TRACE.record(session, packet_trace.SEND, packet_trace.UDP, PORT, response)
+    udp_sock.sendto(response, addr)
+
+def handle_stage_b(addr, num, length, udp_port, secretA, udp_sock=None):
+    # Create a UDP socket for this stage at port udp_port, unless the port pool
+    # already bound one for us
+    if udp_sock is None:
+        udp_sock = TRANSPORT.datagram((HOST, udp_port))
+    if TRACE:
+        udp_sock = TRACE.wrap(udp_sock, TRACE.session(addr), packet_trace.UDP, udp_port)
 
     received = 0  # number of packets received
-    print(f"[{addr}] Listening on UDP port {udp_port} for Stage B")
+
+    # The receive buffers and one ack buffer per datagram of a batch are
+    # reused for the whole stage (a longer datagram is cut off, its header
+    # then claims more than is there)
+    receiver = batch_io.open_receiver(udp_sock, Packet.padded_size(length + 4), DRAIN)
+    acks = [bytearray(Packet.padded_size(PACKET_ID.size)) for _ in range(receiver.count)]
+    expected_content = bytes(length)
+    log.info("Listening on UDP port %d for Stage B", udp_port, extra={"session": addr})
     
     # Use a timeout for the entire stage
-    start_time = time.time()
-    udp_sock.settimeout(TIMEOUT)
+    start_time = time.monotonic()
     
     while received < num:
         try:
-            data, client = udp_sock.recvfrom(2048)
-
-            payload = Packet.extract_payload(data)
-            if len(payload) != length + 4:
-                print(f"[{addr}] Invalid payload length: expected {length + 4}, got {len(payload)}")
-                continue
-
-            packet_id = struct.unpack('!I', payload[:4])[0]  # Extract packet ID as int
-            content = payload[4:]
-
-            # Verify packet ID and content
-            if content != b'\x00' * length or packet_id != received:
-                print(f"[{addr}] Invalid packet content or wrong packet ID: expected ID {received}, got {packet_id}")
-                continue
-
-            # Randomly acknowledge packets and always acknowledge the last packet
-            if random.random() > 0.4 or received == num - 1:
-                ack_payload = struct.pack('!I', packet_id)
-                ack_packet = Packet(4, secretA, 2, ack_payload)
-                udp_sock.sendto(ack_packet.wrap_payload(), client)
-                received += 1
-                print(f"[{addr}] Acknowledged packet {packet_id}, {received}/{num} received")
+            datagrams = receiver.receive(TIMEOUT)
         except socket.timeout:
             # If timeout reached, fail the stage
-            print(f"[{addr}] Timeout in Stage B. Only received {received}/{num} packets.")
+            log.warning("Timeout in Stage B. Only received %d/%d packets.", received, num, extra={"session": addr})
+            FAILURES.inc("b", "timeout")
             udp_sock.close()
             return None
+
+        replies = []
+        for data, client in datagrams:
+            packet_id = check_stage_b_packet(addr, data, length, received, expected_content, secretA)
+            if packet_id is None:
+                continue
+
+            if should_ack(received, num):
+                replies.append((encode_ack(acks[len(replies)], secretA, packet_id), client))
+                received += 1
+                log.debug("Acknowledged packet %d, %d/%d received", packet_id, received, num, extra={"session": addr})
+        # the acks of a batch go out together
+        receiver.send(replies)
             
     # Verify that we received exactly the required number of packets
     if received != num:
-        print(f"[{addr}] Stage B failed: received {received} packets, expected {num}")
+        log.warning("Stage B failed: received %d packets, expected %d", received, num, extra={"session": addr})
         udp_sock.close()
         return None
         
-    tcp_port = random_port()
+    STAGE_SECONDS.observe(time.monotonic() - start_time, "b")
+    tcp_port, accepted = open_tcp_port(addr)
+    secretB, response = make_stage_b_response(secretA, tcp_port)
+
+    log.info("Stage B complete: received all %d packets.", num, extra={"session": addr})
+    log.info("Sending Stage B response: tcp_port=%d, secretB=%d", tcp_port, secretB, extra={"session": addr})
+    udp_sock.sendto(response, addr)
+    udp_sock.close()
+    return tcp_port, secretB, accepted
+
+# Stage B on a port from the pool, the pool socket is released when we are done
+def handle_stage_b_pool(udp_sock, addr, num, length, secretA):
+    try:
+        udp_port = STAGE_B_PORTS.acquire()
+    except OSError as e:
+        log.warning("Cannot start Stage B: %s", e, extra={"session": addr})
+        return None
+
+    try:
+        occupancy = STAGE_B_PORTS.occupancy()
+        log.info("Pool port %d (%d/%d in use)", udp_port, occupancy["in_use"], occupancy["capacity"], extra={"session": addr})
+        send_stage_a_response(udp_sock, addr, num, length, udp_port, secretA)
+        return handle_stage_b(addr, num, length, udp_port, secretA, STAGE_B_PORTS.socket(udp_port))
+    finally:
+        STAGE_B_PORTS.release(udp_port)
+
+# Stage B on one of the shared sockets: the socket's receiver thread validates
+# and acks the packets, this thread only waits for the session to finish
+def handle_stage_b_shared(udp_sock, addr, num, length, secretA):
+    finished = threading.Event()
+    result = []
+
+    def on_done(ok):
+        result.append(ok)
+        finished.set()
+
+    session = StageBSession(addr, num, length, secretA, on_done)
+    udp_port = STAGE_B_PORTS.allocate_port()
+
+    # register before replying so the first packet already finds its session
+    STAGE_B_PORTS.register(udp_port, session)
+    log.info("Shared UDP port %d for Stage B (%d sessions)", udp_port, len(STAGE_B_PORTS.sessions), extra={"session": addr})
+    send_stage_a_response(udp_sock, addr, num, length, udp_port, secretA)
+    return finish_stage_b_shared(addr, udp_port, num, secretA, finished, result)
+
+# waits for a shared Stage B session to end and sends the Stage B response
+def finish_stage_b_shared(addr, udp_port, num, secretA, finished, result):
+    # the timing wheel ends the session if it goes quiet
+    start_time = time.monotonic()
+    finished.wait()
+    if not result[0]:
+        return None
+    STAGE_SECONDS.observe(time.monotonic() - start_time, "b")
+
+    tcp_port, accepted = open_tcp_port(addr)
+    secretB, response = make_stage_b_response(secretA, tcp_port)
+
+    log.info("Stage B complete: received all %d packets.", num, extra={"session": addr})
+    log.info("Sending Stage B response: tcp_port=%d, secretB=%d", tcp_port, secretB, extra={"session": addr})
+    STAGE_B_PORTS.sendto(udp_port, response, addr)
+    return tcp_port, secretB, accepted
+
+# SharedStageB.start_session with --stateless: a thread for the rest of the
+# handshake of a client whose first valid Stage B packet just came in
+def start_stateless_session(udp_port, session):
+    finished = threading.Event()
+    result = []
+
+    def on_done(ok):
+        result.append(ok)
+        finished.set()
+
+    session.on_done = on_done
+    if TRACE:
+        TRACE.start_session(session.addr)
+    log.info("Stage B session from a cookie on shared UDP port %d (%d sessions)",
+             udp_port, len(STAGE_B_PORTS.sessions), extra={"session": session.addr})
+    thread = threading.Thread(target=stateless_client_thread, args=(udp_port, session, finished, result))
+    thread.start()
+
+def stateless_client_thread(udp_port, session, finished, result):
+    addr = session.addr
+    try:
+        stage_b = finish_stage_b_shared(addr, udp_port, session.num, session.secretA, finished, result)
+        if stage_b:
+            handle_tcp_stages(addr, *stage_b)
+    finally:
+        if TRACE:
+            TRACE.end_session(addr, TRACE.session(addr))
+
+# Helper Function: validate one stage B datagram, returns its packet id or None
+# received is the id the next packet must carry
+def check_stage_b_packet(addr, data, length, received, expected_content, secretA):
+    if len(data) < HEADER_SIZE:
+        log.debug("Packet too short: %d bytes", len(data), extra={"session": addr})
+        FAILURES.inc("b", "header_mismatch")
+        return None
+
+    header, payload = Packet.parse(data)
+    if header[1] != secretA:
+        log.debug("Wrong secret: expected %d, got %d", secretA, header[1], extra={"session": addr})
+        FAILURES.inc("b", "wrong_secret")
+        return None
+
+    if len(payload) != length + 4:
+        log.debug("Invalid payload length: expected %d, got %d", length + 4, len(payload), extra={"session": addr})
+        FAILURES.inc("b", "header_mismatch")
+        return None
+
+    packet_id = PACKET_ID.unpack_from(payload)[0]  # Extract packet ID as int
+    content = payload[4:]
+
+    # a packet that was already acked, resent because the ack got lost
+    if packet_id < received and content == expected_content:
+        log.debug("Duplicate packet %d", packet_id, extra={"session": addr})
+        STAGE_B_DATAGRAMS.inc("duplicate")
+        return None
+
+    # a windowed client sent ahead of a packet that wasn't acked, it resends it
+    if packet_id > received and content == expected_content:
+        log.debug("Out of order packet %d, expected %d", packet_id, received, extra={"session": addr})
+        STAGE_B_DATAGRAMS.inc("out_of_order")
+        return None
+
+    # Verify packet ID and content
+    if content != expected_content or packet_id != received:
+        log.debug("Invalid packet content or wrong packet ID: expected ID %d, got %d", received, packet_id, extra={"session": addr})
+        FAILURES.inc("b", "bad_payload")
+        return None
+
+    return packet_id
+
+# Helper Function: randomly acknowledge packets and always acknowledge the last packet
+# the packets that are not acked get retransmitted by the client
+def should_ack(received, num):
+    ack = random.random() >= PROFILE.loss or received == num - 1
+    STAGE_B_DATAGRAMS.inc("acked" if ack else "dropped")
+    return ack
+
+# Helper Function: write the ack for packet_id into the ack buffer and return it
+def encode_ack(ack, secretA, packet_id):
+    Packet.encode_into(ack, 0, PACKET_ID.size, secretA, 2)
+    PACKET_ID.pack_into(ack, HEADER_SIZE, packet_id)
+    return ack
+
+# Helper Function: pick secretB and build the stage B response packet
+def make_stage_b_response(secretA, tcp_port):
     secretB = random_secret()
 
     response_payload = struct.pack('!II', tcp_port, secretB)
     packet = Packet(len(response_payload), secretA, 2, response_payload)
+    return secretB, packet.wrap_payload()
 
-    print(f"[{addr}] Stage B complete: received all {num} packets.")
-    print(f"[{addr}] Sending Stage B response: tcp_port={tcp_port}, secretB={secretB}")
-    udp_sock.sendto(packet.wrap_payload(), addr)
-    udp_sock.close()
-    return tcp_port, secretB
-
-def handle_stage_c(conn, secretB):
-    num2 = random_int()
-    len2 = random_length()
+# Helper Function: pick the stage C parameters and build the response packet
+def make_stage_c_response(secretB):
+    num2, len2 = PROFILE.stage_d()
     secretC = random_secret()
     c = random.choice(b'abcdefghijklmnopqrstuvwxyz')
     c_byte = bytes([c])  # Convert to bytes
@@ -141,72 +371,158 @@ def handle_stage_c(conn, secretB):
     payload = struct.pack('!IIIc', num2, len2, secretC, c_byte)
     packet = Packet(len(payload), secretB, 2, payload)
 
-    print(f"[TCP] Sending Stage C response: num2={num2}, len2={len2}, secretC={secretC}, c={chr(c)}")
-    conn.sendall(packet.wrap_payload())
+    log.info("Sending Stage C response: num2=%d, len2=%d, secretC=%d, c=%s", num2, len2, secretC, chr(c))
+    return packet.wrap_payload(), num2, len2, secretC, c_byte
+
+def handle_stage_c(conn, secretB):
+    response, num2, len2, secretC, c_byte = make_stage_c_response(secretB)
+    conn.sendall(response)
     return num2, len2, secretC, c_byte
 
-# Helper Function: keep receiving until the exact number of bytes is received (for TCP)
-def recv_exact(sock, num_bytes):
-    buf = b""
-    # Keep receiving until we have the exact number of bytes
-    while len(buf) < num_bytes:
-        chunk = sock.recv(num_bytes - len(buf))
-        if not chunk:
-            raise ConnectionError("Socket closed prematurely")
-        buf += chunk
-    return buf
+# Helper Function: pick secretD and build the stage D response packet
+def make_stage_d_response(secretC):
+    secretD = random_secret()
+    response_payload = struct.pack("!I", secretD)
+    return secretD, Packet(len(response_payload), secretC, 2, response_payload).wrap_payload()
 
 def handle_stage_d(conn, num2, len2, secretC, c):
+    # Packets are checked in place in the reader's buffer, a run of them at a
+    # time, without building any payload objects
+    batch_bytes = stage_d_batch_bytes(len2)
+    reader = PacketStreamReader(conn, batch_bytes, Packet.padded_size(len2))
+    validator = StageDValidator(len2, secretC, c, batch_bytes)
+    start_time = time.monotonic()
+
     try:
-        for i in range(num2):
-            # Receive header
-            header = recv_exact(conn, HEADER_SIZE)
-            payload_len, psecret, step, student_id = struct.unpack(HEADER_FORMAT, header)
-
-            # Verify header fields
-            if psecret != secretC or step != 1 or student_id != STUDENT_ID_LAST3:
-                print(f"[TCP] Stage D validation failed on header at packet {i}")
-                print(f"  Expected secretC: {secretC}, Received: {psecret}")
-                print(f"  Expected step: 1, Received: {step}")
-                print(f"  Expected student_id: {STUDENT_ID_LAST3}, Received: {student_id}")
+        while validator.checked < num2:
+            # check the next header before waiting for the rest of its packet
+            if not check_stage_d_header(validator.checked, reader.peek_header(), len2, secretC):
                 return
-
-            # Calculate the number of bytes to read to get the entire payload and receive it
-            pad_len = padded_length(payload_len)
-            full_payload = recv_exact(conn, pad_len)
-
-            # Extract only the real payload (the rest is padding)
-            payload = full_payload[:payload_len]
-
-            if payload != c * len2:
-                print(f"[TCP] Stage D content validation failed at packet {i}")
-                print(f"  Expected: {c * len2}, Received: {payload}")
+            first = validator.checked
+            offset, count = reader.read_frames(validator.frame, num2 - first)
+            if not validator.check(reader.buf, offset, count):
                 return
-
-            print(f"[TCP] Stage D packet {i} valid")
+            log.debug("Stage D packets %d-%d valid", first, first + count - 1)
 
         # If all packets were valid, create and send Stage D response
-        secretD = random_secret()
-        response_payload = struct.pack("!I", secretD)
-        response = Packet(len(response_payload), secretC, 2, response_payload).wrap_payload()
+        secretD, response = make_stage_d_response(secretC)
         conn.sendall(response)
-        print(f"[TCP] Stage D complete. Sent secretD: {secretD}")
+        STAGE_SECONDS.observe(time.monotonic() - start_time, "d")
+        SESSIONS.inc("completed")
+        log.info("Stage D complete. Sent secretD: %d", secretD)
     except Exception as e:
-        print(f"[TCP] Error in Stage D: {e}")
+        log.warning("Error in Stage D: %s", e)
+        FAILURES.inc("d", "error")
         conn.close()
 
+# Helper Function: how many bytes of stage D packets of len2 bytes to take in at once
+def stage_d_batch_bytes(len2):
+    return max(STAGE_D_BATCH_BYTES, STAGE_D_BATCH_PACKETS * Packet.padded_size(len2))
+
+class StageDValidator:
+    # Every valid stage D packet is the same bytes, so a run of packets is
+    # compared against a cached copy of that run in a single memcmp
+    # (bytearray.startswith takes an offset and doesn't copy the buffer)
+
+    def __init__(self, len2, secretC, c, batch_bytes):
+        self.frame = Packet.padded_size(len2)
+        self.header = Packet.HEADER_STRUCT.pack(len2, secretC, 1, STUDENT_ID_LAST3)
+        self.len2 = len2
+        self.secretC = secretC
+
+        # the padding is not part of the protocol check, so it is only used
+        # for the fast path and a mismatch there is looked at packet by packet
+        self.packet = self.header + c * len2
+        padded = self.packet + bytes(self.frame - len(self.packet))
+        self.run = memoryview(padded * max(1, batch_bytes // self.frame))
+        self.checked = 0  # packets validated so far
+
+    # validates count packets stored back to back in buf from offset
+    # prints where the first bad one went wrong and returns False
+    def check(self, buf, offset, count):
+        size = count * self.frame
+        if size <= len(self.run) and buf.startswith(self.run[:size], offset):
+            self.checked += count
+            return True
+
+        for i in range(count):
+            start = offset + i * self.frame
+            if not buf.startswith(self.packet, start):
+                self.report(buf, start, self.checked + i)
+                return False
+        self.checked += count
+        return True
+
+    def report(self, buf, start, i):
+        # binary search for the longest matching prefix, still without copying
+        expected = memoryview(self.packet)
+        low, high = 0, len(self.packet)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if buf.startswith(expected[:mid], start):
+                low = mid
+            else:
+                high = mid - 1
+
+        if low < HEADER_SIZE:
+            check_stage_d_header(i, Packet.HEADER_STRUCT.unpack_from(buf, start), self.len2, self.secretC)
+        else:
+            log.warning("Stage D content validation failed at packet %d, payload byte %d: expected %r, received %r",
+                        i, low - HEADER_SIZE, self.packet[low:low + 1], bytes(buf[start + low:start + low + 1]))
+            FAILURES.inc("d", "bad_payload")
+        log.warning("First bad byte at offset %d of the Stage D stream", i * self.frame + low)
+
+# Helper Function: verify the header of stage D packet i
+def check_stage_d_header(i, header, len2, secretC):
+    payload_len, psecret, step, student_id = header
+
+    # Verify header fields
+    if psecret != secretC or step != 1 or student_id != STUDENT_ID_LAST3:
+        log.warning("Stage D validation failed on header at packet %d: "
+                    "expected secretC=%d step=1 student_id=%d, received secretC=%d step=%d student_id=%d",
+                    i, secretC, STUDENT_ID_LAST3, psecret, step, student_id)
+        FAILURES.inc("d", "wrong_secret" if psecret != secretC else "header_mismatch")
+        return False
+
+    if payload_len != len2:
+        log.warning("Stage D content validation failed at packet %d: expected length %d, received %d",
+                    i, len2, payload_len)
+        FAILURES.inc("d", "header_mismatch")
+        return False
+
+    return True
+
+# the TCP port for addr's stages C and D, and with --tcp shared the
+# AcceptedConnection its connection will be handed to (None otherwise)
+def open_tcp_port(addr):
+    if LISTENERS is None:
+        return random_port(), None
+    accepted = listeners.AcceptedConnection()
+    return LISTENERS.expect(addr, accepted.set), accepted
+
+# waits for addr's connection on a shared listener
+def wait_shared_connection(addr, tcp_port, accepted):
+    start_time = time.monotonic()
+    conn = accepted.wait()
+    if conn is None:
+        log.warning("Timeout waiting for TCP connection on port %d", tcp_port, extra={"session": addr})
+        FAILURES.inc("accept", "timeout")
+        return None
+    STAGE_SECONDS.observe(time.monotonic() - start_time, "accept")
+    return conn
+
 def start_tcp_server(tcp_port):
-    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    tcp_sock.bind((HOST, tcp_port))
-    tcp_sock.listen(1)
+    tcp_sock = TRANSPORT.listen((HOST, tcp_port), 1)
 
+    start_time = time.monotonic()
     try:
         tcp_sock.settimeout(TIMEOUT)
         conn, _ = tcp_sock.accept()
         tcp_sock.close()
+        STAGE_SECONDS.observe(time.monotonic() - start_time, "accept")
         return conn
     except socket.timeout:
+        FAILURES.inc("accept", "timeout")
         tcp_sock.close()
         return None
 
@@ -218,39 +534,192 @@ def client_thread(data, addr, udp_sock):
     # udp_sock.bind((HOST, client_port))
     # udp_sock.settimeout(TIMEOUT)
 
-    stage_a = handle_stage_a(data, addr, udp_sock)
-    if not stage_a:
-        return
-    num, length, udp_port, secretA = stage_a
-
-    stage_b = handle_stage_b(addr, num, length, udp_port, secretA)
-    if not stage_b:
-        return
-    tcp_port, secretB = stage_b
-
-    conn = start_tcp_server(tcp_port)
+    if STAGE_B_PORTS is None:
+        stage_a = handle_stage_a(data, addr, udp_sock)
+        if not stage_a:
+            return
+        num, length, udp_port, secretA = stage_a
+
+        stage_b = handle_stage_b(addr, num, length, udp_port, secretA)
+    else:
+        if not check_stage_a(data, addr):
+            return
+        (num, length), secretA = PROFILE.stage_b(), random_secret()
+
+        if isinstance(STAGE_B_PORTS, PortPool):
+            stage_b = handle_stage_b_pool(udp_sock, addr, num, length, secretA)
+        else:
+            stage_b = handle_stage_b_shared(udp_sock, addr, num, length, secretA)
+    if stage_b:
+        handle_tcp_stages(addr, *stage_b)
+
+# stages C and D, on the TCP port sent in the Stage B response
+def handle_tcp_stages(addr, tcp_port, secretB, accepted=None):
+    if accepted is None:
+        conn = start_tcp_server(tcp_port)
+    else:
+        conn = wait_shared_connection(addr, tcp_port, accepted)
     if not conn:
         return
+    if TRACE:
+        conn = TRACE.wrap(conn, TRACE.session(addr), packet_trace.TCP, tcp_port)
 
+    start_time = time.monotonic()
     num2, len2, secretC, c = handle_stage_c(conn, secretB)
+    STAGE_SECONDS.observe(time.monotonic() - start_time, "c")
     handle_stage_d(conn, num2, len2, secretC, c)
     conn.close()
 
+# client_thread, forgetting the client's trace session once it is over
+def traced_client_thread(data, addr, udp_sock, session):
+    try:
+        client_thread(data, addr, udp_sock)
+    finally:
+        TRACE.end_session(addr, session)
+
 def start_udp_server():
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.bind((HOST, PORT))
-    print(f"[UDP] Listening on UDP port {PORT}")
+    udp_sock = TRANSPORT.datagram((HOST, PORT), REUSE_PORT)
+    log.info("Listening on UDP port %d", PORT)
 
     while True:
         try:
             udp_sock.settimeout(TIMEOUT)
             data, addr = udp_sock.recvfrom(RECV_SIZE)  # Corrected to use recvfrom
-            print(f"[UDP] Received data from {addr} ({len(data)} bytes)")
-            if data:
+            log.debug("Received %d bytes", len(data), extra={"session": addr})
+            if data and COOKIES:
+                # answered right here, without a thread, and traced under a
+                # session nothing keeps: it is only kept for addr once a
+                # valid stage B packet starts the real session
+                session = 0
+                if TRACE:
+                    session = TRACE.new_session()
+                    TRACE.record(session, packet_trace.RECV, packet_trace.UDP, PORT, data)
+                handle_stage_a_stateless(data, addr, udp_sock, session)
+            elif data and TRACE:
+                session = TRACE.start_session(addr)
+                TRACE.record(session, packet_trace.RECV, packet_trace.UDP, PORT, data)
+                thread = threading.Thread(target=traced_client_thread, args=(data, addr, udp_sock, session))
+                thread.start()
+            elif data:
                 thread = threading.Thread(target=client_thread, args=(data, addr, udp_sock))
                 thread.start()
         except socket.timeout:
             continue
 
+# the numeric fields of the port pool or shared sockets' occupancy, for the metrics
+def stage_b_occupancy():
+    occupancy = STAGE_B_PORTS.occupancy()
+    return {(state,): value for state, value in occupancy.items() if isinstance(value, int)}
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="CSE 461 project 1 server")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="threads: one thread per client (default), "
+                             "asyncio: every client on one event loop")
+    parser.add_argument("--stage-b", choices=["bind", "pool", "shared"], default="bind",
+                        help="bind: bind a random port per client (default), "
+                             "pool: per-client ports from a pool that never hands out a bound port, "
+                             "shared: a few shared sockets demultiplexed by client and secret")
+    parser.add_argument("--shared-ports", type=int, default=4,
+                        help="number of sockets for --stage-b shared")
+    parser.add_argument("--tcp", choices=["listen", "shared"], default="listen",
+                        help="listen: listen on a new TCP port per client (default), "
+                             "shared: a few long-lived listeners, connections matched to sessions by client address")
+    parser.add_argument("--tcp-listeners", type=int, default=4,
+                        help="number of listeners for --tcp shared")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="run this many server processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--transport", choices=["inet", "unix"], default="inet",
+                        help="inet: UDP and TCP sockets (default), "
+                             "unix: Unix domain sockets in --unix-dir (threads engine only)")
+    parser.add_argument("--unix-dir", default=None,
+                        help="directory for the --transport unix socket files (default: /tmp/cse461-unix)")
+    parser.add_argument("--profile", type=profiles.parse, default="classic",
+                        help="stage B and D sizes: classic (default), mtu, bulk, max or "
+                             "num=LOW-HIGH,len=...,num2=...,len2=...,loss=P, see profiles.py")
+    parser.add_argument("--stateless", action="store_true",
+                        help="stage A keeps no state: the stage B parameters come from a keyed MAC of the "
+                             "client address (cookies.py), needs --stage-b shared")
+    parser.add_argument("--drain", action="store_true",
+                        help="stage B takes every queued datagram at once (recvmmsg on Linux) "
+                             "and sends their acks together (threads engine only)")
+    parser.add_argument("--trace", default=None,
+                        help="append every packet sent and received to this binary trace (threads engine only)")
+    jsonlog.add_arguments(parser)
+    metrics.add_arguments(parser)
+    return parser
+
+# sets the server up from the parsed command line
+# port_range limits the ports a stage B pool hands out, as (low, high)
+def configure(args, port_range=(1024, 65535)):
+    global HOST, PORT, STAGE_B_PORTS, TRANSPORT, TRACE, PROFILE, DRAIN, COOKIES, LISTENERS
+
+    HOST = args.host
+    PORT = args.port
+    PROFILE = args.profile
+    DRAIN = args.drain
+    TRANSPORT = transport.get(args.transport, args.unix_dir)
+    if args.trace:
+        TRACE = packet_trace.TraceWriter(args.trace, packet_trace.SERVER)
+    jsonlog.setup_logging("server", args.log_level, args.log_file, args.log_sample, args.log_rate)
+    log.info("Profile %s", PROFILE)
+
+    if args.stage_b == "pool":
+        STAGE_B_PORTS = PortPool(HOST, *port_range)
+    elif args.stage_b == "shared":
+        STAGE_B_PORTS = SharedStageB(HOST, args.shared_ports, TIMERS)
+        log.info("Shared Stage B ports: %s", STAGE_B_PORTS.ports)
+        if args.stateless:
+            COOKIES = cookies.CookieJar(PROFILE, STAGE_B_PORTS.ports)
+        if args.engine == "threads":
+            STAGE_B_PORTS.start_session = start_stateless_session
+            STAGE_B_PORTS.start_threads()
+
+    if args.tcp == "shared":
+        LISTENERS = listeners.SharedListeners(HOST, args.tcp_listeners, TIMERS)
+        log.info("Shared TCP ports: %s", LISTENERS.ports)
+        if args.engine == "threads":
+            LISTENERS.start_threads()
+        METRICS.gauge("cse461_tcp_waiting", "Sessions waiting for their connection on a shared TCP listener",
+                      (), lambda: {(): LISTENERS.occupancy()["waiting"]})
+
+    METRICS.gauge("cse461_timers_pending", "Timers armed on the timing wheel", (),
+                  lambda: {(): TIMERS.pending})
+    if STAGE_B_PORTS is not None:
+        METRICS.gauge("cse461_stage_b_ports", "Stage B port occupancy", ("state",), stage_b_occupancy)
+
+def serve(engine):
+    if engine == "asyncio":
+        import async_server
+        async_server.run(HOST, PORT)
+    else:
+        TIMERS.start()
+        start_udp_server()
+
+def main():
+    parser = make_parser()
+    args = parser.parse_args()
+    if args.transport != "inet" and (args.engine != "threads" or args.workers > 1):
+        parser.error("--transport unix needs --engine threads and a single worker")
+    if args.trace and (args.engine != "threads" or args.workers > 1):
+        parser.error("--trace needs --engine threads and a single worker")
+    if args.drain and args.engine != "threads":
+        parser.error("--drain needs --engine threads")
+    if args.stateless and args.stage_b != "shared":
+        parser.error("--stateless needs --stage-b shared")
+    if args.workers > 1:
+        import sharded
+        sharded.run(args)
+        return
+
+    configure(args)
+    metrics.setup(METRICS, HOST, args)
+    if TRACE:
+        # exit normally on kill too, so the end of the trace gets written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serve(args.engine)
+
 if __name__ == "__main__":
-    start_udp_server()
+    main()
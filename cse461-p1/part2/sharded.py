@@ -0,0 +1,161 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import jsonlog
+import metrics
+import server
+
+# Sharded server: --workers N runs N server processes that all bind the stage
+# A port with SO_REUSEPORT, so the kernel spreads clients over them (by a hash
+# of the client's address, a client always reaches the same worker) and
+# stage A parsing and session setup run on N cores instead of under one GIL.
+#
+# A worker handles its sessions start to end: the stage B and TCP ports it
+# hands out are bound in that worker, so all follow-up traffic reaches it.
+# With --stage-b pool every worker gets its own slice of the port range.
+#
+# The supervisor (this process) only restarts workers that die and adds up
+# the metrics they report, which it serves with --metrics-port/--metrics-file.
+
+log = logging.getLogger("server")
+
+# how often workers send their metrics, and the supervisor checks on them
+REPORT_INTERVAL = 1
+# a worker that dies sooner than this after starting is restarted with a delay
+MIN_UPTIME = 1
+
+
+# the part of the stage B pool port range worker index gets
+def port_slice(index, workers, low=1024, high=65535):
+    size = (high - low + 1) // workers
+    start = low + index * size
+    end = high if index == workers - 1 else start + size - 1
+    return start, end
+
+
+def worker_main(index, args, reports):
+    server.REUSE_PORT = True
+    server.configure(args, port_slice(index, args.workers))
+    log.info("Worker %d (pid %d) starting", index, os.getpid())
+
+    parent = os.getppid()
+    thread = threading.Thread(target=report_loop, args=(index, parent, reports), daemon=True)
+    thread.start()
+    server.serve(args.engine)
+
+
+def report_loop(index, parent, reports):
+    while True:
+        time.sleep(REPORT_INTERVAL)
+        # don't outlive the supervisor
+        if os.getppid() != parent:
+            os._exit(1)
+        reports.put((index, server.METRICS.snapshot()))
+
+
+class Supervisor:
+
+    def __init__(self, args):
+        self.args = args
+        # spawn instead of fork, the supervisor has threads running
+        self.context = multiprocessing.get_context("spawn")
+        self.reports = self.context.Queue()
+        self.workers = [None] * args.workers
+        self.started = [0.0] * args.workers
+        self.restarts = [0] * args.workers
+
+        self.lock = threading.Lock()
+        self.latest = {}     # worker index -> last metrics snapshot
+        self.retired = None  # snapshots of dead workers, added up
+
+    def start_worker(self, index):
+        process = self.context.Process(
+            target=worker_main, args=(index, self.args, self.reports), name=f"worker-{index}", daemon=True
+        )
+        process.start()
+        self.workers[index] = process
+        self.started[index] = time.monotonic()
+
+    def run(self):
+        for index in range(len(self.workers)):
+            self.start_worker(index)
+        log.info("Started %d workers on UDP port %d", len(self.workers), self.args.port)
+
+        thread = threading.Thread(target=self.collect, daemon=True)
+        thread.start()
+
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            for index, process in enumerate(self.workers):
+                if process.is_alive():
+                    continue
+                log.warning("Worker %d (pid %d) exited with %s, restarting",
+                            index, process.pid, process.exitcode)
+                self.retire(index)
+                if time.monotonic() - self.started[index] < MIN_UPTIME:
+                    # crashing right away, don't spin
+                    time.sleep(MIN_UPTIME)
+                self.restarts[index] += 1
+                self.start_worker(index)
+
+    def collect(self):
+        while True:
+            try:
+                index, snapshot = self.reports.get()
+            except (EOFError, OSError):
+                return
+            with self.lock:
+                self.latest[index] = snapshot
+
+    # keeps the counts of a dead worker, so totals don't go backwards
+    # its gauges described the worker's state and go with it
+    def retire(self, index):
+        with self.lock:
+            snapshot = self.latest.pop(index, None)
+            if snapshot is not None:
+                snapshot = [entry for entry in snapshot if entry[0] != "gauge"]
+                retired = [self.retired] if self.retired else []
+                self.retired = metrics.combine(retired + [snapshot]).snapshot()
+
+    def render(self):
+        with self.lock:
+            snapshots = list(self.latest.values())
+            if self.retired:
+                snapshots.append(self.retired)
+        combined = metrics.combine(snapshots)
+
+        alive = sum(process.is_alive() for process in self.workers)
+        combined.gauge("cse461_workers", "Worker processes", ("state",),
+                       lambda: {("alive",): alive, ("configured",): len(self.workers)})
+        restarts = combined.counter("cse461_worker_restarts_total", "Worker processes restarted", ("worker",))
+        for index, count in enumerate(self.restarts):
+            restarts.inc(str(index), amount=count)
+        return combined.render()
+
+    def stop(self):
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            if process is not None:
+                process.join()
+
+
+def run(args):
+    jsonlog.setup_logging("server", args.log_level, args.log_file, args.log_sample, args.log_rate)
+    supervisor = Supervisor(args)
+    # serve_http and dump_periodically only need render()
+    metrics.setup(supervisor, args.host, args)
+
+    # stop the workers on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+
+# Hashed timing wheel for session timeouts
+#
+# Time is cut into ticks and the wheel has one slot per tick, wrapping around.
+# A timer lands in the slot of the tick it expires in, so arming and
+# cancelling are a set add/discard no matter how many timers are pending.
+# Every tick only the timers in that one slot are looked at; timers that are
+# more than one lap away simply stay there until their lap comes around.
+
+log = logging.getLogger("server")
+
+
+class Timer:
+    __slots__ = ("expires", "callback", "args", "slot")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires  # absolute tick number
+        self.callback = callback
+        self.args = args
+        self.slot = None        # set the timer is stored in, None once done
+
+
+class TimingWheel:
+
+    def __init__(self, tick=0.05, slots=256):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.start_time = time.monotonic()
+        self.current = 0  # last tick that was processed
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    # calls callback(*args) after delay seconds (rounded up to the next tick)
+    def schedule(self, delay, callback, *args):
+        with self.lock:
+            ticks = max(1, -int(-delay // self.tick))
+            timer = Timer(self.current + ticks, callback, args)
+            timer.slot = self.slots[timer.expires % len(self.slots)]
+            timer.slot.add(timer)
+            self.pending += 1
+            return timer
+
+    # stops timer from firing, safe to call on a timer that already fired
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self.pending -= 1
+
+    # processes every tick up to now and runs the callbacks that expired
+    def advance(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self.start_time) / self.tick)
+
+        expired = []
+        with self.lock:
+            # after a long stall one lap covers every slot
+            if target - self.current > len(self.slots):
+                self.current = target - len(self.slots)
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                for timer in [t for t in slot if t.expires <= self.current]:
+                    slot.discard(timer)
+                    timer.slot = None
+                    expired.append(timer)
+            self.pending -= len(expired)
+
+        # callbacks run outside the lock so they can schedule new timers
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                log.exception("Error in timer callback: %s", e)
+        return len(expired)
+
+    # drives the wheel from a background thread
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
+
+
+class IdleTimer:
+    # fires callback(*args) once touch() was not called for timeout seconds
+    # touching is only a timestamp write; the wheel timer is re-armed lazily
+    # when it fires early, instead of on every packet
+
+    def __init__(self, wheel, timeout, callback, *args):
+        self.wheel = wheel
+        self.timeout = timeout
+        self.callback = callback
+        self.args = args
+        self.last_activity = time.monotonic()
+        self.cancelled = False
+        self.timer = wheel.schedule(timeout, self.check)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def check(self):
+        if self.cancelled:
+            return
+        remaining = self.last_activity + self.timeout - time.monotonic()
+        if remaining > 0:
+            self.timer = self.wheel.schedule(remaining, self.check)
+            return
+        self.cancelled = True
+        self.callback(*self.args)
+
+    def cancel(self):
+        self.cancelled = True
+        self.wheel.cancel(self.timer)
@@ -0,0 +1,446 @@
+import errno
+import itertools
+import os
+import queue
+import random
+import socket
+import threading
+
+# Where the server and client get their sockets from
+#
+# Every backend hands out objects with the subset of the socket API the
+# stages use (sendto/recvfrom_into for datagrams, sendall/recv_into for
+# streams, settimeout, close, ...) and takes (host, port) addresses, so the
+# protocol code doesn't know which one it runs on:
+#
+#   inet    real UDP and TCP sockets (the default)
+#   unix    Unix domain sockets, one file per port in a directory
+#   memory  queues inside one process, for benchmarks without a network stack
+#
+#   transport = get("memory")
+#   sock = transport.datagram(("localhost", 12235))   # bound to the port
+#   listener = transport.listen(("localhost", 4000), 1)
+#   conn = transport.connect(("localhost", 4000), timeout=3)
+
+# where unbound and port 0 endpoints get their ports from
+EPHEMERAL_PORTS = (49152, 65535)
+
+
+class SocketTransport:
+    name = "inet"
+
+    # a UDP socket, bound to addr unless it is None
+    def datagram(self, addr=None, reuse_port=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if addr is not None:
+                sock.bind(addr)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def listen(self, addr, backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(addr)
+            sock.listen(backlog)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def connect(self, addr, timeout):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(addr)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+class UnixTransport:
+    # port p is the socket file udp-p or tcp-p in directory; the host is ignored
+    name = "unix"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, kind, port):
+        return os.path.join(self.directory, f"{kind}-{port}")
+
+    def datagram(self, addr=None, reuse_port=False):
+        return UnixDatagram(self, addr)
+
+    def listen(self, addr, backlog):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        port = addr[1]
+        try:
+            if port:
+                path = self.path("tcp", port)
+                bind_path(sock, path, socket.SOCK_STREAM)
+            else:
+                port, path = bind_any(sock, lambda port: self.path("tcp", port))
+            sock.listen(backlog)
+        except OSError:
+            sock.close()
+            raise
+        return UnixListener(sock, path, (addr[0], port))
+
+    def connect(self, addr, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path("tcp", addr[1]))
+        except FileNotFoundError:
+            # nobody listening on that port
+            sock.close()
+            raise ConnectionRefusedError(errno.ECONNREFUSED, "Connection refused") from None
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+class UnixDatagram:
+    # a Unix datagram socket that takes (host, port) destinations
+    # replies go to whatever address recvfrom returned, which is passed through
+
+    def __init__(self, transport, addr):
+        self.transport = transport
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.path = None
+        self.addr = None
+        if addr is not None:
+            self.bind(addr)
+
+    def bind(self, addr):
+        host, port = addr
+        if port:
+            path = self.transport.path("udp", port)
+            try:
+                bind_path(self.sock, path, socket.SOCK_DGRAM)
+            except OSError:
+                self.sock.close()
+                raise
+        else:
+            try:
+                port, path = bind_any(self.sock, lambda port: self.transport.path("udp", port))
+            except OSError:
+                self.sock.close()
+                raise
+        self.path = path
+        self.addr = (host, port)
+
+    def sendto(self, data, addr):
+        if self.path is None:
+            # an empty name binds a unique abstract address (Linux), enough
+            # for the server to reply to
+            self.sock.bind("")
+            self.path = ""
+        if isinstance(addr, tuple):
+            addr = self.transport.path("udp", addr[1])
+        try:
+            return self.sock.sendto(data, addr)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # nothing bound there (yet): dropped, as UDP would
+            return len(data)
+
+    def recvfrom_into(self, buf, nbytes=0):
+        return self.sock.recvfrom_into(buf, nbytes)
+
+    def recvfrom(self, bufsize):
+        return self.sock.recvfrom(bufsize)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockname(self):
+        return self.addr
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+        if self.path:
+            remove(self.path)
+            self.path = None
+
+
+class UnixListener:
+
+    def __init__(self, sock, path, addr):
+        self.sock = sock
+        self.path = path
+        self.addr = addr
+
+    def accept(self):
+        return self.sock.accept()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def getsockname(self):
+        return self.addr
+
+    def close(self):
+        self.sock.close()
+        remove(self.path)
+
+
+# binds sock to the path_of(port) of a free ephemeral port, returns both
+def bind_any(sock, path_of):
+    low, high = EPHEMERAL_PORTS
+    for _ in range(100):
+        port = random.randint(low, high)
+        path = path_of(port)
+        try:
+            sock.bind(path)
+            return port, path
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+    raise OSError(errno.EADDRINUSE, "no free Unix port")
+
+
+# binds sock to path, taking over the file of a socket nobody has open any
+# more (left behind by a process that was killed)
+def bind_path(sock, path, kind):
+    try:
+        sock.bind(path)
+        return
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+    probe = socket.socket(socket.AF_UNIX, kind)
+    try:
+        probe.connect(path)
+        raise OSError(errno.EADDRINUSE, "Address already in use")
+    except ConnectionRefusedError:
+        remove(path)
+    finally:
+        probe.close()
+    sock.bind(path)
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class MemoryTransport:
+    # endpoints are registered by port in this object; datagrams are put
+    # straight into the receiver's queue and streams are pairs of Pipes
+    name = "memory"
+
+    # datagrams queued per endpoint before new ones are dropped, like a full
+    # socket receive buffer
+    QUEUE_SIZE = 4096
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.datagrams = {}  # port -> MemoryDatagram
+        self.listeners = {}  # port -> MemoryListener
+        self.ephemeral = itertools.cycle(range(EPHEMERAL_PORTS[0], EPHEMERAL_PORTS[1] + 1))
+
+    def register(self, table, port, endpoint):
+        with self.lock:
+            if not port:
+                # the whole ephemeral range taken would loop forever, like
+                # running out of ports on a real host
+                port = next(p for p in self.ephemeral if p not in table)
+            elif port in table:
+                raise OSError(errno.EADDRINUSE, "Address already in use")
+            table[port] = endpoint
+            return port
+
+    def unregister(self, table, port, endpoint):
+        with self.lock:
+            if table.get(port) is endpoint:
+                del table[port]
+
+    def datagram(self, addr=None, reuse_port=False):
+        sock = MemoryDatagram(self)
+        if addr is not None:
+            sock.bind(addr)
+        return sock
+
+    def listen(self, addr, backlog):
+        listener = MemoryListener(self)
+        port = self.register(self.listeners, addr[1], listener)
+        listener.addr = (addr[0], port)
+        return listener
+
+    def connect(self, addr, timeout):
+        listener = self.listeners.get(addr[1])
+        if listener is None:
+            raise ConnectionRefusedError(errno.ECONNREFUSED, "Connection refused")
+        to_server, to_client = Pipe(), Pipe()
+        client = MemoryStream(to_server, to_client)
+        client.settimeout(timeout)
+        listener.pending.put((MemoryStream(to_client, to_server), ("memory", 0)))
+        return client
+
+
+class MemoryDatagram:
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.queue = queue.Queue(transport.QUEUE_SIZE)
+        self.timeout = None
+        self.addr = None
+
+    def bind(self, addr):
+        port = self.transport.register(self.transport.datagrams, addr[1], self)
+        self.addr = (addr[0], port)
+
+    def sendto(self, data, addr):
+        if self.addr is None:
+            self.bind(("memory", 0))
+        peer = self.transport.datagrams.get(addr[1])
+        if peer is not None:
+            try:
+                peer.queue.put_nowait((bytes(data), self.addr))
+            except queue.Full:
+                pass
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        try:
+            data, addr = self.queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout("timed out") from None
+        return data[:bufsize], addr
+
+    def recvfrom_into(self, buf, nbytes=0):
+        data, addr = self.recvfrom(nbytes or len(buf))
+        buf[:len(data)] = data
+        return len(data), addr
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockname(self):
+        return self.addr
+
+    def close(self):
+        if self.addr is not None:
+            self.transport.unregister(self.transport.datagrams, self.addr[1], self)
+
+
+class MemoryListener:
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.pending = queue.Queue()
+        self.timeout = None
+        self.addr = None
+
+    def accept(self):
+        try:
+            return self.pending.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout("timed out") from None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def getsockname(self):
+        return self.addr
+
+    def close(self):
+        self.transport.unregister(self.transport.listeners, self.addr[1], self)
+
+
+class Pipe:
+    # one direction of an in-memory stream
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def write(self, data):
+        with self.ready:
+            if self.closed:
+                raise BrokenPipeError(errno.EPIPE, "Broken pipe")
+            self.buf += data
+            self.ready.notify()
+
+    # copies up to len(view) bytes into view, 0 once closed and drained
+    def read_into(self, view, timeout):
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.buf or self.closed, timeout):
+                raise socket.timeout("timed out")
+            n = min(len(view), len(self.buf))
+            view[:n] = self.buf[:n]
+            del self.buf[:n]
+            return n
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+
+class MemoryStream:
+
+    def __init__(self, send_pipe, recv_pipe):
+        self.send_pipe = send_pipe
+        self.recv_pipe = recv_pipe
+        self.timeout = None
+
+    def sendall(self, data):
+        self.send_pipe.write(data)
+
+    def send(self, data):
+        self.send_pipe.write(data)
+        return len(data)
+
+    def recv_into(self, buf, nbytes=0):
+        view = memoryview(buf)
+        return self.recv_pipe.read_into(view[:nbytes] if nbytes else view, self.timeout)
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        return bytes(buf[:self.recv_into(buf)])
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        # the other end reads EOF
+        self.send_pipe.close()
+        self.recv_pipe.close()
+
+
+SOCKETS = SocketTransport()
+
+
+# returns the backend called name ("inet", "unix" or "memory")
+def get(name, unix_dir=None):
+    if name == "inet":
+        return SOCKETS
+    if name == "unix":
+        return UnixTransport(unix_dir or os.path.join("/tmp", "cse461-unix"))
+    if name == "memory":
+        return MemoryTransport()
+    raise ValueError(f"unknown transport {name!r}")
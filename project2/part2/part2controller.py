@@ -6,8 +6,32 @@
 from pox.core import core
 import pox.openflow.libopenflow_01 as of
 
+# policy.py and flows.py sit next to this file, in pox/ext or in a package
+# like pox/misc
+try:
+    from .flows import get_installer
+    from .policy import Policy
+except ImportError:
+    from flows import get_installer
+    from policy import Policy
+
 log = core.getLogger()
 
+IPS = {
+    "h1": "10.0.1.2",
+    "h2": "10.0.0.2",
+    "h3": "10.0.0.3",
+    "h4": "10.0.1.3",
+}
+
+# icmp within the h1 h4 and h2 h3 subnets, all other ipv4 is dropped
+POLICY = [
+    "h1 may send icmp to h4",
+    "h4 may send icmp to h1",
+    "h2 may send icmp to h3",
+    "h3 may send icmp to h2",
+]
+
 class Firewall(object):
     """
     A Firewall object is created for each switch that connects.
@@ -18,47 +42,42 @@ class Firewall(object):
         # Keep track of the connection to the switch so that we can
         # send it messages!
         self.connection = connection
+        # the switch's rules, sent all at once when they are all set up
+        self.rules = []
+        self.installer = get_installer()
 
         # This binds our PacketIn event listener
         connection.addListeners(self)
 
         # add switch rules here
-        h1_ip = "10.0.1.2"
-        h2_ip = "10.0.0.2"
-        h3_ip = "10.0.0.3"
-        h4_ip = "10.0.1.3"
-
-        # allow icmp traffic in h1 h4 subnet
-        self.add_rule(0x800, 100, 1, h1_ip, h4_ip)
-        self.add_rule(0x800, 100, 1, h4_ip, h1_ip)
-
-        # allow icmp traffic in h2 h3 subnet
-        self.add_rule(0x800, 100, 1, h2_ip, h3_ip)
-        self.add_rule(0x800, 100, 1, h3_ip, h2_ip)
+        policy = Policy(IPS, POLICY, of.OFPP_FLOOD, default="deny")
+        rules = policy.compile()
+        log.info(policy.report(policy.naive(), rules))
+        for rule in rules:
+            self.add_rule(0x800, rule.priority, rule.proto, rule.src, rule.dst, rule.port)
 
         # allow arp traffic
-        self.add_rule(0x806, 100)
+        self.add_rule(0x806, 100, port=of.OFPP_FLOOD)
 
-        # drop all other ipv4
-        self.add_rule(0x800, 0)
-        
-    def add_rule(self, dl_type, priority, proto=None, src=None, dst=None):
+        self.installer.install(connection, self.rules)
+
+    def add_rule(self, dl_type, priority, proto=None, src=None, dst=None, port=None):
         rule = of.ofp_flow_mod()
         rule.priority = priority
         rule.match.dl_type = dl_type
 
         if proto is not None:
             rule.match.nw_proto = proto
-
-        if src is not None and dst is not None:
-            # icmp
+        if src is not None:
             rule.match.nw_src = src
+        if dst is not None:
             rule.match.nw_dst = dst
 
-        if priority > 0:
-            rule.actions.append(of.ofp_action_output(port=of.OFPP_FLOOD))
+        # no port drops
+        if port is not None:
+            rule.actions.append(of.ofp_action_output(port=port))
 
-        self.connection.send(rule)
+        self.rules.append(rule)
 
 
     def _handle_PacketIn(self, event):
@@ -67,6 +86,10 @@ class Firewall(object):
         forwarded to this method to be handled by the controller
         """
 
+        # came in before the rules for it, it goes through them once they are
+        if self.installer.hold(event):
+            return
+
         packet = event.parsed  # This is the parsed packet data.
         if not packet.parsed:
             log.warning("Ignoring incomplete packet")
@@ -7,6 +7,15 @@ from pox.core import core
 import pox.openflow.libopenflow_01 as of
 from pox.lib.addresses import IPAddr, IPAddr6, EthAddr
 
+# policy.py and flows.py sit next to this file, in pox/ext or in a package
+# like pox/misc
+try:
+    from .flows import get_installer
+    from .policy import Policy
+except ImportError:
+    from flows import get_installer
+    from policy import Policy
+
 log = core.getLogger()
 
 # Convenience mappings of hostnames to ips
@@ -27,6 +36,13 @@ SUBNETS = {
     "hnotrust": "172.16.10.0/24",
 }
 
+# what the core switch lets through, everything else between the hosts is
+# allowed (see policy.py)
+POLICY = [
+    "hnotrust may not send icmp",
+    "hnotrust may not reach serv1",
+]
+
 
 class Part3Controller(object):
     """
@@ -38,6 +54,9 @@ class Part3Controller(object):
         # Keep track of the connection to the switch so that we can
         # send it messages!
         self.connection = connection
+        # the switch's rules, sent all at once when they are all set up
+        self.rules = []
+        self.installer = get_installer()
 
         # This binds our PacketIn event listener
         connection.addListeners(self)
@@ -55,6 +74,7 @@ class Part3Controller(object):
         else:
             print("UNKNOWN SWITCH")
             exit(1)
+        self.installer.install(connection, self.rules)
 
     
     def add_rule(self, dl_type=None, priority=0, proto=None, src=None, dst=None, port=None):
@@ -73,7 +93,7 @@ class Part3Controller(object):
         if port is not None:
             rule.actions.append(of.ofp_action_output(port=port))
         
-        self.connection.send(rule)
+        self.rules.append(rule)
 
     def setup(self):
         # allow all traffic
@@ -97,47 +117,19 @@ class Part3Controller(object):
         # handle ARP
         self.add_rule(dl_type=0x806, priority=200, port=of.OFPP_FLOOD)
 
-        # block hnotrust from sending IP to serv1
-        self.add_rule(dl_type=0x800, priority=100, src=IPS["hnotrust"], dst=IPS["serv1"])
-
-        # block hnotrust from sending all ICMP
-        self.add_rule(dl_type=0x800, priority=100, proto=1, src=IPS["hnotrust"])
-
-        # let serv1 communicate with hnotrust
-        self.add_rule(
-            dl_type=0x800,
-            priority=100, 
-            src=IPS["serv1"], 
-            dst=IPS["hnotrust"], 
-            port=ports["hnotrust"]
-        )
-
-        # otherwise allow all traffic between trusted hosts
-        internal_hosts = ["h10", "h20", "h30", "serv1"]
-        for src in internal_hosts:
-            for dst in internal_hosts:
-                if src != dst:
-                    self.add_rule(
-                        dl_type=0x800,
-                        priority=50,
-                        src=IPS[src],
-                        dst=IPS[dst],
-                        port=ports[dst]
-                    )
-
-        # allow communication between regular hosts and hnotrust
-        for host in internal_hosts[:3]:
+        # IP traffic goes out of its destination's port, compiled from POLICY
+        # into a few subnet rules instead of one per pair of hosts
+        policy = Policy(IPS, POLICY, ports, subnets=SUBNETS)
+        rules = policy.compile()
+        log.info(policy.report(policy.naive(), rules))
+        for rule in rules:
             self.add_rule(
                 dl_type=0x800,
-                priority=50,
-                src=IPS["hnotrust"],
-                dst=IPS[host],
-                port=ports[host]
-            )
-            self.add_rule(
-                dl_type=0x800, priority=50,
-                src=IPS[host], dst=IPS["hnotrust"],
-                port=ports["hnotrust"]
+                priority=rule.priority,
+                proto=rule.proto,
+                src=rule.src,
+                dst=rule.dst,
+                port=rule.port
             )
 
     def dcs31_setup(self):
@@ -160,6 +152,10 @@ class Part3Controller(object):
         forwarded to this method to be handled by the controller
         """
 
+        # came in before the rules for it, it goes through them once they are
+        if self.installer.hold(event):
+            return
+
         packet = event.parsed  # This is the parsed packet data.
         if not packet.parsed:
             log.warning("Ignoring incomplete packet")
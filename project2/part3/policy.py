@@ -0,0 +1,427 @@
+# Policy compiler for the IPv4 flow tables of the Mininet-SDN project
+#
+# The policy is a list of statements over the host names of an IPS map,
+# earlier statements win over later ones, and whatever no statement covers
+# gets the default (allow or deny):
+#
+#   "hnotrust may not send icmp"         hnotrust's ICMP to anyone is dropped
+#   "hnotrust may not reach serv1"       all of hnotrust's IP traffic to serv1
+#   "h1 may send icmp to h4"             allowed traffic goes to the outputs
+#                                        port of its destination
+#
+# The naive table has one exact src/dst rule per host pair (plus one per
+# protocol that is treated differently for the pair). compile() builds a
+# much smaller one instead:
+#   - every statement becomes one rule with wildcards for what it leaves
+#     out, at a priority above the statements after it (priority layering)
+#   - allowed traffic is routed by destination only, with the destinations
+#     of one output port aggregated into as few subnet prefixes as possible;
+#     a source wildcard is safe because the denials sit above it
+#   - rules are merged into common prefixes and redundant ones dropped, but
+#     only when the table still decides every host pair the same way
+# check() compares the two tables on every (src, dst, protocol) between the
+# hosts. Addresses that are not in IPS are outside the policy, the compiled
+# table may route them where the naive one sends them to the controller.
+#
+# Compiling runs in the controller's ConnectionUp handler, so it has to stay
+# fast as hosts are added: merge() scans the rules once, only tries pairs
+# that could merge at all, and every check goes through a Table that only
+# looks at the rules covering the flow's destination.
+#
+#   python3 policy.py [hosts]    compiles a made-up policy for that many
+#                                hosts and checks how long it takes
+#
+# This file is part3/policy.py, copied as is into part2/: edit part3's and
+# copy it over.
+
+import bisect
+import ipaddress
+import itertools
+import sys
+import time
+
+PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17}
+# a protocol the policy doesn't name, to check traffic of all the others
+OTHER = 255
+
+# most seconds compiling the policy of CHECK_HOSTS hosts may take, see main()
+CHECK_HOSTS = 100
+CHECK_BUDGET = 1.0
+
+ALLOW_PRIORITY = 50   # the default layer and naive per-pair rules
+TOP_PRIORITY = 100    # the first statement, the next ones go below it
+
+
+class Rule(object):
+    # src and dst are prefix strings like "10.0.1.0/24" or None for any,
+    # proto is an IP protocol number or None, port None drops
+
+    def __init__(self, priority, src=None, dst=None, proto=None, port=None):
+        self.priority = priority
+        self.src = src
+        self.dst = dst
+        self.proto = proto
+        self.port = port
+        self.src_net = ipaddress.ip_network(src) if src else None
+        self.dst_net = ipaddress.ip_network(dst) if dst else None
+
+    def matches(self, src, dst, proto):
+        return ((self.src_net is None or src in self.src_net)
+                and (self.dst_net is None or dst in self.dst_net)
+                and (self.proto is None or proto == self.proto))
+
+    def __repr__(self):
+        action = "drop" if self.port is None else "output:%s" % (self.port,)
+        return "Rule(priority=%d, src=%s, dst=%s, proto=%s, %s)" % (
+            self.priority, self.src or "*", self.dst or "*", "*" if self.proto is None else self.proto, action)
+
+
+class Statement(object):
+
+    def __init__(self, text, allow, src=None, dst=None, proto=None):
+        self.text = text
+        self.allow = allow
+        self.src = src      # host name, None for any
+        self.dst = dst
+        self.proto = proto  # protocol number, None for all IP
+
+    def matches(self, src, dst, proto):
+        return ((self.src is None or src == self.src)
+                and (self.dst is None or dst == self.dst)
+                and (self.proto is None or proto == self.proto))
+
+
+# parses "<src> may [not] reach <dst>" or "<src> may [not] send <proto> [to <dst>]"
+# where hosts are names from hosts or "any"
+def parse_statement(text, hosts):
+    words = text.lower().split()
+
+    def host(word):
+        if word == "any":
+            return None
+        for name in hosts:
+            if name.lower() == word:
+                return name
+        raise ValueError("unknown host %r in %r" % (word, text))
+
+    if len(words) < 4 or words[1] != "may":
+        raise ValueError("expected '<host> may [not] ...' in %r" % text)
+    allow = words[2] != "not"
+    rest = words[2:] if allow else words[3:]
+
+    if len(rest) == 2 and rest[0] == "reach":
+        return Statement(text, allow, host(words[0]), host(rest[1]))
+    if len(rest) in (2, 4) and rest[0] == "send" and rest[1] in PROTOCOLS:
+        dst = None
+        if len(rest) == 4:
+            if rest[2] != "to":
+                raise ValueError("expected 'to <host>' in %r" % text)
+            dst = host(rest[3])
+        return Statement(text, allow, host(words[0]), dst, PROTOCOLS[rest[1]])
+    raise ValueError("expected 'reach <host>' or 'send icmp|tcp|udp [to <host>]' in %r" % text)
+
+
+class Policy(object):
+    # ips maps host names to addresses, subnets (optional) to their subnets
+    # outputs is the port allowed traffic goes out of: one for every host, or
+    # a dict with the port of each destination host
+
+    def __init__(self, ips, statements, outputs, default="allow", subnets=None):
+        if default not in ("allow", "deny"):
+            raise ValueError("default must be allow or deny, not %r" % (default,))
+        self.ips = dict((name, ipaddress.ip_address(ip)) for name, ip in ips.items())
+        self.names = dict((ip, name) for name, ip in self.ips.items())
+        self.subnets = dict((name, ipaddress.ip_network(net)) for name, net in (subnets or {}).items())
+        self.statements = [parse_statement(text, ips) for text in statements]
+        self.outputs = outputs
+        self.default = default
+        protos = set(st.proto for st in self.statements if st.proto is not None)
+        self.protos = sorted(protos) + [OTHER]
+        self.compile_time = None
+
+    def output(self, host):
+        if isinstance(self.outputs, dict):
+            return self.outputs[host]
+        return self.outputs
+
+    # what happens to proto traffic from src to dst (host names): the output
+    # port, or None if it is dropped
+    def decide(self, src, dst, proto):
+        for st in self.statements:
+            if st.matches(src, dst, proto):
+                return self.output(dst) if st.allow else None
+        return self.output(dst) if self.default == "allow" else None
+
+    # every (src, dst, proto) between two different hosts, as (names, addresses)
+    def flows(self):
+        for src, src_ip in self.ips.items():
+            for dst, dst_ip in self.ips.items():
+                if src == dst:
+                    continue
+                for p in self.protos:
+                    yield (src, dst, p), (src_ip, dst_ip, p)
+
+    # one exact rule per host pair, the way the tables used to be written
+    def naive(self):
+        rules = []
+        for src, src_ip in self.ips.items():
+            for dst, dst_ip in self.ips.items():
+                if src == dst:
+                    continue
+                common = self.decide(src, dst, OTHER)
+                for proto in self.protos[:-1]:
+                    port = self.decide(src, dst, proto)
+                    if port != common:
+                        rules.append(Rule(TOP_PRIORITY, host_prefix(src_ip), host_prefix(dst_ip), proto, port))
+                if common is not None or self.default == "allow":
+                    rules.append(Rule(ALLOW_PRIORITY, host_prefix(src_ip), host_prefix(dst_ip), None, common))
+        if self.default == "deny":
+            rules.append(Rule(0))
+        return rules
+
+    def compile(self):
+        started = time.time()
+        rules = []
+        priority = TOP_PRIORITY
+        for st in self.statements:
+            src = host_prefix(self.ips[st.src]) if st.src else None
+            if not st.allow:
+                dst = host_prefix(self.ips[st.dst]) if st.dst else None
+                rules.append(Rule(priority, src, dst, st.proto, None))
+            else:
+                dsts = [st.dst] if st.dst else [name for name in self.ips if name != st.src]
+                rules += self.route(priority, src, st.proto, dsts)
+            priority -= 1
+
+        if self.default == "allow":
+            rules += self.route(min(priority, ALLOW_PRIORITY), None, None, list(self.ips))
+        else:
+            rules.append(Rule(0))
+
+        table = Table(rules, self.ips.values())
+        rules = self.merge(rules, table)
+        rules = self.prune(rules, table)
+        rules.sort(key=lambda rule: -rule.priority)
+        self.compile_time = time.time() - started
+        return rules
+
+    # rules sending traffic to the dsts hosts out of their ports, one per
+    # prefix of the hosts that share a port
+    def route(self, priority, src, proto, dsts):
+        by_port = {}
+        for name in dsts:
+            by_port.setdefault(self.output(name), []).append(name)
+
+        rules = []
+        for port, names in by_port.items():
+            others = [ip for name, ip in self.ips.items() if name not in names]
+            for prefix in self.aggregate(names, others):
+                rules.append(Rule(priority, src, prefix, proto, port))
+        return rules
+
+    # as few prefixes as possible covering the addresses of names and none
+    # of the others, starting from each host's subnet ("0.0.0.0/0" is None)
+    def aggregate(self, names, others):
+        others = sorted(others)
+
+        # whether net has none of the others in it
+        def clear(net):
+            i = bisect.bisect_left(others, net.network_address)
+            return i == len(others) or others[i] > net.broadcast_address
+
+        nets = []
+        for name in names:
+            net = self.subnets.get(name)
+            if net is None or self.ips[name] not in net or not clear(net):
+                net = ipaddress.ip_network(host_prefix(self.ips[name]))
+            nets.append(net)
+
+        # in address order, a net can only merge with the ones before it
+        # through the last one, which the merged net covers as well
+        merged = []
+        for net in ipaddress.collapse_addresses(nets):
+            while merged:
+                wider = supernet(merged[-1], net)
+                if not clear(wider):
+                    break
+                merged.pop()
+                net = wider
+            merged.append(net)
+        return [None if net.prefixlen == 0 else str(net) for net in merged]
+
+    # the rule covering both a and b, None if they can't be merged: they need
+    # the same protocol and action, and a rule sending traffic out of a port
+    # can't cover hosts that are reached through another one
+    def merged(self, a, b, table):
+        if a.proto != b.proto or a.port != b.port:
+            return None
+        dst = common(a.dst_net, b.dst_net)
+        if a.port is not None and isinstance(self.outputs, dict):
+            dst_net = ipaddress.ip_network(dst) if dst else None
+            if any(self.outputs[self.names[ip]] != a.port for ip in table.covered(dst_net)):
+                return None
+        return Rule(max(a.priority, b.priority), common(a.src_net, b.src_net), dst, a.proto, a.port)
+
+    # merges pairs of rules into one over their common prefixes, where that
+    # changes no decision. A merged rule goes on taking in the rules after
+    # it, the scan doesn't start over.
+    def merge(self, rules, table):
+        rules = list(rules)
+        i = 0
+        while i < len(rules):
+            j = i + 1
+            while j < len(rules):
+                a, b = rules[i], rules[j]
+                rule = self.merged(a, b, table)
+                if rule is not None and self.same_decisions(table, rule, (a, b), rule):
+                    table.remove(a)
+                    table.remove(b)
+                    table.add(rule)
+                    rules[i] = rule
+                    del rules[j]
+                else:
+                    j += 1
+            i += 1
+        return rules
+
+    # drops the rules the table decides the same without
+    def prune(self, rules, table):
+        for rule in sorted(rules, key=lambda rule: rule.priority):
+            if self.same_decisions(table, rule, (rule,)):
+                table.remove(rule)
+                rules = [r for r in rules if r is not rule]
+        return rules
+
+    # whether table decides the same with the rules in without taken out and
+    # extra put in, checked on the flows rule matches (the only ones that
+    # change can affect)
+    def same_decisions(self, table, rule, without, extra=None):
+        for src in table.covered(rule.src_net):
+            for dst in table.covered(rule.dst_net):
+                if src == dst:
+                    continue
+                for proto in self.protos:
+                    if rule.proto is not None and proto != rule.proto:
+                        continue
+                    if table.lookup(src, dst, proto) != table.lookup(src, dst, proto, without, extra):
+                        return False
+        return True
+
+    # the flows (as host names) the two tables decide differently
+    def check(self, naive, compiled):
+        naive, compiled = Table(naive, self.ips.values()), Table(compiled, self.ips.values())
+        return [names for names, flow in self.flows() if naive.lookup(*flow) != compiled.lookup(*flow)]
+
+    # rule counts before and after, and whether the tables are equivalent
+    def report(self, naive, compiled):
+        mismatches = self.check(naive, compiled)
+        flows = len(self.ips) * (len(self.ips) - 1) * len(self.protos)
+        took = "" if self.compile_time is None else " in %.1f ms" % (self.compile_time * 1000)
+        if mismatches:
+            return "policy: %d rules compiled to %d%s, NOT equivalent on %d of %d flows, e.g. %s" % (
+                len(naive), len(compiled), took, len(mismatches), flows, mismatches[0])
+        return "policy: %d rules compiled to %d%s, equivalent on all %d flows between the hosts" % (
+            len(naive), len(compiled), took, flows)
+
+
+MISS = "controller"
+# two rules of the same priority match with different actions, the switch
+# could apply either
+AMBIGUOUS = "ambiguous"
+
+
+class Table(object):
+    # a flow table indexed for lookups of flows between hosts: rules for an
+    # exact (src, dst) host pair under that pair, the others under each host
+    # their dst covers, so a lookup only looks at the rules that can match.
+    # Only addresses in hosts can be looked up.
+
+    def __init__(self, rules, hosts):
+        self.hosts = sorted(hosts)
+        self.exact = {}
+        self.by_dst = dict((ip, []) for ip in self.hosts)
+        for rule in rules:
+            self.add(rule)
+
+    # the hosts in net (all of them for None), in address order
+    def covered(self, net):
+        if net is None:
+            return self.hosts
+        lo = bisect.bisect_left(self.hosts, net.network_address)
+        hi = bisect.bisect_right(self.hosts, net.broadcast_address)
+        return self.hosts[lo:hi]
+
+    # the index lists rule goes in
+    def entries(self, rule):
+        if (rule.src_net is not None and rule.src_net.prefixlen == 32
+                and rule.dst_net is not None and rule.dst_net.prefixlen == 32):
+            return [self.exact.setdefault((rule.src_net.network_address, rule.dst_net.network_address), [])]
+        return [self.by_dst[ip] for ip in self.covered(rule.dst_net)]
+
+    def add(self, rule):
+        for entry in self.entries(rule):
+            entry.append(rule)
+
+    def remove(self, rule):
+        for entry in self.entries(rule):
+            entry.remove(rule)
+
+    # the action of the highest priority rule matching the flow, MISS if none
+    # does; with the rules in without left out and extra put in
+    def lookup(self, src, dst, proto, without=(), extra=None):
+        best, action = None, MISS
+        candidates = itertools.chain(self.exact.get((src, dst), ()), self.by_dst.get(dst, ()),
+                                     () if extra is None else (extra,))
+        for rule in candidates:
+            if rule in without or not rule.matches(src, dst, proto):
+                continue
+            if best is None or rule.priority > best.priority:
+                best, action = rule, rule.port
+            elif rule.priority == best.priority and rule.port != action:
+                action = AMBIGUOUS
+        return action
+
+
+def host_prefix(ip):
+    return "%s/32" % ip
+
+
+# the smallest network containing both
+def supernet(a, b):
+    net = a if a.prefixlen <= b.prefixlen else b
+    while not (a.subnet_of(net) and b.subnet_of(net)):
+        net = net.supernet()
+    return net
+
+
+# common prefix of two rule fields, None (any) if either is any
+def common(a, b):
+    if a is None or b is None:
+        return None
+    net = supernet(a, b)
+    return None if net.prefixlen == 0 else str(net)
+
+
+# compiles the policy of a made-up network as big as the command line asks
+# (CHECK_HOSTS by default): every host on a /24 of its own, spread over 8
+# ports, and fails if the result isn't equivalent or CHECK_HOSTS hosts take
+# longer than CHECK_BUDGET
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else CHECK_HOSTS
+    ips = dict(("h%d" % i, "10.%d.%d.10" % (i // 250, i % 250)) for i in range(count))
+    subnets = dict(("h%d" % i, "10.%d.%d.0/24" % (i // 250, i % 250)) for i in range(count))
+    ports = dict(("h%d" % i, i % 8 + 1) for i in range(count))
+    statements = ["h0 may not send icmp", "h1 may not reach h2", "h3 may not send udp to h%d" % (count - 1)]
+
+    policy = Policy(ips, statements, ports, subnets=subnets)
+    compiled = policy.compile()
+    print(policy.report(policy.naive(), compiled))
+    if policy.check(policy.naive(), compiled):
+        sys.exit(1)
+    if count <= CHECK_HOSTS and policy.compile_time > CHECK_BUDGET:
+        print("policy: compiling %d hosts took longer than %.1f s" % (count, CHECK_BUDGET))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
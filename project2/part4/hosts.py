@@ -0,0 +1,181 @@
+# Controller-wide table of where the hosts are, shared by every switch
+#
+# Hosts are learned from their ARP packets and kept by integer IP and by MAC,
+# both plain dicts, so a lookup costs the same with five hosts or fifty
+# thousand. Each entry has the host's location on every switch that has seen
+# its ARP (dpid -> port; every switch reaches a host through a port of its
+# own) and when it was last seen. The entries are also kept in an
+# OrderedDict from least to most recently seen, which lets the aging timer
+# evict the idle ones from its front without looking at the others.
+#
+# A host seen on another port of the same switch, or with a new MAC, has
+# moved: the flows installed towards it on that switch (on all of them for a
+# new MAC, see depend()) are deleted and HostMoved is raised. A switch seeing
+# the host for the first time is no move. An evicted host's flows are deleted
+# the same way, so its next packet comes up to the controller and gets the
+# host relearned.
+
+import collections
+import time
+
+from pox.core import core
+import pox.openflow.libopenflow_01 as of
+from pox.lib.addresses import IPAddr
+from pox.lib.recoco import Timer
+from pox.lib.revent import Event, EventMixin
+
+log = core.getLogger()
+
+IDLE_TIMEOUT = 300   # seconds without an ARP packet before a host is evicted
+SWEEP_INTERVAL = 10  # seconds between aging sweeps
+
+
+def ip_key(ip):
+    return IPAddr(ip).toUnsigned()
+
+
+class HostEntry(object):
+    __slots__ = ("ip", "mac", "locations", "last_seen", "flows")
+
+    def __init__(self, ip, mac):
+        self.ip = ip        # integer
+        self.mac = mac      # string
+        self.locations = {}  # dpid -> port
+        self.last_seen = time.time()
+        # (dpid, nw_dst string, priority) -> match of the flows that send
+        # traffic to the host
+        self.flows = {}
+
+    def __repr__(self):
+        where = ", ".join("%s:%s" % location for location in sorted(self.locations.items()))
+        return "%s (%s) at %s" % (IPAddr(self.ip), self.mac, where)
+
+
+class HostMoved(Event):
+    # raised when a host turns up on another port of dpid or with another MAC,
+    # after its flows are deleted
+
+    def __init__(self, entry, dpid, old_port, old_mac):
+        Event.__init__(self)
+        self.entry = entry
+        self.dpid = dpid
+        self.old_port = old_port
+        self.old_mac = old_mac
+
+
+class HostExpired(Event):
+    # raised when an idle host is evicted, after its flows are deleted
+
+    def __init__(self, entry):
+        Event.__init__(self)
+        self.entry = entry
+
+
+class HostTable(EventMixin):
+    _eventMixin_events = set([HostMoved, HostExpired])
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, sweep_interval=SWEEP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.by_ip = {}
+        self.by_mac = {}
+        # ip -> entry, least recently seen first
+        self.by_age = collections.OrderedDict()
+        self.timer = Timer(sweep_interval, self.expire, recurring=True)
+
+    def __len__(self):
+        return len(self.by_ip)
+
+    # records that ip has mac and was seen on dpid's port, returns its entry
+    def learn(self, ip, mac, dpid, port):
+        key, mac = ip_key(ip), str(mac)
+        entry = self.by_ip.get(key)
+        if entry is None:
+            entry = HostEntry(key, mac)
+            entry.locations[dpid] = port
+            self.by_ip[key] = entry
+            self.by_mac[mac] = entry
+            self.by_age[key] = entry
+            log.debug("Learned %s", entry)
+            return entry
+
+        entry.last_seen = time.time()
+        self.by_age.move_to_end(key)
+        old_port, old_mac = entry.locations.get(dpid), entry.mac
+        entry.locations[dpid] = port
+        if mac != old_mac:
+            # another machine has the address now, nothing about it holds
+            if self.by_mac.get(old_mac) is entry:
+                del self.by_mac[old_mac]
+            entry.mac = mac
+            self.by_mac[mac] = entry
+            entry.locations = {dpid: port}
+            log.info("Host %s changed MAC from %s", entry, old_mac)
+            self.invalidate(entry)
+            self.raiseEvent(HostMoved(entry, dpid, old_port, old_mac))
+        elif old_port is not None and old_port != port:
+            log.info("Host %s moved from %s:%s", entry, dpid, old_port)
+            self.invalidate(entry, dpid)
+            self.raiseEvent(HostMoved(entry, dpid, old_port, old_mac))
+        return entry
+
+    # the entry for ip, None if it is unknown or (given dpid) that switch
+    # doesn't know where it is
+    def lookup(self, ip, dpid=None):
+        entry = self.by_ip.get(ip_key(ip))
+        if entry is None or (dpid is not None and dpid not in entry.locations):
+            return None
+        return entry
+
+    def lookup_mac(self, mac):
+        return self.by_mac.get(str(mac))
+
+    # records a flow_mod installed on dpid that sends traffic to ip, to delete
+    # it when the host moves or is evicted
+    def depend(self, ip, dpid, flow_mod):
+        entry = self.by_ip.get(ip_key(ip))
+        if entry is not None:
+            key = (dpid, str(flow_mod.match.nw_dst), flow_mod.priority)
+            entry.flows[key] = flow_mod.match
+
+    # forgets a flow depend() recorded, once the switch has removed it
+    def forget(self, ip, dpid, priority):
+        entry = self.by_ip.get(ip_key(ip))
+        if entry is not None:
+            entry.flows.pop((dpid, str(IPAddr(ip)), priority), None)
+
+    # deletes the flows towards entry from their switches (from dpid only,
+    # if given)
+    def invalidate(self, entry, dpid=None):
+        for key, match in list(entry.flows.items()):
+            flow_dpid, _, priority = key
+            if dpid is not None and flow_dpid != dpid:
+                continue
+            del entry.flows[key]
+            connection = core.openflow.getConnection(flow_dpid)
+            if connection is None:
+                continue
+            # strict, so only this flow goes and not the policy rules it overlaps
+            msg = of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT, match=match, priority=priority)
+            connection.send(msg)
+
+    # evicts the hosts that have been idle for too long
+    def expire(self):
+        idle_since = time.time() - self.idle_timeout
+        while self.by_age:
+            key, entry = next(iter(self.by_age.items()))
+            if entry.last_seen > idle_since:
+                break
+            del self.by_age[key]
+            del self.by_ip[key]
+            if self.by_mac.get(entry.mac) is entry:
+                del self.by_mac[entry.mac]
+            log.debug("Evicted idle host %s", entry)
+            self.invalidate(entry)
+            self.raiseEvent(HostExpired(entry))
+
+
+# the table shared by all switches, registered as core.HostTable
+def get_host_table():
+    if not core.hasComponent("HostTable"):
+        core.registerNew(HostTable)
+    return core.HostTable
@@ -3,10 +3,24 @@
 # based on Lab Final from UCSC's Networking Class
 # which is based on of_tutorial by James McCauley
 
+import collections
+import itertools
+import time
+
 from pox.core import core
 import pox.openflow.libopenflow_01 as of
 from pox.lib.addresses import IPAddr, IPAddr6, EthAddr
 from pox.lib.packet import arp, ethernet
+from pox.lib.recoco import Timer
+
+# flows.py and hosts.py sit next to this file, in pox/ext or in a package
+# like pox/misc
+try:
+    from .flows import get_installer
+    from .hosts import get_host_table
+except ImportError:
+    from flows import get_installer
+    from hosts import get_host_table
 
 log = core.getLogger()
 
@@ -28,19 +42,67 @@ SUBNETS = {
     "hnotrust": "172.16.10.0/24",
 }
 
+# the forwarding flows forward_ip installs go away after this many seconds
+# without traffic, and after FLOW_HARD_TIMEOUT in any case (0 never)
+FLOW_IDLE_TIMEOUT = 30
+FLOW_HARD_TIMEOUT = 300
+FORWARD_PRIORITY = 10
+
+# packets to a destination without a host entry wait for its ARP reply: at
+# most PENDING_PACKETS per destination (the oldest go first) for at most
+# PENDING_AGE seconds, and for at most PENDING_DESTINATIONS destinations
+PENDING_PACKETS = 64
+PENDING_AGE = 5
+PENDING_DESTINATIONS = 1024
+# seconds to wait for the reply to each ARP request before sending the next
+# one: requests go out at 0, 1 and 3 s. After the last one the packets wait
+# until the newest of them is PENDING_AGE old (5 s for a burst at 0 s, 8 s
+# at the latest), then they are dropped, unless some came in after the last
+# request: those get a new round of requests.
+ARP_RETRIES = (1, 2)
+
+
+class PendingDestination(object):
+    # packets waiting for the ARP reply of their destination
+
+    def __init__(self, ip_src):
+        # the ARP request asks on behalf of the first packet's sender
+        self.ip_src = ip_src
+        # (time queued, ofp_packet_in, in port), oldest first
+        self.packets = collections.deque()
+        self.requests = 0       # sent in this round
+        self.last_request = None
+        self.timer = None
+
+
 class Part4Controller(object):
     """
     A Connection object for that switch is passed to the __init__ function.
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, idle_timeout=FLOW_IDLE_TIMEOUT, hard_timeout=FLOW_HARD_TIMEOUT):
         print(connection.dpid)
         # Keep track of the connection to the switch so that we can
         # send it messages!
         self.connection = connection
-
-        # create ARP table to map IPs to MAC addresses and port
-        self.arp_table = {}
+        self.idle_timeout = idle_timeout
+        self.hard_timeout = hard_timeout
+        # forwarding flows installed on the switch: destination IP -> (MAC,
+        # port, cookie), until the switch reports them removed
+        self.installed = {}
+        # tells the flows to one destination apart, so the removal of an old
+        # one isn't taken for the one that replaced it
+        self.cookies = itertools.count(1)
+        self.flow_hits = 0    # packets whose flow was already installed
+        self.flow_misses = 0  # flow_mods sent
+        # destination IP -> PendingDestination, while its ARP request is out
+        self.pending = {}
+        # the switch's rules, sent all at once when they are all set up
+        self.rules = []
+        self.installer = get_installer()
+
+        # where the hosts are (MAC, switch and port), shared by all switches
+        self.hosts = get_host_table()
         # This binds our PacketIn event listener
         connection.addListeners(self)
         # use the dpid to figure out what switch is being created
@@ -57,11 +119,12 @@ class Part4Controller(object):
         else:
             print("UNKNOWN SWITCH")
             exit(1)
+        self.installer.install(connection, self.rules)
 
     def setup(self):
         arp_rule = of.ofp_flow_mod()
         arp_rule.actions.append(of.ofp_action_output(port=of.OFPP_FLOOD))
-        self.connection.send(arp_rule)
+        self.rules.append(arp_rule)
 
     def s1_setup(self):
         # Set up ARP rules for switch 1
@@ -82,7 +145,7 @@ class Part4Controller(object):
         hnotrust_drop_rule.match.nw_proto = 1
         hnotrust_drop_rule.match.nw_src = IPS["hnotrust"]
         hnotrust_drop_rule.actions = []
-        self.connection.send(hnotrust_drop_rule)
+        self.rules.append(hnotrust_drop_rule)
 
         serv1_drop_rule = of.ofp_flow_mod()
         serv1_drop_rule.priority = 20
@@ -90,7 +153,7 @@ class Part4Controller(object):
         serv1_drop_rule.match.nw_src = IPS["hnotrust"]
         serv1_drop_rule.match.nw_dst = IPS["serv1"]
         serv1_drop_rule.actions = []
-        self.connection.send(serv1_drop_rule)
+        self.rules.append(serv1_drop_rule)
 
     def dcs31_setup(self):
         # Set up ARP rules for switch 31
@@ -113,15 +176,19 @@ class Part4Controller(object):
         if arp_packet.opcode == arp.REQUEST :
             self.learn_packet(packet, event)
             self.send_arp_reply(packet, event)
+        # or the answer to one of ours
+        elif arp_packet.opcode == arp.REPLY :
+            self.learn_packet(packet, event)
 
     def learn_packet(self, packet, event) :
-        # takes in ARP packet and maps IP to MAC, Port tuple
+        # takes in ARP packet and records the sender's MAC and location
         arp_payload = packet.payload
-        ip = str(arp_payload.protosrc)
-        mac = str(arp_payload.hwsrc)
-        port = event.port
-        self.arp_table[ip] = (mac, port)
-        print(f"Learned address for IP {ip}: MAC {mac}, Port {port}")
+        entry = self.hosts.learn(arp_payload.protosrc, arp_payload.hwsrc, self.connection.dpid, event.port)
+        print(f"Learned address for IP {arp_payload.protosrc}: MAC {entry.mac}, Port {event.port}")
+
+        pending = self.pending.pop(str(arp_payload.protosrc), None)
+        if pending is not None:
+            self.release_packets(str(arp_payload.protosrc), entry, pending)
 
     def send_arp_reply(self, packet, event) :
         # proxy the ARP replies
@@ -142,53 +209,165 @@ class Part4Controller(object):
         self.resend_packet(reply_eth.pack(), event.port)
 
     def forward_ip(self, packet, event) :
-        # method to forward IP packets using the ARP table records
+        # method to forward IP packets using the host table records
 
         ip_packet = packet.payload
 
         ip_src = str(ip_packet.srcip)
         ip_dst = str(ip_packet.dstip)
 
-        print(f"Verifying if destination IP {ip_dst} exists in ARP table: {self.arp_table}")
+        print(f"Verifying if destination IP {ip_dst} is a known host ({len(self.hosts)} known)")
 
-        if ip_dst in self.arp_table:
-            mac, port = self.arp_table[ip_dst]
+        # only hosts learned on this switch, we don't know the port to others
+        entry = self.hosts.lookup(ip_dst, self.connection.dpid)
+        if entry is not None:
+            mac, port = entry.mac, entry.locations[self.connection.dpid]
             print(f"Found record for IP {ip_dst}: MAC {mac}, Port {port}")
-            forward_rule = of.ofp_flow_mod()
-            forward_rule.match.dl_type = 0x0800
-            forward_rule.match.nw_dst = IPAddr(ip_dst)
-            forward_rule.actions.append(of.ofp_action_dl_addr.set_src(self.connection.eth_addr))
-            forward_rule.actions.append(of.ofp_action_dl_addr.set_dst(EthAddr(mac.encode())))
-            forward_rule.actions.append(of.ofp_action_output(port=port))
-            forward_rule.priority = 10
-            self.connection.send(forward_rule)
-
-            
+            self.install_flow(ip_dst, mac, port)
+
             ethernet_record = packet.find('ethernet')
             if ethernet_record :
                 ethernet_record.src = self.connection.eth_addr
-
-            if mac :
-                ethernet_record.dst = forward_rule.actions.append(of.ofp_action_dl_addr.set_dst(EthAddr(mac)))
+                ethernet_record.dst = EthAddr(mac)
                 self.resend_packet(packet, port)
         else:
-            print(f"No ARP entry found for {ip_dst}, broadcasting ARP request.")
-
-            arp_req = arp()
-            arp_req.opcode = arp.REQUEST
-            arp_req.hwsrc = self.connection.eth_addr
-            arp_req.hwdst = EthAddr("ff:ff:ff:ff:ff:ff")
-            arp_req.protosrc = IPAddr(ip_src)
-            arp_req.protodst = IPAddr(ip_dst)
-
-            eth = ethernet()
-            eth.type = ethernet.ARP_TYPE
-            eth.src = self.connection.eth_addr
-            eth.dst = arp_req.hwdst
-            eth.payload = arp_req
-
-            self.resend_packet(eth.pack(), of.OFPP_FLOOD)
+            self.hold_packet(ip_src, ip_dst, event)
+
+    # sends traffic to ip_dst to mac out of port, unless the switch has that
+    # flow already
+    def install_flow(self, ip_dst, mac, port):
+        if self.installed.get(ip_dst, ())[:2] == (mac, port):
+            # sent up while its flow was going in, no need for another one
+            self.flow_hits += 1
+            return
+        self.flow_misses += 1
+        forward_rule = of.ofp_flow_mod()
+        forward_rule.match.dl_type = 0x0800
+        forward_rule.match.nw_dst = IPAddr(ip_dst)
+        forward_rule.actions.append(of.ofp_action_dl_addr.set_src(self.connection.eth_addr))
+        forward_rule.actions.append(of.ofp_action_dl_addr.set_dst(EthAddr(mac)))
+        forward_rule.actions.append(of.ofp_action_output(port=port))
+        forward_rule.priority = FORWARD_PRIORITY
+        forward_rule.cookie = next(self.cookies)
+        forward_rule.idle_timeout = self.idle_timeout
+        forward_rule.hard_timeout = self.hard_timeout
+        # so that _handle_FlowRemoved can keep self.installed right
+        forward_rule.flags = of.OFPFF_SEND_FLOW_REM
+        self.connection.send(forward_rule)
+        self.installed[ip_dst] = (mac, port, forward_rule.cookie)
+        # deleted again if the host moves
+        self.hosts.depend(ip_dst, self.connection.dpid, forward_rule)
+
+    # keeps the packet until ip_dst answers ARP, the first one to a destination
+    # sends the ARP request
+    def hold_packet(self, ip_src, ip_dst, event):
+        pending = self.pending.get(ip_dst)
+        if pending is None:
+            if len(self.pending) >= PENDING_DESTINATIONS:
+                print(f"Already waiting for {len(self.pending)} destinations, dropping packet to {ip_dst}")
+                return
+            print(f"No host entry found for {ip_dst}, broadcasting ARP request.")
+            pending = self.pending[ip_dst] = PendingDestination(ip_src)
+            self.request_arp(ip_dst, pending)
+
+        if len(pending.packets) >= PENDING_PACKETS:
+            pending.packets.popleft()
+        pending.packets.append((time.time(), event.ofp, event.port))
+
+    # sends the next ARP request for ip_dst and sets the timer for the one
+    # after (see ARP_RETRIES)
+    def request_arp(self, ip_dst, pending):
+        self.send_arp_request(pending.ip_src, ip_dst)
+        pending.requests += 1
+        pending.last_request = time.time()
+        if pending.requests <= len(ARP_RETRIES):
+            delay = ARP_RETRIES[pending.requests - 1]
+        else:
+            # the last one, the packets can't wait longer than the newest can
+            delay = PENDING_AGE - (pending.last_request - pending.packets[-1][0])
+        pending.timer = Timer(delay, self.retry_arp, args=[ip_dst])
 
+    def retry_arp(self, ip_dst):
+        pending = self.pending.get(ip_dst)
+        if pending is None:
+            return
+        now = time.time()
+        if pending.requests > len(ARP_RETRIES):
+            # the round is over: only packets from after its last request
+            # are worth another one
+            while pending.packets and pending.packets[0][0] <= pending.last_request:
+                pending.packets.popleft()
+            pending.requests = 0
+        while pending.packets and now - pending.packets[0][0] > PENDING_AGE:
+            pending.packets.popleft()
+
+        if not pending.packets:
+            del self.pending[ip_dst]
+            print(f"No ARP reply from {ip_dst}, dropped the packets waiting for it.")
+            return
+        print(f"No ARP reply from {ip_dst} yet, broadcasting ARP request again.")
+        self.request_arp(ip_dst, pending)
+
+    # sends the packets held for ip_dst through the flow to its new entry
+    def release_packets(self, ip_dst, entry, pending):
+        if pending.timer is not None:
+            pending.timer.cancel()
+        self.install_flow(ip_dst, entry.mac, entry.locations[self.connection.dpid])
+        # the switch finishes everything before a barrier first, so the
+        # packets find the flow in the table
+        self.connection.send(of.ofp_barrier_request())
+
+        now = time.time()
+        released = 0
+        for queued, packet_in, in_port in pending.packets:
+            if now - queued > PENDING_AGE:
+                continue
+            msg = of.ofp_packet_out(data=packet_in, in_port=in_port)
+            msg.actions.append(of.ofp_action_output(port=of.OFPP_TABLE))
+            self.connection.send(msg)
+            released += 1
+        print(f"Released {released} packets to {ip_dst}.")
+
+    def send_arp_request(self, ip_src, ip_dst):
+        arp_req = arp()
+        arp_req.opcode = arp.REQUEST
+        arp_req.hwsrc = self.connection.eth_addr
+        arp_req.hwdst = EthAddr("ff:ff:ff:ff:ff:ff")
+        arp_req.protosrc = IPAddr(ip_src)
+        arp_req.protodst = IPAddr(ip_dst)
+
+        eth = ethernet()
+        eth.type = ethernet.ARP_TYPE
+        eth.src = self.connection.eth_addr
+        eth.dst = arp_req.hwdst
+        eth.payload = arp_req
+
+        self.resend_packet(eth.pack(), of.OFPP_FLOOD)
+
+    def _handle_FlowRemoved(self, event):
+        # a forwarding flow timed out or was deleted (see hosts.py)
+        flow = event.ofp
+        if flow.priority != FORWARD_PRIORITY or flow.match.nw_dst is None:
+            return
+        ip_dst = str(flow.match.nw_dst)
+        installed = self.installed.get(ip_dst)
+        if installed is not None and installed[2] == flow.cookie:
+            # the current flow, not an older one replaced since (after a move)
+            del self.installed[ip_dst]
+            self.hosts.forget(ip_dst, self.connection.dpid, flow.priority)
+            log.debug("Switch %s: flow to %s removed, %d installed, %d hits, %d misses",
+                      self.connection.dpid, ip_dst, len(self.installed), self.flow_hits, self.flow_misses)
+
+    def _handle_ConnectionDown(self, event):
+        # no more ARP requests on the dead connection, and its queued packets
+        # can go now instead of once they age out
+        for pending in self.pending.values():
+            if pending.timer is not None:
+                pending.timer.cancel()
+        if self.pending:
+            log.debug("Switch %s down: dropping packets queued for %d destinations",
+                      self.connection.dpid, len(self.pending))
+        self.pending.clear()
 
     def _handle_PacketIn(self, event):
         """
@@ -196,6 +375,10 @@ class Part4Controller(object):
         forwarded to this method to be handled by the controller
         """
 
+        # came in before the rules for it, it goes through them once they are
+        if self.installer.hold(event):
+            return
+
         packet = event.parsed 
         if not packet.parsed:
             log.warning("Ignoring incomplete packet")
@@ -213,13 +396,13 @@ class Part4Controller(object):
             )
 
 
-def launch():
+def launch(idle_timeout=FLOW_IDLE_TIMEOUT, hard_timeout=FLOW_HARD_TIMEOUT):
     """
     Starts the component
     """
 
     def start_switch(event):
         log.debug("Controlling %s" % (event.connection,))
-        Part4Controller(event.connection)
+        Part4Controller(event.connection, int(idle_timeout), int(hard_timeout))
 
     core.openflow.addListenerByName("ConnectionUp", start_switch)